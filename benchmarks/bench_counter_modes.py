@@ -0,0 +1,182 @@
+"""
+
+Compares write and read cost of the Motor backend counter modes (MotorConfig.counter_mode):
+"periods" writes total, year, month, week and day counters, "daily" writes total and daily counters
+and sums daily counters up at query time.
+
+For every mode a fresh database is seeded with a year of history, then live messages and reactions
+are written and top-10 queries of every period are timed with cold and warm rollup cache.
+
+    python -m benchmarks.bench_counter_modes --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.bench_counter_modes --backend motor-mock  # requires mongomock-motor
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import typing
+from datetime import datetime, timedelta
+
+import yaml
+from pymongo import monitoring
+
+from benchmarks.bench_ingestion import EventGenerator, _BenchCog, _OperationCounter, _git_revision, _percentile
+from benchmarks.bench_ingestion import parse_args as parse_ingestion_args
+from emoji_maniac.bot.config import Config
+from emoji_maniac.bot.emoji import get_emojis
+from emoji_maniac.persistence.backends.motor import COUNTER_MODES
+from emoji_maniac.persistence.models import EmojiSource
+
+PERIODS = ('total', 'yearly', 'monthly', 'weekly', 'daily')
+COUNTER_COLLECTIONS = ('ds_emoji_counters', 'ds_emoji_daily', 'ds_emoji_gld_counters')
+
+
+def _create_backend(args, workdir: str, mode: str):
+    import motor.motor_asyncio
+    if args.backend == 'motor-mock':
+        import mongomock_motor
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    from emoji_maniac.persistence.backends.motor import MotorEmojiBackend
+
+    cfg = {
+        'token': 'benchmark',
+        'backend': 'motor',
+        'emoji_backends': {
+            'motor': {'uri': args.mongo_uri, 'dbname': f'{args.mongo_db}_{mode}', 'counter_mode': mode},
+        }
+    }
+    cfg_file = os.path.join(workdir, f'bench_{mode}.yaml')
+    with open(cfg_file, 'w') as f:
+        yaml.safe_dump(cfg, f)
+    return MotorEmojiBackend(Config(cfg_file))
+
+
+async def _seed_history(backend, generator: EventGenerator, args):
+    now = datetime.utcnow()
+    batch = []
+    for _ in range(args.history):
+        message = generator.message()
+        at = now - timedelta(days=generator.rnd.random() * args.history_days)
+        source = EmojiSource.from_message(message)
+        batch += [(source, emoji_obj, at) for emoji_obj in get_emojis(message.content)]
+        if len(batch) >= 500:
+            await backend.submit_history(batch)
+            batch = []
+    if batch:
+        await backend.submit_history(batch)
+
+
+async def _time_query(backend, period: str, guild_id: int, user_id: typing.Optional[int]) -> float:
+    method = getattr(backend, 'get_emojis_top10' if period == 'total' else f'get_emojis_top10_{period}')
+    started_at = time.perf_counter()
+    await method(guild_id, user_id)
+    return time.perf_counter() - started_at
+
+
+async def run_mode(args, mode: str, workdir: str, counter: _OperationCounter) -> dict:
+    backend = _create_backend(args, workdir, mode)
+    await backend.motor_client.drop_database(backend._cfg.dbname)
+    await backend.init()
+
+    generator = EventGenerator(args, random.Random(args.seed))
+    await _seed_history(backend, generator, args)
+
+    cog = _BenchCog(backend)
+    handlers = {
+        'message': cog._on_message,
+        'reaction_add': cog._on_raw_reaction_add,
+        'reaction_remove': cog._on_raw_reaction_remove,
+    }
+    events = generator.stream(args.events)
+    operations_before = counter.count
+    started_at = time.perf_counter()
+    for (kind, event) in events:
+        await handlers[kind](event)
+    write_duration = time.perf_counter() - started_at
+    write_operations = counter.count - operations_before
+
+    documents = {}
+    for collection in COUNTER_COLLECTIONS:
+        documents[collection] = await backend._db[collection].count_documents({})
+
+    reads = {}
+    targets = [(guild_id, None) for guild_id in generator.guilds[:args.query_guilds]] + \
+              [(generator.guilds[0], user_id) for user_id in generator.users[:args.query_guilds]]
+    for period in PERIODS:
+        cold, warm = [], []
+        for (guild_id, user_id) in targets:
+            await backend.clear_cache()
+            cold.append(await _time_query(backend, period, guild_id, user_id))
+            warm.append(await _time_query(backend, period, guild_id, user_id))
+        cold.sort()
+        warm.sort()
+        reads[period] = {
+            'cold_p50_ms': _percentile(cold, 50) * 1000,
+            'cold_max_ms': cold[-1] * 1000,
+            'warm_p50_ms': _percentile(warm, 50) * 1000,
+            'warm_max_ms': warm[-1] * 1000,
+        }
+
+    await backend.close()
+    return {
+        'events': len(events),
+        'write_events_per_s': len(events) / write_duration if write_duration else 0,
+        'write_db_operations_per_event': write_operations / len(events) if events else 0,
+        'documents': documents,
+        'reads': reads,
+    }
+
+
+async def run(args) -> dict:
+    counter = _OperationCounter()
+    monitoring.register(counter)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes:
+            results[mode] = await run_mode(args, mode, workdir, counter)
+    return {
+        'benchmark': 'counter_modes',
+        'revision': _git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'parameters': {k: v for (k, v) in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Counter modes benchmark of the Motor backend')
+    parser.add_argument('--backend', choices=['motor', 'motor-mock'], default='motor')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--mongo-db', default='emoji_maniac_bench')
+    parser.add_argument('--modes', nargs='+', choices=COUNTER_MODES, default=list(COUNTER_MODES))
+    parser.add_argument('--history', type=int, default=20000, help='number of history messages')
+    parser.add_argument('--history-days', type=int, default=365)
+    parser.add_argument('--events', type=int, default=5000, help='number of live events')
+    parser.add_argument('--query-guilds', type=int, default=5, help='number of guilds and users queried')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args, rest = parser.parse_known_args(argv)
+    # Event distribution parameters are shared with the ingestion benchmark (--guilds, --emoji-density...)
+    for (key, value) in vars(parse_ingestion_args(rest)).items():
+        if not hasattr(args, key):
+            setattr(args, key, value)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
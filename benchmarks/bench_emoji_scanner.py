@@ -0,0 +1,98 @@
+"""
+
+Micro-benchmark of emoji extraction: the single-pass scanner (emoji_maniac.bot.emoji.get_emojis)
+against the previous per-character lookup implementation.
+Note that the legacy implementation splits multi-codepoint sequences into their components,
+so for sequence-heavy texts it does less work and returns wrong results.
+
+    python -m benchmarks.bench_emoji_scanner
+
+"""
+import random
+import re
+import timeit
+import typing
+
+import emoji
+
+from emoji_maniac.bot.emoji import get_emojis, get_scanner
+from emoji_maniac.persistence.models import MessageEmoji
+
+_legacy_regex = re.compile(r'<:(\w+):(\d+)>')
+
+
+def get_emojis_legacy(text: str) -> typing.List[MessageEmoji]:
+    emoji_unicode = [c for c in text if c in emoji.UNICODE_EMOJI]
+    emoji_count = {}
+
+    for em in emoji_unicode:
+        c = emoji_count.get(em)
+        if c is not None:
+            emoji_count[em] = emoji_count[em] + 1
+        else:
+            emoji_count[em] = 1
+
+    emojis_list = [
+        MessageEmoji.unicode(emoji.UNICODE_EMOJI[c][1:-1], emoji_count[c])
+        for c in emoji_count.keys() if c in emoji.UNICODE_EMOJI]
+    match = _legacy_regex.findall(text)
+    if match:
+        custom_emojis_count = {}
+        for g in match:
+            name = g[0]
+            emoji_id = int(g[1])
+            key = (emoji_id, name)
+            c = custom_emojis_count.get(key)
+            if c is None:
+                custom_emojis_count[key] = 1
+            else:
+                custom_emojis_count[key] = custom_emojis_count[key] + 1
+
+        for (emoji_id, name), count in custom_emojis_count.items():
+            emojis_list.append(MessageEmoji.custom(name, emoji_id, count))
+    return emojis_list
+
+
+def _make_messages(rnd: random.Random) -> typing.Dict[str, str]:
+    words = ['hello', 'there', 'how', 'are', 'you', 'doing', 'today', 'lol', 'gg', 'nice', '1', '#2']
+    table = list(emoji.UNICODE_EMOJI.keys())
+    # Real messages reuse a small set of popular emojis
+    emojis = rnd.sample(table, 100)
+    customs = [f'<:custom{i}:{100000000000000000 + i}>' for i in range(20)]
+
+    def text(length: int, density: float):
+        parts = []
+        for _ in range(length):
+            roll = rnd.random()
+            if roll < density * 0.8:
+                parts.append(rnd.choice(emojis))
+            elif roll < density:
+                parts.append(rnd.choice(customs))
+            else:
+                parts.append(rnd.choice(words))
+        return ' '.join(parts)
+
+    return {
+        'short plain': text(10, 0),
+        'short, few emojis': text(10, 0.2),
+        'long plain (2000 words)': text(2000, 0),
+        'long, few emojis (2000 words)': text(2000, 0.05),
+        'emoji-dense (500 tokens)': text(500, 0.9),
+        'emoji-only, no spaces (500 emojis)': ''.join(rnd.choice(emojis) for _ in range(500)),
+        'whole table, no spaces (500 emojis)': ''.join(rnd.choice(table) for _ in range(500)),
+    }
+
+
+def main(number: int = 200):
+    # Build the scanner tables outside of the measurement
+    get_scanner()
+    messages = _make_messages(random.Random(42))
+    print(f'{"message":<40}{"legacy, us":>14}{"scanner, us":>14}{"speedup":>10}')
+    for (name, text) in messages.items():
+        legacy = min(timeit.repeat(lambda: get_emojis_legacy(text), number=number, repeat=5)) / number
+        scanner = min(timeit.repeat(lambda: get_emojis(text), number=number, repeat=5)) / number
+        print(f'{name:<40}{legacy * 1e6:>14.1f}{scanner * 1e6:>14.1f}{legacy / scanner:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
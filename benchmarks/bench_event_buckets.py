@@ -0,0 +1,191 @@
+"""
+
+Compares storage size and top query time of raw emoji events stored as a ds_emojies document per event
+("flat") and as hourly per-guild ds_emoji_buckets documents (MotorConfig.event_buckets, "buckets").
+
+For every layout a fresh database is seeded with the same history, then get_emojis_top is timed for
+guilds, users of a guild and the last week of a guild.
+
+    python -m benchmarks.bench_event_buckets --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.bench_event_buckets --backend motor-mock  # requires mongomock-motor
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bson
+import yaml
+
+from benchmarks.bench_ingestion import EventGenerator, _git_revision, _percentile
+from benchmarks.bench_ingestion import parse_args as parse_ingestion_args
+from emoji_maniac.bot.config import Config
+from emoji_maniac.bot.emoji import get_emojis
+from emoji_maniac.persistence.models import EmojiSource, EmojiBatch
+
+LAYOUTS = ('flat', 'buckets')
+EVENT_COLLECTIONS = ('ds_emojies', 'ds_emoji_buckets')
+
+
+def _create_backend(args, workdir: str, layout: str):
+    import motor.motor_asyncio
+    if args.backend == 'motor-mock':
+        import mongomock_motor
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    from emoji_maniac.persistence.backends.motor import MotorEmojiBackend
+
+    cfg = {
+        'token': 'benchmark',
+        'backend': 'motor',
+        'emoji_backends': {
+            'motor': {
+                'uri': args.mongo_uri,
+                'dbname': f'{args.mongo_db}_{layout}',
+                'event_buckets': layout == 'buckets',
+                'event_bucket_size': args.bucket_size,
+            },
+        }
+    }
+    cfg_file = os.path.join(workdir, f'bench_{layout}.yaml')
+    with open(cfg_file, 'w') as f:
+        yaml.safe_dump(cfg, f)
+    return MotorEmojiBackend(Config(cfg_file))
+
+
+async def _collection_size(db, collection: str) -> dict:
+    """
+    Returns document count and sizes of a collection, from collStats when the server supports it,
+    otherwise the BSON size of the documents
+    """
+    try:
+        stats = await db.command('collStats', collection)
+        return {
+            'documents': stats.get('count', 0),
+            'data_bytes': stats.get('size', 0),
+            'storage_bytes': stats.get('storageSize'),
+            'index_bytes': stats.get('totalIndexSize'),
+        }
+    except Exception:
+        sizes = [len(bson.encode(doc)) async for doc in db[collection].find({})]
+        return {'documents': len(sizes), 'data_bytes': sum(sizes), 'storage_bytes': None, 'index_bytes': None}
+
+
+async def _seed(backend, generator: EventGenerator, args) -> int:
+    now = datetime.utcnow()
+    batch = EmojiBatch()
+    events = 0
+    for _ in range(args.history):
+        message = generator.message()
+        at = now - timedelta(days=generator.rnd.random() * args.history_days)
+        source = EmojiSource.from_message(message)
+        for emoji_obj in get_emojis(message.content):
+            batch.add(source, emoji_obj, at)
+        if len(batch) >= 1000:
+            events += len(batch)
+            await backend.submit_bulk(batch)
+            batch = EmojiBatch()
+    if batch:
+        events += len(batch)
+        await backend.submit_bulk(batch)
+    return events
+
+
+async def _time_queries(backend, targets, **kwargs) -> dict:
+    durations = []
+    for (guild_id, user_id) in targets:
+        started_at = time.perf_counter()
+        await backend.get_emojis_top(guild_id, user_id=user_id, limit=10, **kwargs)
+        durations.append(time.perf_counter() - started_at)
+    durations.sort()
+    return {
+        'p50_ms': _percentile(durations, 50) * 1000,
+        'max_ms': durations[-1] * 1000,
+    }
+
+
+async def run_layout(args, layout: str, workdir: str) -> dict:
+    backend = _create_backend(args, workdir, layout)
+    await backend.motor_client.drop_database(backend._cfg.dbname)
+    await backend.init()
+
+    generator = EventGenerator(args, random.Random(args.seed))
+    started_at = time.perf_counter()
+    events = await _seed(backend, generator, args)
+    write_duration = time.perf_counter() - started_at
+
+    storage = {}
+    for collection in EVENT_COLLECTIONS:
+        storage[collection] = await _collection_size(backend._db, collection)
+    data_bytes = sum(stats['data_bytes'] for stats in storage.values())
+
+    guilds = [(guild_id, None) for guild_id in generator.guilds[:args.query_guilds]]
+    users = [(generator.guilds[0], user_id) for user_id in generator.users[:args.query_guilds]]
+    reads = {
+        'guild': await _time_queries(backend, guilds),
+        'guild_last_7_days': await _time_queries(backend, guilds, last_n_days=7),
+        'user': await _time_queries(backend, users),
+    }
+
+    await backend.close()
+    return {
+        'events': events,
+        'write_events_per_s': events / write_duration if write_duration else 0,
+        'storage': storage,
+        'data_bytes_per_event': data_bytes / events if events else 0,
+        'reads': reads,
+    }
+
+
+async def run(args) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for layout in args.layouts:
+            results[layout] = await run_layout(args, layout, workdir)
+            print(f'{layout:<8} {results[layout]["data_bytes_per_event"]:8.1f} B/event '
+                  f'{results[layout]["reads"]["guild"]["p50_ms"]:8.1f} ms guild top p50', file=sys.stderr)
+    return {
+        'benchmark': 'event_buckets',
+        'revision': _git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'parameters': {k: v for (k, v) in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Raw event layouts benchmark of the Motor backend')
+    parser.add_argument('--backend', choices=['motor', 'motor-mock'], default='motor')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--mongo-db', default='emoji_maniac_bench_events')
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=list(LAYOUTS))
+    parser.add_argument('--bucket-size', type=int, default=1000, help='entries per bucket document')
+    parser.add_argument('--history', type=int, default=50000, help='number of history messages')
+    parser.add_argument('--history-days', type=int, default=30)
+    parser.add_argument('--query-guilds', type=int, default=5, help='number of guilds and users queried')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args, rest = parser.parse_known_args(argv)
+    # Event distribution parameters are shared with the ingestion benchmark (--guilds, --emoji-density...)
+    for (key, value) in vars(parse_ingestion_args(rest)).items():
+        if not hasattr(args, key):
+            setattr(args, key, value)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,307 @@
+"""
+
+Replays a synthetic stream of gateway events (messages and reaction adds/removes) through the
+LogBackendMixin listeners against an emoji backend and reports events/s, handler latency and
+database operations per event.
+
+    python -m benchmarks.bench_ingestion --backend memory
+    python -m benchmarks.bench_ingestion --backend sqlite --events 50000
+    python -m benchmarks.bench_ingestion --backend motor --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.bench_ingestion --backend motor-mock  # requires mongomock-motor
+
+Results are written as JSON (--output) so runs of different versions can be compared.
+
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from datetime import datetime
+from types import SimpleNamespace
+
+import discord
+import emoji
+import yaml
+from pymongo import monitoring
+
+from emoji_maniac.bot.cogs.default.backend import LogBackendMixin
+from emoji_maniac.bot.config import Config, ReactionDebounceConfig
+from emoji_maniac.bot.debounce import ReactionDebouncer
+from emoji_maniac.log import get_logger
+from emoji_maniac.persistence.backends import get_backend_class
+from emoji_maniac.persistence.emoji_backend import EmojiBackend
+
+BOT_USER_ID = 1
+CHANNEL_ID = 400000000000000000
+
+
+class _BenchCog(LogBackendMixin):
+    def __init__(self, backend: EmojiBackend):
+        self.bot = SimpleNamespace(user=SimpleNamespace(id=BOT_USER_ID))
+        self.backend = backend
+        self.log = get_logger('IngestionBenchmark')
+        self.log.setLevel(logging.WARNING)
+        # The listeners log every message to it
+        get_logger('Messages').setLevel(logging.WARNING)
+
+
+class _OperationCounter(monitoring.CommandListener):
+    """
+    Counts database operations: MongoDB commands or SQLite statements
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *_):
+        self.count += 1
+
+    # pymongo.monitoring.CommandListener interface
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _zipf_weights(n: int, s: float) -> typing.List[float]:
+    return [1 / (i + 1) ** s for i in range(n)]
+
+
+class EventGenerator:
+    def __init__(self, args, rnd: random.Random):
+        self.args = args
+        self.rnd = rnd
+        self.guilds = [100000000000000000 + i for i in range(args.guilds)]
+        self.guild_weights = _zipf_weights(args.guilds, args.guild_skew)
+        self.users = [200000000000000000 + i for i in range(args.users)]
+        self.user_weights = _zipf_weights(args.users, args.user_skew)
+        table = list(emoji.UNICODE_EMOJI.keys())
+        self.emojis = rnd.sample(table, min(args.emojis, len(table)))
+        self.emoji_weights = _zipf_weights(len(self.emojis), args.emoji_skew)
+        self.words = ['hello', 'there', 'how', 'are', 'you', 'doing', 'today', 'lol', 'gg', 'nice', 'ok', 'sure']
+        self.next_message_id = 300000000000000000
+        self.recent_messages = []
+        self.recent_reactions = []
+
+    def _pick(self, values, weights):
+        return self.rnd.choices(values, weights)[0]
+
+    def message(self):
+        self.next_message_id += 1
+        guild_id = self._pick(self.guilds, self.guild_weights)
+        user_id = self._pick(self.users, self.user_weights)
+        parts = []
+        for _ in range(self.rnd.randint(3, 30)):
+            if self.rnd.random() < self.args.emoji_density:
+                parts.append(self._pick(self.emojis, self.emoji_weights))
+            else:
+                parts.append(self.rnd.choice(self.words))
+        author = SimpleNamespace(id=user_id, display_name=f'user{user_id}')
+        message = SimpleNamespace(id=self.next_message_id, content=' '.join(parts), author=author,
+                                  guild=SimpleNamespace(id=guild_id), channel=SimpleNamespace(id=CHANNEL_ID),
+                                  created_at=datetime.utcnow())
+        self.recent_messages.append((guild_id, message.id))
+        if len(self.recent_messages) > 1000:
+            self.recent_messages.pop(0)
+        return message
+
+    def reaction(self, event_type: str):
+        if self.recent_reactions and self.rnd.random() < self.args.reaction_toggles:
+            # The same user toggles a recent reaction
+            data, name, last_type = self.rnd.choice(self.recent_reactions)
+            event_type = 'REACTION_REMOVE' if last_type == 'REACTION_ADD' else 'REACTION_ADD'
+        else:
+            guild_id, message_id = self.rnd.choice(self.recent_messages)
+            data = {
+                'message_id': message_id,
+                'channel_id': CHANNEL_ID,
+                'user_id': self._pick(self.users, self.user_weights),
+                'guild_id': guild_id
+            }
+            name = self._pick(self.emojis, self.emoji_weights)
+        self.recent_reactions.append((data, name, event_type))
+        if len(self.recent_reactions) > 100:
+            self.recent_reactions.pop(0)
+        return discord.RawReactionActionEvent(data, discord.PartialEmoji(name=name), event_type)
+
+    def stream(self, count: int):
+        events = []
+        for _ in range(count):
+            roll = self.rnd.random()
+            if not self.recent_messages or roll >= self.args.reactions:
+                events.append(('message', self.message()))
+            elif roll < self.args.reactions * self.args.reaction_removes:
+                events.append(('reaction_remove', self.reaction('REACTION_REMOVE')))
+            else:
+                events.append(('reaction_add', self.reaction('REACTION_ADD')))
+        return events
+
+
+def _percentile(values: typing.List[float], p: float) -> float:
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _create_backend(args, workdir: str) -> typing.Tuple[EmojiBackend, _OperationCounter]:
+    counter = _OperationCounter()
+    backend_name = 'motor' if args.backend.startswith('motor') else args.backend
+    cfg = {
+        'token': 'benchmark',
+        'backend': backend_name,
+        'emoji_backends': {
+            'motor': {'uri': args.mongo_uri, 'dbname': args.mongo_db, 'write_behind': args.write_behind},
+            'sqlite': {'path': os.path.join(workdir, 'bench.sqlite3')},
+        }
+    }
+    cfg_file = os.path.join(workdir, 'bench_cfg.yaml')
+    with open(cfg_file, 'w') as f:
+        yaml.safe_dump(cfg, f)
+
+    if backend_name == 'motor':
+        monitoring.register(counter)
+        if args.backend == 'motor-mock':
+            import mongomock_motor
+            import motor.motor_asyncio
+            motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+    backend = get_backend_class(backend_name)(Config(cfg_file))
+    if backend_name == 'sqlite':
+        backend._conn.set_trace_callback(counter)
+    return backend, counter
+
+
+def _git_revision() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> dict:
+    rnd = random.Random(args.seed)
+    generator = EventGenerator(args, rnd)
+    warmup = generator.stream(args.warmup)
+    events = generator.stream(args.events)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        backend, counter = _create_backend(args, workdir)
+        await backend.init()
+        cog = _BenchCog(backend)
+        if args.reaction_debounce:
+            cog.reaction_debouncer = ReactionDebouncer(
+                backend, ReactionDebounceConfig(enabled=True, window=args.reaction_debounce))
+        handlers = {
+            'message': cog._on_message,
+            'reaction_add': cog._on_raw_reaction_add,
+            'reaction_remove': cog._on_raw_reaction_remove,
+        }
+
+        for (kind, event) in warmup:
+            await handlers[kind](event)
+
+        latencies = []
+        queue = asyncio.Queue()
+        for item in events:
+            queue.put_nowait(item)
+
+        async def worker():
+            while not queue.empty():
+                kind, event = queue.get_nowait()
+                started_at = time.perf_counter()
+                await handlers[kind](event)
+                latencies.append(time.perf_counter() - started_at)
+
+        operations_before = counter.count
+        started_at = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        handled_at = time.perf_counter()
+        # Buffered writes are part of the cost
+        if cog.reaction_debouncer is not None:
+            await cog.reaction_debouncer.close()
+        await backend.close()
+        finished_at = time.perf_counter()
+        operations = counter.count - operations_before
+
+    latencies.sort()
+    duration = finished_at - started_at
+    kinds = {}
+    for (kind, _) in events:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return {
+        'benchmark': 'ingestion',
+        'revision': _git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'parameters': {k: v for (k, v) in vars(args).items() if k != 'output'},
+        'results': {
+            'events': len(events),
+            'events_by_kind': kinds,
+            'duration_s': duration,
+            'drain_s': finished_at - handled_at,
+            'events_per_s': len(events) / duration if duration else 0,
+            'latency_ms': {
+                'p50': _percentile(latencies, 50) * 1000,
+                'p99': _percentile(latencies, 99) * 1000,
+                'max': (latencies[-1] if latencies else 0) * 1000,
+                'mean': (sum(latencies) / len(latencies) if latencies else 0) * 1000,
+            },
+            'db_operations': operations,
+            'db_operations_per_event': operations / len(events) if events else 0,
+        }
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Ingestion path benchmark')
+    parser.add_argument('--backend', choices=['memory', 'sqlite', 'motor', 'motor-mock'], default='memory')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--mongo-db', default='emoji_maniac_bench')
+    parser.add_argument('--write-behind', action='store_true', help='enable write-behind mode of the Motor backend')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=1, help='number of events handled at the same time')
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--guild-skew', type=float, default=1.0)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--user-skew', type=float, default=1.0)
+    parser.add_argument('--emojis', type=int, default=300, help='size of the emoji pool')
+    parser.add_argument('--emoji-skew', type=float, default=1.2)
+    parser.add_argument('--emoji-density', type=float, default=0.1, help='probability of a word being an emoji')
+    parser.add_argument('--reactions', type=float, default=0.3, help='share of reaction events')
+    parser.add_argument('--reaction-removes', type=float, default=0.2, help='share of removals among reactions')
+    parser.add_argument('--reaction-toggles', type=float, default=0.0,
+                        help='share of reactions that toggle one of the recent reactions')
+    parser.add_argument('--reaction-debounce', type=float, default=0.0, metavar='WINDOW',
+                        help='debounce reactions for WINDOW seconds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
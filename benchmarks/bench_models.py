@@ -0,0 +1,236 @@
+"""
+
+Compares memory and throughput of the representations of history records (an emoji from a message or
+a reaction with its time):
+
+- dataclass: plain dataclasses with a per-instance __dict__ as the models were before, a new emoji
+  object per record and documents encoded with dataclasses.asdict
+- slotted: the slotted, frozen models with interned emojis and documents encoded with EmojiEntry.document
+- columnar: EmojiBatch, parallel arrays of ids, counts and unix times
+
+    python -m benchmarks.bench_models
+    python -m benchmarks.bench_models --records 100000 --output models.json
+
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+import typing
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta
+
+import emoji
+
+from benchmarks.bench_ingestion import _git_revision
+from emoji_maniac.persistence.backends.motor import EmojiEntry
+from emoji_maniac.persistence.models import EmojiSource, MessageEmoji, EmojiBatch, utc_timestamp
+from emoji_maniac.persistence.utils import pack2b64
+
+# Documents are encoded in chunks of this size, the size of a submit_history batch
+ENCODE_CHUNK = 10000
+
+
+@dataclass
+class _PlainEmoji:
+    is_custom: bool
+    name: str
+    emoji_id: int = None
+    count: int = 1
+
+
+@dataclass
+class _PlainSource:
+    guild_id: int
+    message_id: int
+    user_id: int
+    reaction: bool = False
+
+
+@dataclass
+class _PlainEntry:
+    gld_id: int
+    msg_id: int
+    usr_id: int
+    src_uid: str
+    count: int
+    is_reaction: bool
+    emoji_uid: str
+    at: datetime = field(default_factory=datetime.utcnow)
+
+
+class RecordGenerator:
+    """
+    Generates the same records for every representation: (guild id, message id, user id, reaction,
+    is custom, emoji name, emoji id, count, time)
+    """
+
+    def __init__(self, args):
+        rnd = random.Random(args.seed)
+        self.rnd = rnd
+        names = [name[1:-1] for name in list(emoji.EMOJI_UNICODE.keys())[:args.unicode_emojis]]
+        self.emojis = [(False, name, None) for name in names] + \
+                      [(True, f'custom_{i}', 10 ** 17 + i) for i in range(args.custom_emojis)]
+        self.guilds = [rnd.getrandbits(60) for _ in range(args.guilds)]
+        self.users = [rnd.getrandbits(60) for _ in range(args.users)]
+        self.started_at = datetime(2026, 1, 1)
+        self.args = args
+
+    def records(self) -> typing.Iterator[tuple]:
+        rnd = random.Random(self.args.seed)
+        message_id = 10 ** 17
+        for index in range(self.args.records):
+            message_id += rnd.randrange(1, 1000)
+            (is_custom, name, emoji_id) = self.emojis[min(int(rnd.paretovariate(1.2)) - 1, len(self.emojis) - 1)]
+            count = 1 if rnd.random() < 0.9 else rnd.randrange(2, 6)
+            at = self.started_at + timedelta(seconds=index * 30)
+            yield (self.guilds[index % len(self.guilds)], message_id, rnd.choice(self.users), rnd.random() < 0.3,
+                   is_custom, name, emoji_id, count, at)
+
+
+def _build_dataclass(records) -> list:
+    return [(_PlainSource(guild_id, message_id, user_id, reaction), _PlainEmoji(is_custom, name, emoji_id, count), at)
+            for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id, count, at) in records]
+
+
+def _build_slotted(records) -> list:
+    return [(EmojiSource(guild_id, message_id, user_id, reaction),
+             MessageEmoji.custom(name, emoji_id, count) if is_custom else MessageEmoji.unicode(name, count), at)
+            for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id, count, at) in records]
+
+
+def _build_columnar(records) -> EmojiBatch:
+    batch = EmojiBatch()
+    for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id, count, at) in records:
+        emoji_obj = MessageEmoji.custom(name, emoji_id, count) if is_custom else MessageEmoji.unicode(name, count)
+        batch.append(guild_id, message_id, user_id, reaction, emoji_obj, count, utc_timestamp(at))
+    return batch
+
+
+def _plain_uid(emoji_obj: _PlainEmoji) -> str:
+    if emoji_obj.is_custom:
+        return 'c' + pack2b64('<Q', emoji_obj.emoji_id) + ':' + emoji_obj.name
+    return MessageEmoji.unicode(emoji_obj.name).uid
+
+
+def _encode_dataclass(records: list) -> int:
+    encoded = 0
+    for start in range(0, len(records), ENCODE_CHUNK):
+        documents = [
+            asdict(_PlainEntry(
+                gld_id=source.guild_id, msg_id=source.message_id, usr_id=source.user_id,
+                src_uid=pack2b64('<?QQQ', source.reaction, source.guild_id, source.user_id, source.message_id),
+                count=emoji_obj.count, is_reaction=source.reaction, emoji_uid=_plain_uid(emoji_obj), at=at
+            ))
+            for (source, emoji_obj, at) in records[start:start + ENCODE_CHUNK]
+        ]
+        encoded += len(documents)
+    return encoded
+
+
+def _encode_slotted(records: list) -> int:
+    encoded = 0
+    for start in range(0, len(records), ENCODE_CHUNK):
+        documents = [EmojiEntry.source_document(source, emoji_obj, at)
+                     for (source, emoji_obj, at) in records[start:start + ENCODE_CHUNK]]
+        encoded += len(documents)
+    return encoded
+
+
+def _encode_columnar(batch: EmojiBatch) -> int:
+    encoded = 0
+    documents = []
+    for (guild_id, message_id, user_id, reaction, emoji_obj, count, at) in batch.rows():
+        documents.append(EmojiEntry.document(guild_id, message_id, user_id, bool(reaction), emoji_obj.uid, count,
+                                             datetime.utcfromtimestamp(at)))
+        if len(documents) == ENCODE_CHUNK:
+            encoded += len(documents)
+            documents = []
+    return encoded + len(documents)
+
+
+VARIANTS = {
+    'dataclass': (_build_dataclass, _encode_dataclass),
+    'slotted': (_build_slotted, _encode_slotted),
+    'columnar': (_build_columnar, _encode_columnar),
+}
+
+
+def run_variant(name: str, generator: RecordGenerator) -> dict:
+    (build, encode) = VARIANTS[name]
+    # Records are generated while memory is traced, so ids and times count only if the representation keeps them
+    gc.collect()
+    tracemalloc.start()
+    built = build(generator.records())
+    gc.collect()
+    (memory, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    gc.collect()
+
+    # Throughput is measured on records generated up front
+    records = list(generator.records())
+    started_at = time.perf_counter()
+    built = build(records)
+    build_duration = time.perf_counter() - started_at
+    del records
+    gc.collect()
+
+    started_at = time.perf_counter()
+    encoded = encode(built)
+    encode_duration = time.perf_counter() - started_at
+    count = len(built)
+    return {
+        'records': count,
+        'build_records_per_s': count / build_duration if build_duration else 0,
+        'memory_mb': memory / 2 ** 20,
+        'bytes_per_record': memory / count if count else 0,
+        'encode_documents_per_s': encoded / encode_duration if encode_duration else 0,
+    }
+
+
+def run(args) -> dict:
+    generator = RecordGenerator(args)
+    results = {}
+    for name in args.variants:
+        results[name] = run_variant(name, generator)
+        print(f'{name:<10} {results[name]["bytes_per_record"]:8.1f} B/record '
+              f'{results[name]["build_records_per_s"]:12.0f} built/s '
+              f'{results[name]["encode_documents_per_s"]:12.0f} encoded/s', file=sys.stderr)
+    return {
+        'benchmark': 'models',
+        'revision': _git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'parameters': {k: v for (k, v) in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Memory and throughput of history record representations')
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--unicode-emojis', type=int, default=300)
+    parser.add_argument('--custom-emojis', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
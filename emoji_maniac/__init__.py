@@ -1,2 +1,9 @@
-from .bot import Bot
 from .log import set_debug
+
+
+def __getattr__(name):
+    # Bot pulls in discord.py, so it is imported when it is used and not with the package
+    if name == 'Bot':
+        from .bot import Bot
+        return Bot
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
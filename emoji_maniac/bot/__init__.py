@@ -1 +1,6 @@
-from .bot import Bot
+def __getattr__(name):
+    # Importing a submodule (e.g. emoji_maniac.bot.default) does not pull in discord.py this way
+    if name == 'Bot':
+        from .bot import Bot
+        return Bot
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,242 @@
+import asyncio
+import time
+import typing
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import discord
+
+from emoji_maniac.bot.config import BackfillConfig
+from emoji_maniac.bot.emoji import get_emojis
+from emoji_maniac.log import get_logger
+from emoji_maniac.persistence.emoji_backend import EmojiBackend
+from emoji_maniac.persistence.models import MessageEmoji, EmojiBatch, utc_timestamp
+
+HISTORY_PAGE_SIZE = 100
+
+
+@dataclass
+class BackfillProgress:
+    guild_id: int
+    channels_total: int = 0
+    channels_done: int = 0
+    messages: int = 0
+    emojis: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: typing.Optional[float] = None
+    error: typing.Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def messages_per_second(self) -> float:
+        elapsed = self.elapsed
+        if elapsed == 0:
+            return 0
+        return self.messages / elapsed
+
+
+class Backfill:
+    """
+
+    Backfill crawls the history of guild's text channels and stores emojis from the messages posted before
+    the bot joined. Channels are crawled concurrently by a bounded number of workers, discord.py takes care
+    of the rate limits and there is an additional delay between history pages.
+    The last stored message of every channel is saved as a checkpoint, so an interrupted backfill resumes
+    where it stopped. The last message of a batch is marked as pending before the batch is stored, if the bot
+    stopped before the checkpoint followed, messages of the batch whose emojis are stored are not stored again
+    when the backfill resumes. Messages posted after the backfill was started for the first time are ignored, they
+    are counted by the gateway listeners
+
+    """
+
+    CHECKPOINT_PREFIX = 'backfill-'
+
+    _tasks: typing.Dict[int, asyncio.Task]
+    _progress: typing.Dict[int, BackfillProgress]
+
+    def __init__(self, client: discord.Client, backend: EmojiBackend, cfg: BackfillConfig):
+        self._client = client
+        self._backend = backend
+        self._cfg = cfg
+        self._tasks = {}
+        self._progress = {}
+        self.log = get_logger(Backfill)
+
+    def is_running(self, guild_id: int) -> bool:
+        return guild_id in self._tasks
+
+    def progress(self, guild_id: int) -> typing.Optional[BackfillProgress]:
+        return self._progress.get(guild_id)
+
+    def start(self, guild: discord.Guild) -> BackfillProgress:
+        if guild.id in self._tasks:
+            return self._progress[guild.id]
+        progress = BackfillProgress(guild_id=guild.id)
+        self._progress[guild.id] = progress
+        self._tasks[guild.id] = asyncio.ensure_future(self._run(guild, progress))
+        return progress
+
+    async def stop_all(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, guild: discord.Guild, progress: BackfillProgress):
+        checkpoint_name = self.CHECKPOINT_PREFIX + str(guild.id)
+        reporter = None
+        try:
+            checkpoint = await self._backend.get_persistent_config(checkpoint_name, None) or {}
+            if checkpoint.get('completed_at') is not None:
+                self.log.info(f'Backfill of guild {guild.id} was completed at {checkpoint["completed_at"]}, skipped')
+                progress.channels_total = progress.channels_done = checkpoint.get('channels', 0)
+                return
+
+            before_id = checkpoint.get('before')
+            if before_id is None:
+                before_id = discord.utils.time_snowflake(datetime.utcnow())
+                await self._backend.update_persistent_config(checkpoint_name, {'before': before_id})
+
+            channels = [
+                channel for channel in guild.text_channels
+                if channel.permissions_for(guild.me).read_message_history
+            ]
+            progress.channels_total = len(channels)
+            self.log.info(f'Starting backfill of guild "{guild.name}" ({guild.id}), {len(channels)} channels')
+
+            queue = asyncio.Queue()
+            for channel in channels:
+                queue.put_nowait(channel)
+            reporter = asyncio.ensure_future(self._report(progress))
+            await asyncio.gather(*(
+                self._worker(queue, checkpoint_name, checkpoint, before_id, progress)
+                for _ in range(max(1, min(self._cfg.workers, len(channels))))
+            ))
+            await self._backend.update_persistent_config(checkpoint_name, {
+                'completed_at': datetime.utcnow(),
+                'channels': len(channels)
+            })
+        except asyncio.CancelledError:
+            progress.error = 'cancelled'
+            raise
+        except Exception as exc:
+            progress.error = str(exc)
+            self.log.error(f'Backfill of guild {guild.id} failed: {exc}')
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            progress.finished_at = time.monotonic()
+            self._tasks.pop(guild.id, None)
+            self.log.info(self._describe(progress))
+
+    async def _report(self, progress: BackfillProgress):
+        while True:
+            await asyncio.sleep(self._cfg.report_interval)
+            self.log.info(self._describe(progress))
+
+    @staticmethod
+    def _describe(progress: BackfillProgress) -> str:
+        state = 'finished' if progress.finished else 'running'
+        if progress.error:
+            state += f' with error: {progress.error}'
+        return f'Backfill of guild {progress.guild_id} {state}: ' \
+               f'{progress.channels_done}/{progress.channels_total} channels, {progress.messages} messages ' \
+               f'({progress.messages_per_second:.1f}/s), {progress.emojis} emojis in {round(progress.elapsed)}s'
+
+    async def _worker(self, queue: asyncio.Queue, checkpoint_name: str, checkpoint: dict, before_id: int,
+                      progress: BackfillProgress):
+        while True:
+            try:
+                channel = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            key = f'c{channel.id}'
+            try:
+                await self._crawl_channel(channel, checkpoint_name, key, checkpoint.get(key), before_id, progress,
+                                          checkpoint.get(key + '-pending'))
+            except discord.Forbidden:
+                self.log.warning(f'No access to the history of channel #{channel.name} ({channel.id})')
+            progress.channels_done += 1
+
+    async def _crawl_channel(self, channel: discord.TextChannel, checkpoint_name: str, key: str,
+                             after_id: typing.Optional[int], before_id: int, progress: BackfillProgress,
+                             pending_id: typing.Optional[int] = None):
+        batch = EmojiBatch()
+        last_id = None
+        fetched = 0
+        history = channel.history(
+            limit=None,
+            before=discord.Object(before_id),
+            after=discord.Object(after_id) if after_id is not None else None,
+            oldest_first=True
+        )
+        async for message in history:
+            if message.author != self._client.user:
+                await self._extract(message, batch)
+            last_id = message.id
+            fetched += 1
+            progress.messages += 1
+
+            if len(batch) >= self._cfg.batch_size or fetched % (HISTORY_PAGE_SIZE * 10) == 0:
+                await self._flush(batch, checkpoint_name, key, last_id, progress, pending_id)
+                batch = EmojiBatch()
+                if pending_id is not None and last_id >= pending_id:
+                    pending_id = None
+            if fetched % HISTORY_PAGE_SIZE == 0 and self._cfg.page_delay:
+                await asyncio.sleep(self._cfg.page_delay)
+
+        if last_id is not None:
+            await self._flush(batch, checkpoint_name, key, last_id, progress, pending_id)
+
+    async def _extract(self, message: discord.Message, batch: EmojiBatch):
+        at = utc_timestamp(message.created_at)
+        for emoji_obj in get_emojis(message.content):
+            batch.append(message.guild.id, message.id, message.author.id, False, emoji_obj, emoji_obj.count, at)
+        if self._cfg.fetch_reaction_users:
+            # Reaction time is unknown, reactions are counted in the period the message was posted in
+            for reaction in message.reactions:
+                emoji_obj = MessageEmoji.from_discord_emoji(reaction.emoji)
+                if emoji_obj is None:
+                    continue
+                async for user in reaction.users():
+                    if user == self._client.user:
+                        continue
+                    batch.append(message.guild.id, message.id, user.id, True, emoji_obj, emoji_obj.count, at)
+
+    async def _flush(self, batch: EmojiBatch, checkpoint_name: str, key: str, last_id: int, progress: BackfillProgress,
+                     pending_id: typing.Optional[int] = None):
+        if batch and pending_id is not None:
+            batch = await self._skip_stored(batch, pending_id)
+        # A pending mark past this batch stays until the crawl passes it
+        pending_id = pending_id if pending_id is not None and pending_id > last_id else None
+        if batch:
+            if pending_id is None:
+                await self._backend.update_persistent_config(checkpoint_name, {key + '-pending': last_id})
+            await self._backend.submit_history(batch)
+            progress.emojis += batch.total_count
+        await self._backend.update_persistent_config(checkpoint_name, {key: last_id, key + '-pending': pending_id})
+
+    async def _skip_stored(self, batch: EmojiBatch, pending_id: int) -> EmojiBatch:
+        """
+        Drops messages up to `pending_id` whose emojis were stored by the batch the previous run did not
+        checkpoint, reactions of those messages are dropped too
+        """
+        guild_id = batch.guild_ids[0]
+        stored = await self._backend.get_stored_messages(
+            guild_id, {message_id for message_id in batch.message_ids if message_id <= pending_id}
+        )
+        if not stored:
+            return batch
+        self.log.info(f'Skipping {len(stored)} messages of guild {guild_id} stored before the backfill stopped')
+        remaining = EmojiBatch()
+        for row in batch.rows():
+            if row[1] not in stored:
+                remaining.append(*row)
+        return remaining
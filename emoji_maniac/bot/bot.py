@@ -2,6 +2,7 @@ import abc
 import asyncio
 import inspect
 import re
+import time
 from datetime import datetime
 from functools import cached_property
 
@@ -10,13 +11,25 @@ import typing
 
 from discord.ext import commands
 
+from .backfill import Backfill
+from .debounce import ReactionDebouncer
+from .event_queue import EventQueue
+from .ingestion import IngestionStage
+from .message_cache import MessageCache
+from .retention import RetentionScheduler
 from .cogs.default import EmojiCog
 from .emoji import (get_emojis, MessageEmoji)
-from emoji_maniac.log import get_logger
+from emoji_maniac import startup
+from emoji_maniac.log import get_logger, is_debug, configure_logging
+from emoji_maniac.metrics import REGISTRY, MetricsServer
 from logging import Logger
 from .config import Config
+from ..persistence.backends import get_backend_class
 from ..persistence.emoji_backend import EmojiBackend, EmojiSource, BackendCog
 
+COMMAND_SECONDS = REGISTRY.histogram('emoji_maniac_command_seconds', 'Duration of commands', ('command',))
+COMMANDS = REGISTRY.counter('emoji_maniac_commands_total', 'Invoked commands', ('command', 'status'))
+
 
 class BotContext(commands.Cog):
     _bot: 'Bot'
@@ -73,18 +86,61 @@ class Bot(commands.Bot):
     config: Config
     backend: EmojiBackend
     log: Logger
+    backfill: Backfill
+    reaction_debouncer: typing.Optional[ReactionDebouncer] = None
+    event_queue: typing.Optional[EventQueue] = None
+    ingestion: typing.Optional[IngestionStage] = None
+    message_cache: typing.Optional[MessageCache] = None
+    metrics_server: typing.Optional[MetricsServer] = None
+    retention: typing.Optional[RetentionScheduler] = None
+    # Background maintenance (retention) runs in one process only
+    runs_maintenance: bool = True
+    # Added to the metrics port, so processes of one machine do not collide
+    metrics_port_offset: int = 0
     _ctx: BotContext
     _cmd_bot: commands.Bot
 
-    def __init__(self, backend: typing.Type[EmojiBackend], cfg_file='emoji_cfg.yaml', **kwargs):
+    def __init__(self, backend: typing.Optional[typing.Type[EmojiBackend]] = None, cfg_file='emoji_cfg.yaml',
+                 **kwargs):
+        startup.mark('bot modules imported')
         super(Bot, self).__init__(command_prefix=self._determine_prefix, **kwargs)
         self.log = get_logger()
         self.log.info('Initializing bot...')
-        self.config = Config(cfg_file)
-        self.backend = backend(self.config)
+        with startup.phase('config'):
+            self.config = Config(cfg_file)
+            configure_logging(self.config.logging_cfg)
+        with startup.phase('backend import'):
+            if backend is None:
+                backend = get_backend_class(self.config.backend)
+        with startup.phase('backend'):
+            self.backend = backend(self.config)
+        self.backfill = Backfill(self, self.backend, self.config.backfill_cfg)
+        if self.config.message_cache_cfg.enabled:
+            self.message_cache = MessageCache(self.config.message_cache_cfg.size)
+        if self.config.event_queue_cfg.enabled:
+            if self.backend.in_process:
+                raise ValueError(f'The {self.config.backend} backend keeps its data in process memory, '
+                                 f'event queue writers cannot share it')
+            if getattr(self.backend, 'leaderboard_stats', None) is not None:
+                raise ValueError('Leaderboards do not receive the writes of the event queue writers, '
+                                 'set emoji_backends.motor.leaderboards to false to use the event queue')
+            self.event_queue = EventQueue(cfg_file, self.config.event_queue_cfg, is_debug(), self.message_cache)
+            self.event_queue.start()
+            if self.config.ingestion_cfg.enabled:
+                self.log.warning('The ingestion stage is not used together with the event queue')
+        elif self.config.ingestion_cfg.enabled:
+            self.ingestion = IngestionStage(self.backend, self.config.ingestion_cfg, self.message_cache)
+        if self.config.reaction_debounce_cfg.enabled:
+            # Debounced reactions are forwarded to the event queue or the ingestion stage when there is one
+            self.reaction_debouncer = ReactionDebouncer(self.event_queue or self.ingestion or self.backend,
+                                                        self.config.reaction_debounce_cfg)
+        if self.config.retention_cfg.enabled:
+            self.retention = RetentionScheduler(self.backend, self.config.retention_cfg)
         self._ctx = BotContext(self)
 
-        self._init_cogs()
+        with startup.phase('cogs'):
+            self._init_cogs()
+        startup.mark('bot created')
 
     def _init_cogs(self):
         self.add_cog(self._ctx)
@@ -98,6 +154,35 @@ class Bot(commands.Bot):
         """
         super(Bot, self).run(self.config.token)
 
+    async def invoke(self, ctx: commands.Context):
+        if ctx.command is None:
+            return await super(Bot, self).invoke(ctx)
+        started_at = time.perf_counter()
+        try:
+            await super(Bot, self).invoke(ctx)
+        finally:
+            name = ctx.command.qualified_name
+            COMMAND_SECONDS.observe(time.perf_counter() - started_at, command=name)
+            COMMANDS.inc(command=name, status='error' if ctx.command_failed else 'ok')
+
+    async def close(self):
+        await super(Bot, self).close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.backfill.stop_all()
+        if self.retention is not None:
+            await self.retention.close()
+        if self.reaction_debouncer is not None:
+            await self.reaction_debouncer.close()
+        if self.ingestion is not None:
+            self.log.info('Writing pending emojis...')
+            await self.ingestion.close()
+        if self.event_queue is not None:
+            self.log.info('Waiting for event queue writers...')
+            await self.event_queue.close()
+        self.log.info(f'Closing {type(self.backend).__name__} backend...')
+        await self.backend.close()
+
     def _create_client(self, args: dict):
         args = args or {}
         c = commands.Bot(command_prefix=self._determine_prefix, **args)
@@ -110,11 +195,23 @@ class Bot(commands.Bot):
                 return prefix
         return (await self.backend.get_guild_prefix(message.guild.id)) or self.DEFAULT_PREFIX
 
+    async def on_connect(self):
+        startup.mark('gateway connected')
+
     async def on_ready(self):
+        startup.mark('ready')
         self.log.info(f'Bot is ready - {self.user.name}')
         self.log.info(f'Initializing {type(self.backend).__name__} backend...')
         await self.backend.init()
         self.log.info(f'Initializing {type(self.backend).__name__} backend COMPLETE')
+        if self.config.metrics_cfg.enabled and self.metrics_server is None:
+            cfg = self.config.metrics_cfg
+            self.metrics_server = MetricsServer(REGISTRY, cfg.host, cfg.port + self.metrics_port_offset)
+            await self.metrics_server.start()
+        if self.retention is not None and self.runs_maintenance:
+            self.retention.start()
+        startup.mark('backend initialized')
+        startup.report()
 
     async def on_guild_join(self, guild: discord.Guild):
         self.log.info(f'Bot joined guild "{guild.name}" ({guild.id})')
@@ -129,6 +226,8 @@ class Bot(commands.Bot):
             await self.backend.update_guild_config(guild.id, {
                 'active': True
             })
+        if self.config.backfill_cfg.on_guild_join:
+            self.backfill.start(guild)
 
     async def on_guild_remove(self, guild: discord.Guild):
         if await self.backend.has_guild_config(guild.id):
@@ -7,4 +7,9 @@ from ..cog_base import CogBase
 
 
 class EmojiCog(LogBackendMixin, EmojiCommandsMixin, CogBase):
-    pass
+    def __init__(self, bot):
+        super(EmojiCog, self).__init__(bot)
+        self.reaction_debouncer = bot.reaction_debouncer
+        self.event_queue = bot.event_queue
+        self.ingestion = bot.ingestion
+        self.message_cache = bot.message_cache
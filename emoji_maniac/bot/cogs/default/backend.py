@@ -1,47 +1,227 @@
 import logging
+import typing
+from datetime import datetime
 
 import discord
 from discord.ext import commands
 
 from emoji_maniac.bot.cogs.cog_base import CogBase
+from emoji_maniac.bot.debounce import ReactionDebouncer
 from emoji_maniac.bot.emoji import get_emojis
+from emoji_maniac.bot.event_queue import EventQueue
+from emoji_maniac.bot.ingestion import IngestionStage
+from emoji_maniac.bot.message_cache import MessageCache, CachedMessage
+from emoji_maniac.log import get_logger
+from emoji_maniac.metrics import REGISTRY
 from emoji_maniac.persistence.emoji_backend import EmojiBackend, BackendCog
-from emoji_maniac.persistence.models import MessageEmoji
+from emoji_maniac.persistence.models import MessageEmoji, EmojiSource, HistoryRecord, EventRemoval
+
+LISTENER_SECONDS = REGISTRY.histogram('emoji_maniac_listener_seconds', 'Duration of gateway event listeners',
+                                      ('listener',))
+EVENTS = REGISTRY.counter('emoji_maniac_events_total', 'Gateway events processed by the listeners', ('event',))
+EMOJIS_EXTRACTED = REGISTRY.counter('emoji_maniac_emojis_extracted_total', 'Emojis found in messages and reactions',
+                                    ('source',))
+UNTRACKED_MESSAGES = REGISTRY.counter('emoji_maniac_untracked_messages_total',
+                                     'Edited or deleted messages missing from the message cache', ('event',))
+# One record per message, sample or rate limit it with the "logging.loggers.Messages" configuration key
+MESSAGES_LOG = get_logger('Messages')
 
 
 class LogBackendMixin:
     bot: commands.Bot
     log: logging.Logger
     backend: EmojiBackend
+    # Reactions go straight to the backend when there is no debouncer
+    reaction_debouncer: typing.Optional[ReactionDebouncer] = None
+    # Emojis are written by the event queue writers instead of this process when there is a queue
+    event_queue: typing.Optional[EventQueue] = None
+    # Otherwise emojis are put to the bounded ingestion stage instead of awaiting the backend, if there is one
+    ingestion: typing.Optional[IngestionStage] = None
+    # Edits, deletes and cleared reactions are ignored without a message cache
+    message_cache: typing.Optional[MessageCache] = None
 
     @CogBase.listener('on_message')
     async def _on_message(self, message: discord.Message):
         if message.author == self.bot.user:
             return
 
-        await self._handle_incoming_message(message)
+        EVENTS.inc(event='message')
+        with LISTENER_SECONDS.time(listener='on_message'):
+            await self._handle_incoming_message(message)
 
     @CogBase.listener('on_raw_reaction_add')
     async def _on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        await self._submit_emojis_on_reaction(payload, False)
+        EVENTS.inc(event='raw_reaction_add')
+        with LISTENER_SECONDS.time(listener='on_raw_reaction_add'):
+            await self._submit_emojis_on_reaction(payload, False)
 
     @CogBase.listener('on_raw_reaction_remove')
     async def _on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        await self._submit_emojis_on_reaction(payload, True)
+        EVENTS.inc(event='raw_reaction_remove')
+        with LISTENER_SECONDS.time(listener='on_raw_reaction_remove'):
+            await self._submit_emojis_on_reaction(payload, True)
+
+    @CogBase.listener('on_raw_message_edit')
+    async def _on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        EVENTS.inc(event='raw_message_edit')
+        with LISTENER_SECONDS.time(listener='on_raw_message_edit'):
+            await self._correct_edited_message(payload)
+
+    @CogBase.listener('on_raw_message_delete')
+    async def _on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        EVENTS.inc(event='raw_message_delete')
+        with LISTENER_SECONDS.time(listener='on_raw_message_delete'):
+            await self._correct_deleted_messages(payload.guild_id, [payload.message_id])
+
+    @CogBase.listener('on_raw_bulk_message_delete')
+    async def _on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        EVENTS.inc(event='raw_bulk_message_delete')
+        with LISTENER_SECONDS.time(listener='on_raw_bulk_message_delete'):
+            await self._correct_deleted_messages(payload.guild_id, payload.message_ids)
+
+    @CogBase.listener('on_raw_reaction_clear')
+    async def _on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        EVENTS.inc(event='raw_reaction_clear')
+        with LISTENER_SECONDS.time(listener='on_raw_reaction_clear'):
+            await self._correct_cleared_reactions(payload.guild_id, payload.message_id)
+
+    @CogBase.listener('on_raw_reaction_clear_emoji')
+    async def _on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
+        EVENTS.inc(event='raw_reaction_clear_emoji')
+        with LISTENER_SECONDS.time(listener='on_raw_reaction_clear_emoji'):
+            emoji_obj = MessageEmoji.from_discord_emoji(payload.emoji)
+            if emoji_obj is not None:
+                await self._correct_cleared_reactions(payload.guild_id, payload.message_id, emoji_obj.uid)
 
     async def _handle_incoming_message(self, message: discord.Message, from_history: bool = False):
         await self._submit_emojis_on_message(message)
-        self.log.info(f'New message from {message.author.display_name}: {message.content}')
+        if not MESSAGES_LOG.isEnabledFor(logging.INFO):
+            return
+        # %-style arguments are only formatted for the records that pass the sampling filter
+        channel = getattr(message, 'channel', None)
+        MESSAGES_LOG.info('New message from %s: %s', message.author.display_name, message.content,
+                          extra={'guild_id': message.guild.id if message.guild else None,
+                                 'channel_id': channel.id if channel else None, 'message_id': message.id,
+                                 'author_id': message.author.id})
 
     async def _submit_emojis_on_message(self, message: discord.Message):
         emojis = get_emojis(message.content)
+        if self.message_cache is not None and message.guild is not None:
+            self.message_cache.add_message(message.id, message.guild.id, message.author.id, emojis)
         if len(emojis) == 0:
             return
-        await self.backend.submit_message(message, emojis)
+        EMOJIS_EXTRACTED.inc(sum(em.count for em in emojis), source='message')
+        if self.event_queue is not None:
+            self.event_queue.put(EmojiSource.from_message(message), emojis)
+        elif self.ingestion is not None:
+            await self.ingestion.put(EmojiSource.from_message(message), emojis)
+        else:
+            await self.backend.submit_message(message, emojis)
 
     async def _submit_emojis_on_reaction(self, reaction: discord.RawReactionActionEvent, removed: bool):
         emoji_obj = MessageEmoji.from_reaction(reaction)
+        if not removed:
+            EMOJIS_EXTRACTED.inc(source='reaction')
+        if self.message_cache is not None and reaction.guild_id is not None:
+            self.message_cache.add_reaction(reaction.message_id, reaction.guild_id, reaction.user_id, emoji_obj,
+                                            -1 if removed else 1)
+        if self.reaction_debouncer is not None:
+            self.reaction_debouncer.add(reaction.guild_id, reaction.message_id, reaction.user_id, emoji_obj,
+                                        -1 if removed else 1)
+            return
+        target = self.event_queue or self.ingestion or self.backend
         if removed:
-            await self.backend.remove_reaction(reaction.guild_id, reaction.message_id, reaction.user_id, emoji_obj)
+            await target.remove_reaction(reaction.guild_id, reaction.message_id, reaction.user_id, emoji_obj)
         else:
-            await self.backend.submit_reaction(reaction.guild_id, reaction.message_id, reaction.user_id, emoji_obj)
\ No newline at end of file
+            await target.submit_reaction(reaction.guild_id, reaction.message_id, reaction.user_id, emoji_obj)
+
+    async def _correct_edited_message(self, payload: discord.RawMessageUpdateEvent):
+        # Edits without content are embeds resolved by Discord
+        if self.message_cache is None or 'content' not in payload.data:
+            return
+        entry = self.message_cache.get(payload.message_id)
+        if entry is None or entry.emojis is None:
+            UNTRACKED_MESSAGES.inc(event='edit')
+            return
+        emojis = get_emojis(payload.data['content'] or '')
+        delta = self.message_cache.emoji_delta(entry.emojis, emojis)
+        entry.emojis = tuple(emojis)
+        if not delta:
+            return
+        # Counters of the period the message was posted in are corrected
+        source = EmojiSource(entry.guild_id, payload.message_id, entry.author_id)
+        at = discord.utils.snowflake_time(payload.message_id)
+        await self._submit_corrections([(source, emoji_obj, at) for emoji_obj in delta], [])
+
+    async def _correct_deleted_messages(self, guild_id: typing.Optional[int], message_ids: typing.Iterable[int]):
+        """
+        Subtracts emojis of the deleted messages and of their reactions from the counters in one batch and
+        removes their raw events
+        """
+        if self.message_cache is None or guild_id is None:
+            return
+        records = []
+        removed = []
+        for message_id in message_ids:
+            entry = self.message_cache.pop(message_id)
+            if entry is None:
+                UNTRACKED_MESSAGES.inc(event='delete')
+                continue
+            if entry.emojis:
+                source = EmojiSource(guild_id, message_id, entry.author_id)
+                at = discord.utils.snowflake_time(message_id)
+                records += [(source, emoji_obj.with_count(-emoji_obj.count), at) for emoji_obj in entry.emojis]
+                removed.append((source, None))
+            # Reactions are deleted together with the message
+            (reaction_records, reaction_removed) = self._take_reactions(guild_id, message_id, entry)
+            records += reaction_records
+            removed += reaction_removed
+        await self._submit_corrections(records, removed)
+
+    async def _correct_cleared_reactions(self, guild_id: typing.Optional[int], message_id: int,
+                                         emoji_uid: str = None):
+        if self.message_cache is None or guild_id is None:
+            return
+        entry = self.message_cache.get(message_id)
+        if entry is None:
+            UNTRACKED_MESSAGES.inc(event='reaction_clear')
+            return
+        await self._submit_corrections(*self._take_reactions(guild_id, message_id, entry, emoji_uid))
+
+    def _take_reactions(self, guild_id: int, message_id: int, entry: CachedMessage, emoji_uid: str = None) \
+            -> typing.Tuple[typing.List[HistoryRecord], typing.List[EventRemoval]]:
+        """
+        Removes reactions (of one emoji if `emoji_uid` is given) from the cached message and returns records
+        that subtract the written ones from the counters and their raw events to remove
+        """
+        reactions = entry.reactions or {}
+        # Reactions still held back by the debouncer were never written
+        pending = {}
+        if self.reaction_debouncer is not None:
+            pending = self.reaction_debouncer.discard_message(guild_id, message_id, emoji_uid)
+        now = datetime.utcnow()
+        records = []
+        removed = set()
+        for key in set(reactions) | set(pending):
+            (user_id, uid) = key
+            if emoji_uid is not None and uid != emoji_uid:
+                continue
+            (emoji_obj, count, at) = reactions.pop(key, (None, 0, None))
+            (pending_emoji, pending_delta) = pending.get(key, (None, 0))
+            emoji_obj = emoji_obj or pending_emoji
+            source = EmojiSource(guild_id, message_id, user_id, reaction=True)
+            written = count - pending_delta
+            if written:
+                records.append((source, emoji_obj.with_count(-written),
+                                datetime.utcfromtimestamp(at) if at is not None else now))
+            # Raw events of the other emojis the user reacted with stay when only one emoji is cleared
+            removed.add((source, None if emoji_uid is None else emoji_obj.with_count(1)))
+        if not reactions:
+            entry.reactions = None
+        return records, list(removed)
+
+    async def _submit_corrections(self, records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]):
+        # Queued like the writes, so raw events are not removed before they are stored
+        if records or removed:
+            target = self.event_queue or self.ingestion or self.backend
+            await target.submit_corrections(records, removed)
@@ -7,6 +7,7 @@ from discord.ext import commands
 
 from emoji_maniac.bot import ds_utils
 from emoji_maniac.bot.config import Config
+from emoji_maniac.metrics import REGISTRY, Histogram
 from emoji_maniac.persistence.emoji_backend import EmojiBackend
 
 
@@ -59,7 +60,14 @@ class EmojiCommandsMixin:
 
     async def _send_stats(self, ctx: commands.Context, period: PeriodConverter = TOTAL, member: discord.User = None):
         dt = time.time()
-        top10 = await self._get_top10(period, ctx.guild.id, member)
+        member_id = member.id if member is not None else None
+        cacheable = self.backend.stats_cacheable
+        top10 = await self.backend.get_stats_cache(ctx.guild.id, member_id, period) if cacheable else None
+        from_cache = top10 is not None
+        if not from_cache:
+            top10 = await self._get_top10(period, ctx.guild.id, member)
+            if cacheable:
+                await self.backend.put_stats_cache(ctx.guild.id, member_id, period, top10)
         lang = await self.backend.get_guild_lang(ctx.guild.id)
         if period == self.TOTAL:
             if member is None:
@@ -86,6 +94,7 @@ class EmojiCommandsMixin:
             title=title,
             description=msg,
             td=dt,
+            from_cache=from_cache,
             thumbnail=None if member is None else member.avatar_url
         )
         await ctx.send(embed=embed)
@@ -127,6 +136,42 @@ class EmojiCommandsMixin:
 
     #endregion
 
+    #region backfill command
+
+    @commands.command('backfill')
+    @commands.has_permissions(manage_guild=True)
+    async def _backfill(self, ctx: commands.Context, action: str = 'status'):
+        lang = await self.backend.get_guild_lang(ctx.guild.id)
+        if action.lower().strip() == 'start':
+            progress = self.bot.backfill.start(ctx.guild)
+        else:
+            progress = self.bot.backfill.progress(ctx.guild.id)
+
+        if progress is None:
+            description = self.__cfg.i18n.get(lang, 'backfill:not_started')
+        else:
+            if progress.error:
+                state = self.__cfg.i18n.get(lang, 'backfill:failed', progress.error)
+            elif progress.finished:
+                state = self.__cfg.i18n.get(lang, 'backfill:finished')
+            else:
+                state = self.__cfg.i18n.get(lang, 'backfill:running')
+            description = self.__cfg.i18n.get(lang, 'backfill:progress', {
+                'state': state,
+                'channels_done': progress.channels_done,
+                'channels_total': progress.channels_total,
+                'messages': progress.messages,
+                'rate': round(progress.messages_per_second, 1),
+                'emojis': progress.emojis
+            })
+        embed = ds_utils.create_embed(
+            title=self.__cfg.i18n.get(lang, 'backfill:title'),
+            description=description
+        )
+        await ctx.send(embed=embed)
+
+    #endregion
+
     #region ping command
 
     @commands.command('ping')
@@ -139,3 +184,57 @@ class EmojiCommandsMixin:
         await ctx.send(embed=embed)
 
     #endregion
+
+    #region perf command
+
+    @staticmethod
+    def _format_latencies(histogram: Histogram, label: str, limit: int = 10) -> typing.List[str]:
+        """
+        Formats calls, average and p99 latency of the histogram's series with the most time spent first
+        """
+        rows = []
+        for key in histogram.labels():
+            labels = dict(zip(histogram.label_names, key))
+            rows.append((histogram.total(**labels), labels[label], histogram.count(**labels),
+                         histogram.quantile(0.99, **labels)))
+        rows.sort(reverse=True)
+        return [f'`{name}` {count} calls, avg {total / count * 1000:.1f}ms, p99 < {p99 * 1000:g}ms'
+                for (total, name, count, p99) in rows[:limit]]
+
+    @commands.command('perf')
+    @commands.is_owner()
+    async def _perf(self, ctx: commands.Context):
+        lang = await self.backend.get_guild_lang(ctx.guild.id)
+        events = REGISTRY.get('emoji_maniac_events_total')
+        emojis = REGISTRY.get('emoji_maniac_emojis_extracted_total')
+        lines = [
+            'Events: ' + ', '.join(f'{key[0]} {value:g}' for (key, value) in sorted(events.values().items())),
+            'Emojis: ' + ', '.join(f'{key[0]} {value:g}' for (key, value) in sorted(emojis.values().items())),
+        ]
+        if self.bot.event_queue is not None:
+            lines.append(f'Event queue depth: {self.bot.event_queue.depth}')
+        if self.bot.reaction_debouncer is not None:
+            lines.append(f'Pending reactions: {len(self.bot.reaction_debouncer)}')
+        sections = (
+            ('Listeners', 'emoji_maniac_listener_seconds', 'listener'),
+            ('Backend', 'emoji_maniac_backend_seconds', 'method'),
+            ('Commands', 'emoji_maniac_command_seconds', 'command'),
+        )
+        for (title, name, label) in sections:
+            rows = self._format_latencies(REGISTRY.get(name), label)
+            if rows:
+                lines += ['', f'**{title}**'] + rows
+        command_stats = getattr(self.backend, 'command_stats', None)
+        if command_stats:
+            lines += ['', '**MongoDB**'] + [
+                f'`{operation}` {stats.count} commands, avg {stats.avg_ms:.1f}ms, max {stats.max_ms:.0f}ms, '
+                f'{stats.documents} documents, {stats.slow} slow'
+                for (operation, stats) in sorted(command_stats.items(), key=lambda item: -item[1].total_ms)
+            ]
+        embed = ds_utils.create_embed(
+            title=self.__cfg.i18n.get(lang, 'perf:title'),
+            description='\n'.join(lines)[:4096]
+        )
+        await ctx.send(embed=embed)
+
+    #endregion
@@ -1,9 +1,10 @@
 import glob
+from concurrent.futures import ThreadPoolExecutor, Future
 import os
 import random
 import typing
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from os import path
 
 from emoji_maniac.log import get_logger
@@ -18,9 +19,137 @@ except ImportError:
 @dataclass
 class CacheConfig:
     enabled: bool = True
+    guild_config_ttl: float = 300
+    guild_config_size: int = 1024
+    local_size: int = 1024
+    local_ttl: float = 60
+    stats_ttl: float = 60
+
+
+@dataclass
+class BackfillConfig:
+    on_guild_join: bool = False
+    workers: int = 4
+    batch_size: int = 500
+    page_delay: float = 0.5
+    fetch_reaction_users: bool = False
+    report_interval: float = 30
+
+
+@dataclass
+class ReactionDebounceConfig:
+    enabled: bool = False
+    window: float = 2.0
+    max_pending: int = 10000
+
+
+@dataclass
+class MessageCacheConfig:
+    # Emojis of recent messages and their reactions are kept to correct counters when messages are edited
+    # or deleted and reactions are cleared
+    enabled: bool = True
+    size: int = 10000
+
+
+@dataclass
+class EventQueueConfig:
+    enabled: bool = False
+    # Writer processes draining the queue into the backend, every guild is written by one of them
+    writers: int = 1
+    batch_size: int = 500
+    # How long a writer waits for a batch to fill up, seconds
+    batch_interval: float = 0.5
+    # The bot process sends records in chunks of up to chunk_size, at least every flush_interval seconds
+    chunk_size: int = 100
+    flush_interval: float = 0.05
+    # Maximum number of chunks queued, split between the writers. While the queue of a writer is full the bot
+    # process holds back as many records as fit the queue and drops the ones beyond that
+    max_chunks: int = 10000
+    retries: int = 3
+    report_interval: float = 60
+
+
+@dataclass
+class IngestionConfig:
+    # Write emojis through a bounded in-process queue instead of awaiting the backend in the listeners,
+    # not used together with the event queue
+    enabled: bool = False
+    # Records waiting to be written, the overflow policy applies once there are more
+    max_pending: int = 10000
+    # block: listeners wait up to block_timeout seconds for room (at most max_blocked of them), then drop
+    # drop_oldest: the oldest pending records are dropped
+    # counters_only: new records are summed into counter deltas and written without raw events
+    overflow: str = 'block'
+    block_timeout: float = 5.0
+    max_blocked: int = 1000
+    # Concurrent batch writes
+    workers: int = 2
+    batch_size: int = 500
+    # Writes taking longer than this fail and their records are dropped, seconds
+    write_timeout: float = 30
+    # Records are shed as on overflow while the event loop lags more than this, keeping the gateway heartbeat
+    # on time, seconds
+    max_loop_lag: float = 1.0
+    report_interval: float = 60
+
+
+@dataclass
+class MetricsConfig:
+    # Serve metrics in the Prometheus text format at http://host:port/metrics
+    enabled: bool = False
+    host: str = '127.0.0.1'
+    # Shard processes listen on port + process index
+    port: int = 9108
+
+
+@dataclass
+class ShardingConfig:
+    # None asks Discord for the recommended number of shards
+    shard_count: typing.Optional[int] = None
+    processes: int = 1
+    # Shards identify one at a time, processes are started this many seconds per shard apart
+    identify_interval: float = 5.0
+    restart_delay: float = 5.0
+    max_restart_delay: float = 300
+    # A process that ran this long before it crashed is restarted without backoff
+    stable_after: float = 600
+    report_interval: float = 60
+    # JSON file the supervisor writes per-shard event rates to
+    stats_file: typing.Optional[str] = None
+
+
+@dataclass
+class LoggingConfig:
+    # Write to the console from a background thread, records are dropped while queue_size records are waiting
+    async_handlers: bool = False
+    queue_size: int = 10000
+    # text or json (one JSON object per line)
+    format: str = 'text'
+    # Logger name -> {sample_rate, rate_limit, burst}, warnings and errors are never dropped
+    loggers: typing.Dict[str, dict] = field(default_factory=dict)
+
+
+@dataclass
+class RetentionConfig:
+    enabled: bool = False
+    # Seconds between runs, the first run starts first_run_delay seconds after the bot is ready
+    interval: float = 3600
+    first_run_delay: float = 300
+    # Documents are removed in batches of batch_size with batch_delay seconds between batches
+    batch_size: int = 1000
+    batch_delay: float = 0.1
+    # Counters of days, weeks and months older than this many days are folded into coarser counters,
+    # None keeps them forever. Daily counters are kept for at least 31 days
+    day_counters_days: typing.Optional[int] = 90
+    week_counters_days: typing.Optional[int] = 180
+    month_counters_days: typing.Optional[int] = None
+    # Raw emoji events older than this many days are removed, or moved to <collection>_archive
+    raw_events_days: typing.Optional[int] = None
+    archive_raw_events: bool = False
 
 
 DEFAULT_STORAGE_DIR = 'storage'
+DEFAULT_BACKEND = 'motor'
 
 
 class I18NConfig:
@@ -30,7 +159,21 @@ class I18NConfig:
         self.config = config
         self.fallback_language = 'en'
         self.log = get_logger(I18NConfig)
-        self.translations = {}
+        self._translations = {}
+        self._loading: typing.Optional[typing.List[typing.Tuple[str, Future]]] = None
+
+    @property
+    def translations(self) -> typing.Dict[str, dict]:
+        if self._loading is not None:
+            loading = self._loading
+            self._loading = None
+            translations = {}
+            for (language, future) in loading:
+                translation = future.result()
+                if translation is not None:
+                    translations[language] = translation
+            self._translations = translations
+        return self._translations
 
     def get_available_translations(self):
         return list(self.translations.keys())
@@ -56,6 +199,9 @@ class I18NConfig:
         return self.translations.get(lang, {}).get(key) or self.translations.get(self.fallback_language, {}).get(key)
 
     def refresh_translations(self):
+        """
+        Starts loading translation files concurrently in the background, the first lookup waits for them
+        """
         directory = self.config.get_storage_dir('i18n')
         if path.isdir(directory):
             files = os.listdir(directory)
@@ -63,34 +209,49 @@ class I18NConfig:
         else:
             files = []
         self.log.info('Refreshing list of translations')
-        translations = {}
+        if not files:
+            self._loading = None
+            self._translations = {}
+            return
+        pool = ThreadPoolExecutor(max_workers=min(len(files), 4), thread_name_prefix='i18n')
+        self._loading = [(file[:-len(self.LANG_FILE_EXT)], pool.submit(self._load_file, directory, file))
+                         for file in files]
+        pool.shutdown(wait=False)
 
-        for file in files:
-            language = file[:-len(self.LANG_FILE_EXT)]
-            fullpath = path.join(directory, file)
-            data = Loader(open(fullpath, encoding='utf-8')).get_data()
-            if not isinstance(data, dict):
-                self.log.warning(f'Invalid log file {file} contains valid yaml but '
-                                 f'instead of dictionary contains: {type(data)}, file ignored')
-                continue
-            translation = {}
-            for (k, v) in data.items():
-                if isinstance(v, str) or isinstance(v, list) and all(isinstance(i, str) for i in v):
-                    translation[k] = v
-                else:
-                    self.log.warning('Translation key "{k}" from file "{file}" is neither a string or a list of '
-                                     'strings, key ignored')
-            translations[language] = translation
-        self.translations = translations
+    def _load_file(self, directory: str, file: str) -> typing.Optional[dict]:
+        with open(path.join(directory, file), encoding='utf-8') as f:
+            data = Loader(f).get_data()
+        if not isinstance(data, dict):
+            self.log.warning(f'Invalid log file {file} contains valid yaml but '
+                             f'instead of dictionary contains: {type(data)}, file ignored')
+            return None
+        translation = {}
+        for (k, v) in data.items():
+            if isinstance(v, str) or isinstance(v, list) and all(isinstance(i, str) for i in v):
+                translation[k] = v
+            else:
+                self.log.warning(f'Translation key "{k}" from file "{file}" is neither a string or a list of '
+                                 'strings, key ignored')
+        return translation
 
 
 class Config(commands.Cog):
     token: str = None
     storage_dir: str = DEFAULT_STORAGE_DIR
+    backend: str = DEFAULT_BACKEND
     _filename: str
     _data: dict
     log: logging.Logger
     cache_cfg: CacheConfig = CacheConfig()
+    backfill_cfg: BackfillConfig = BackfillConfig()
+    reaction_debounce_cfg: ReactionDebounceConfig = ReactionDebounceConfig()
+    message_cache_cfg: MessageCacheConfig = MessageCacheConfig()
+    event_queue_cfg: EventQueueConfig = EventQueueConfig()
+    ingestion_cfg: IngestionConfig = IngestionConfig()
+    metrics_cfg: MetricsConfig = MetricsConfig()
+    sharding_cfg: ShardingConfig = ShardingConfig()
+    logging_cfg: LoggingConfig = LoggingConfig()
+    retention_cfg: RetentionConfig = RetentionConfig()
     _i18n: I18NConfig
 
     def __init__(self, filename: str):
@@ -102,10 +263,11 @@ class Config(commands.Cog):
     def refresh(self):
         d = self._get_data()
         if d is None:
-            print('Failed to refresh storage')
+            self.log.error(f'Failed to refresh configuration from {self._filename}')
             return
         self.token = d.get('token')
         self.storage_dir = d.get('storage') or DEFAULT_STORAGE_DIR
+        self.backend = d.get('backend') or DEFAULT_BACKEND
         self._data = d
 
         try:
@@ -113,6 +275,51 @@ class Config(commands.Cog):
         except:
             pass
 
+        try:
+            self.backfill_cfg = BackfillConfig(**d['backfill'])
+        except:
+            pass
+
+        try:
+            self.reaction_debounce_cfg = ReactionDebounceConfig(**d['reaction_debounce'])
+        except:
+            pass
+
+        try:
+            self.message_cache_cfg = MessageCacheConfig(**d['message_cache'])
+        except:
+            pass
+
+        try:
+            self.event_queue_cfg = EventQueueConfig(**d['event_queue'])
+        except:
+            pass
+
+        try:
+            self.ingestion_cfg = IngestionConfig(**d['ingestion'])
+        except:
+            pass
+
+        try:
+            self.metrics_cfg = MetricsConfig(**d['metrics'])
+        except:
+            pass
+
+        try:
+            self.sharding_cfg = ShardingConfig(**d['sharding'])
+        except:
+            pass
+
+        try:
+            self.logging_cfg = LoggingConfig(**d['logging'])
+        except:
+            pass
+
+        try:
+            self.retention_cfg = RetentionConfig(**d['retention'])
+        except:
+            pass
+
         self._i18n.refresh_translations()
 
     @property
@@ -146,14 +353,12 @@ class Config(commands.Cog):
     
     def _get_data(self) -> dict or type(None):
         try:
-            f = self._open_file()
-            loader = Loader(f)
-            data = loader.get_data()
-            print(data)
+            with self._open_file() as f:
+                data = Loader(f).get_data()
             if not isinstance(data, dict):
                 return None
 
             return data
         except Exception as exc:
-            print(str(exc))
+            self.log.error(f'Failed to read {self._filename}: {exc}')
 
@@ -0,0 +1,150 @@
+import asyncio
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from emoji_maniac.bot.config import ReactionDebounceConfig
+from emoji_maniac.bot.event_queue import EventQueue
+from emoji_maniac.bot.ingestion import IngestionStage
+from emoji_maniac.log import get_logger
+from emoji_maniac.persistence.emoji_backend import EmojiBackend
+from emoji_maniac.persistence.models import MessageEmoji
+
+# (guild id, message id, user id, emoji uid)
+ReactionKey = typing.Tuple[int, int, int, str]
+
+
+@dataclass
+class DebounceStats:
+    received: int = 0
+    forwarded: int = 0
+    cancelled: int = 0
+    # Keys forwarded before their window ended because there were too many pending keys
+    forced: int = 0
+    failures: int = 0
+
+
+class _PendingReaction:
+    __slots__ = ('deadline', 'emoji', 'delta', 'events')
+
+    def __init__(self, deadline: float, emoji_obj: MessageEmoji):
+        self.deadline = deadline
+        self.emoji = emoji_obj
+        self.delta = 0
+        self.events = 0
+
+
+class ReactionDebouncer:
+    """
+
+    ReactionDebouncer holds reaction adds and removals back for a short window and sums them up per
+    (guild, message, user, emoji). When the window of the first event ends only the net delta is forwarded
+    to the backend, so a reaction toggled on and off costs nothing and a toggle storm costs one write.
+    Once there are more than `max_pending` keys, the oldest ones are forwarded right away
+
+    """
+
+    _pending: 'OrderedDict[ReactionKey, _PendingReaction]'
+
+    def __init__(self, backend: typing.Union[EmojiBackend, EventQueue, IngestionStage], cfg: ReactionDebounceConfig):
+        self._backend = backend
+        self._cfg = cfg
+        self._pending = OrderedDict()
+        self._loop_task: typing.Optional[asyncio.Task] = None
+        self._forward_tasks: typing.Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self.stats = DebounceStats()
+        self.log = get_logger(ReactionDebouncer)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, guild_id: int, message_id: int, user_id: int, emoji_obj: MessageEmoji, delta: int):
+        self.stats.received += 1
+        key = (guild_id, message_id, user_id, emoji_obj.uid)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = _PendingReaction(time.monotonic() + self._cfg.window, emoji_obj)
+            self._pending[key] = entry
+            if len(self._pending) == 1:
+                self._wakeup.set()
+        entry.delta += delta
+        entry.events += 1
+
+        if len(self._pending) > self._cfg.max_pending:
+            overflow = [self._pending.popitem(last=False) for _ in range(len(self._pending) - self._cfg.max_pending)]
+            self.stats.forced += len(overflow)
+            self._start_forward(overflow)
+
+        if self._loop_task is None:
+            self._loop_task = asyncio.ensure_future(self._run())
+
+    def discard_message(self, guild_id: int, message_id: int, emoji_uid: str = None) \
+            -> typing.Dict[typing.Tuple[int, str], typing.Tuple[MessageEmoji, int]]:
+        """
+        Drops pending reactions of the message (of one emoji if `emoji_uid` is given), e.g. when its reactions
+        were cleared, and returns their emojis and net deltas by (user id, emoji uid)
+        """
+        keys = [key for key in self._pending
+                if key[0] == guild_id and key[1] == message_id and (emoji_uid is None or key[3] == emoji_uid)]
+        deltas = {}
+        for key in keys:
+            entry = self._pending.pop(key)
+            self.stats.cancelled += entry.events
+            deltas[(key[2], key[3])] = (entry.emoji, entry.delta)
+        return deltas
+
+    async def close(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        pending = list(self._pending.items())
+        self._pending.clear()
+        await asyncio.gather(self._forward(pending), *self._forward_tasks)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Keys are ordered by their first event, so the first one has the earliest deadline
+            delay = next(iter(self._pending.values())).deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            due = []
+            while self._pending and next(iter(self._pending.values())).deadline <= now:
+                due.append(self._pending.popitem(last=False))
+            # Cancelling the loop must not cancel a forward of entries already taken from _pending,
+            # close waits for it with the other forward tasks
+            await asyncio.shield(self._start_forward(due))
+
+    def _start_forward(self, entries: typing.List[typing.Tuple[ReactionKey, _PendingReaction]]) -> asyncio.Task:
+        task = asyncio.ensure_future(self._forward(entries))
+        self._forward_tasks.add(task)
+        task.add_done_callback(self._forward_tasks.discard)
+        return task
+
+    async def _forward(self, entries: typing.List[typing.Tuple[ReactionKey, _PendingReaction]]):
+        calls = []
+        for ((guild_id, message_id, user_id, _), entry) in entries:
+            if entry.delta == 0:
+                self.stats.cancelled += entry.events
+                continue
+            self.stats.cancelled += entry.events - abs(entry.delta)
+            self.stats.forwarded += abs(entry.delta)
+            submit = self._backend.submit_reaction if entry.delta > 0 else self._backend.remove_reaction
+            calls += [submit(guild_id, message_id, user_id, entry.emoji) for _ in range(abs(entry.delta))]
+        if not calls:
+            return
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            self.stats.failures += len(failures)
+            self.log.error(f'Failed to submit {len(failures)} of {len(calls)} reactions: {failures[0]}')
@@ -1,15 +1,28 @@
 import typing
 
-from emoji_maniac import Bot, set_debug
-from emoji_maniac.persistence.emoji_backend import EmojiBackend
+from emoji_maniac.log import set_debug
 
+if typing.TYPE_CHECKING:
+    from emoji_maniac.persistence.emoji_backend import EmojiBackend
 
-def create_bot(backend: typing.Type[EmojiBackend]):
+
+def create_bot(backend: typing.Optional[typing.Type['EmojiBackend']] = None):
+    from emoji_maniac.bot.bot import Bot
     return Bot(backend)
 
 
 def run_default(debug: bool = False):
     if debug:
         set_debug(True)
-    from emoji_maniac.persistence.backends.motor import MotorEmojiBackend
-    create_bot(MotorEmojiBackend).run()
+    # Backend is taken from the "backend" configuration key
+    create_bot().run()
+
+
+def run_sharded(debug: bool = False, cfg_file: str = 'emoji_cfg.yaml'):
+    """
+    Runs shards in one or more processes as configured by the "sharding" configuration key
+    """
+    from emoji_maniac.bot.sharding import ShardSupervisor
+    if debug:
+        set_debug(True)
+    ShardSupervisor(cfg_file, debug).run()
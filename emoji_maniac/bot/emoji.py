@@ -1,41 +1,109 @@
 import discord
-import emoji
 import re
 import typing
 
 from emoji_maniac.persistence.emoji_backend import MessageEmoji
 
-regex = re.compile(r'<:(\w+):(\d+)>')
+regex = re.compile(r'<a?:(\w+):(\d+)>')
 
 
-def get_emojis(text: str) -> typing.List[MessageEmoji]:
-    emoji_unicode = [c for c in text if c in emoji.UNICODE_EMOJI]
-    emoji_count = {}
-
-    for em in emoji_unicode:
-        c = emoji_count.get(em)
-        if c is not None:
-            emoji_count[em] = emoji_count[em] + 1
-        else:
-            emoji_count[em] = 1
-
-    emojis_list = [
-        MessageEmoji.unicode(emoji.UNICODE_EMOJI[c][1:-1], emoji_count[c])
-        for c in emoji_count.keys() if c in emoji.UNICODE_EMOJI]
-    match = regex.findall(text)
-    if match:
-        custom_emojis_count = {}
-        for g in match:
-            name = g[0]
-            emoji_id = int(g[1])
-            key = (emoji_id, name)
-            c = custom_emojis_count.get(key)
-            if c is None:
-                custom_emojis_count[key] = 1
+class EmojiScanner:
+    """
+
+    EmojiScanner finds unicode emojis (including multi-codepoint sequences such as ZWJ families, skin tones,
+    keycaps and flags) and custom emojis in a single pass over the text.
+    Emoji-like sequences are tokenized by one precompiled regular expression, so plain text is skipped by the
+    regex engine, and then looked up in the emoji table. Sequences that are not in the table are split into
+    the longest known emojis with a prefix trie
+
+    """
+
+    _TERMINAL = ''
+    _MODIFIERS = '[\ufe0f\U0001f3fb-\U0001f3ff\U000e0020-\U000e007f]*'
+    _ZWJ = '\u200d'
+    _REGIONAL_INDICATOR = '[\U0001f1e6-\U0001f1ff]'
+    _KEYCAP_BASE = '[#*0-9]'
+
+    def __init__(self, table: typing.Dict[str, str]):
+        self._names = {sequence: name[1:-1] for (sequence, name) in table.items()}
+        self._trie = {}
+        for (sequence, name) in self._names.items():
+            node = self._trie
+            for char in sequence:
+                node = node.setdefault(char, {})
+            node[self._TERMINAL] = name
+
+        # A character class containing astral code points is matched by a linear scan over its items,
+        # so only BMP first code points are listed exactly and astral ones are covered by a single range.
+        # Every alternative starts with the same character class, so the regex engine can use it to skip
+        # to the next candidate, the alternatives check what came before with lookbehinds
+        first_chars = sorted(self._trie.keys())
+        bmp_chars = ''.join(c for c in first_chars if not c.isascii() and ord(c) <= 0xffff)
+        astral_chars = [c for c in first_chars if ord(c) > 0xffff]
+        emoji_chars = re.escape(bmp_chars) + (f'{astral_chars[0]}-\U0010ffff' if astral_chars else '')
+        emoji_class = f'[{emoji_chars}]'
+        self._tokens = re.compile(
+            f'([<{emoji_chars}#*0-9](?:'
+            r'(?<=<)a?:(\w+):(\d+)>'
+            f'|(?<={self._KEYCAP_BASE})\ufe0f?\u20e3'
+            f'|(?<={self._REGIONAL_INDICATOR}){self._REGIONAL_INDICATOR}'
+            f'|(?<={emoji_class}){self._MODIFIERS}(?:{self._ZWJ}{emoji_class}{self._MODIFIERS})*'
+            '))'
+        )
+
+    def scan(self, text: str) -> typing.List[MessageEmoji]:
+        counts = {}
+        names = self._names
+        for (sequence, custom_name, custom_id) in self._tokens.findall(text):
+            name = names.get(sequence)
+            if name is not None:
+                counts[name] = counts.get(name, 0) + 1
+            elif custom_id:
+                key = (custom_name, int(custom_id))
+                counts[key] = counts.get(key, 0) + 1
             else:
-                custom_emojis_count[key] = custom_emojis_count[key] + 1
+                self._split_sequence(sequence, counts)
 
-        for (emoji_id, name), count in custom_emojis_count.items():
-            emojis_list.append(MessageEmoji.custom(name, emoji_id, count))
-    return emojis_list
+        return [
+            MessageEmoji.custom(key[0], key[1], count) if isinstance(key, tuple) else MessageEmoji.unicode(key, count)
+            for (key, count) in counts.items()
+        ]
 
+    def _split_sequence(self, sequence: str, counts: dict):
+        position = 0
+        end = len(sequence)
+        while position < end:
+            # Longest match in the trie starting at the current position
+            node = self._trie
+            name = None
+            match_end = index = position
+            while index < end:
+                node = node.get(sequence[index])
+                if node is None:
+                    break
+                index += 1
+                terminal = node.get(self._TERMINAL)
+                if terminal is not None:
+                    name = terminal
+                    match_end = index
+            if name is None:
+                position += 1
+            else:
+                counts[name] = counts.get(name, 0) + 1
+                position = match_end
+
+
+_scanner: typing.Optional[EmojiScanner] = None
+
+
+def get_scanner() -> EmojiScanner:
+    global _scanner
+    if _scanner is None:
+        # The emoji package builds its tables on import, so it is loaded with the first scan
+        import emoji
+        _scanner = EmojiScanner(emoji.UNICODE_EMOJI)
+    return _scanner
+
+
+def get_emojis(text: str) -> typing.List[MessageEmoji]:
+    return get_scanner().scan(text)
@@ -0,0 +1,427 @@
+import asyncio
+import multiprocessing
+import queue
+import signal
+import time
+import typing
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+
+from emoji_maniac.bot.config import Config, EventQueueConfig
+from emoji_maniac.bot.message_cache import MessageCache
+from emoji_maniac.log import get_logger, set_debug, configure_logging
+from emoji_maniac.metrics import REGISTRY
+from emoji_maniac.persistence.backends import get_backend_class
+from emoji_maniac.persistence.emoji_backend import EmojiBackend, PartialWriteError
+from emoji_maniac.persistence.models import EmojiSource, MessageEmoji, Emoji, EmojiBatch, HistoryRecord, \
+    EventRemoval, get_emoji_registry, utc_timestamp
+
+# (guild id, message id, user id, reaction, is custom, emoji name, emoji id, count, unix time of the event)
+EventRecord = typing.Tuple[int, int, int, bool, bool, str, typing.Optional[int], int, float]
+# (guild id, message id, user id, reaction, is custom, emoji name, emoji id), emoji fields are None to remove
+# all raw events of the source
+RemovalRecord = typing.Tuple[int, int, int, bool, typing.Optional[bool], typing.Optional[str], typing.Optional[int]]
+# (counter deltas, removed raw events)
+CorrectionRecord = typing.Tuple[typing.List[EventRecord], typing.List[RemovalRecord]]
+# Chunks of records are lists, corrections are tuples
+QueueItem = typing.Union[typing.List[EventRecord], CorrectionRecord]
+
+EVENT_QUEUE_DROPPED = REGISTRY.counter('emoji_maniac_event_queue_dropped_total',
+                                       'Records and corrections dropped while a writer queue was full')
+
+
+def encode_record(source: EmojiSource, emoji_obj: MessageEmoji, at: float) -> EventRecord:
+    return (source.guild_id, source.message_id, source.user_id, source.reaction,
+            emoji_obj.is_custom, emoji_obj.name, emoji_obj.emoji_id, emoji_obj.count, at)
+
+
+def encode_correction(records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]) -> CorrectionRecord:
+    return ([encode_record(source, emoji_obj, utc_timestamp(at)) for (source, emoji_obj, at) in records],
+            [(source.guild_id, source.message_id, source.user_id, source.reaction) +
+             ((None, None, None) if emoji_obj is None else (emoji_obj.is_custom, emoji_obj.name, emoji_obj.emoji_id))
+             for (source, emoji_obj) in removed])
+
+
+def decode_correction(correction: CorrectionRecord) \
+        -> typing.Tuple[typing.List[HistoryRecord], typing.List[EventRemoval]]:
+    registry = get_emoji_registry()
+    records = [(EmojiSource(guild_id, message_id, user_id, reaction),
+                registry.counted(is_custom, name, emoji_id, count), datetime.utcfromtimestamp(at))
+               for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id, count, at) in correction[0]]
+    removed = [(EmojiSource(guild_id, message_id, user_id, reaction),
+                None if name is None else registry.counted(is_custom, name, emoji_id, 1))
+               for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id) in correction[1]]
+    return records, removed
+
+
+def item_size(item: QueueItem) -> int:
+    return len(item) if isinstance(item, list) else len(item[0]) + len(item[1])
+
+
+def decode_batch(records: typing.List[EventRecord]) -> EmojiBatch:
+    registry = get_emoji_registry()
+    batch = EmojiBatch()
+    for (guild_id, message_id, user_id, reaction, is_custom, name, emoji_id, count, at) in records:
+        batch.append(guild_id, message_id, user_id, reaction, registry.counted(is_custom, name, emoji_id, count),
+                     count, at)
+    return batch
+
+
+@dataclass
+class EventQueueStats:
+    enqueued: int = 0
+    chunks: int = 0
+    corrections: int = 0
+    # Flushes postponed because the queue was full
+    full: int = 0
+    # Records and corrections dropped because a writer was max_chunks behind
+    dropped: int = 0
+    writer_restarts: int = 0
+
+
+@dataclass
+class WriterStats:
+    records: int = 0
+    batches: int = 0
+    max_batch: int = 0
+    lag_total: float = 0
+    max_lag: float = 0
+    failures: int = 0
+    dropped: int = 0
+    corrections: int = 0
+
+    @property
+    def avg_batch(self) -> float:
+        return self.records / self.batches if self.batches else 0
+
+    @property
+    def avg_lag(self) -> float:
+        return self.lag_total / self.records if self.records else 0
+
+
+class EventQueue:
+    """
+
+    EventQueue moves writes out of the gateway process. Listeners put compact records (EmojiSource and
+    MessageEmoji fields plus the event time) to multiprocessing queues and return right away, writer
+    processes drain them in batches into their own EmojiBackend with `submit_events`.
+    Records are sent in chunks to keep the per-record pickling and pipe overhead low. Every guild is written
+    by one writer, so corrections of edits, deletes and cleared reactions are applied after the records
+    put before them. While the queue of a writer is full, its records are held back up to the size of the
+    queue and dropped beyond that, dropped records are discarded from the message cache.
+    Reactions are submitted with the same methods as to a backend, so the queue can be the target of
+    the ReactionDebouncer
+
+    """
+
+    _buffers: typing.List[typing.List[QueueItem]]
+    _writers: typing.List[typing.Optional[multiprocessing.Process]]
+
+    def __init__(self, cfg_file: str, cfg: EventQueueConfig, debug: bool = False,
+                 message_cache: MessageCache = None):
+        self._cfg_file = cfg_file
+        self._cfg = cfg
+        self._debug = debug
+        self._message_cache = message_cache
+        self._context = multiprocessing.get_context('spawn')
+        writers = max(1, cfg.writers)
+        queue_size = max(1, cfg.max_chunks // writers)
+        self._queues = [self._context.Queue(queue_size) for _ in range(writers)]
+        # Records held back per writer while its queue is full, as many as fit the queue
+        self._max_buffered = queue_size * cfg.chunk_size
+        # Records put to the queues and not taken by a writer yet
+        self._depth = self._context.Value('q', 0)
+        self._writers = [None] * writers
+        # Items of every writer not sent to its queue yet, in order, and the number of records in them
+        self._buffers = [[] for _ in range(writers)]
+        self._buffered = [0] * writers
+        # Writers whose records are dropped until their buffer drains
+        self._overflowing: typing.Set[int] = set()
+        self._flush_handle: typing.Optional[asyncio.TimerHandle] = None
+        self._monitor_task: typing.Optional[asyncio.Task] = None
+        self.stats = EventQueueStats()
+        self.log = get_logger(EventQueue)
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of records waiting for a writer, including the ones not sent to the queue yet
+        """
+        return self._depth.value + sum(self._buffered)
+
+    def start(self):
+        for index in range(len(self._writers)):
+            self._start_writer(index)
+
+    def put(self, source: EmojiSource, emojis: typing.List[MessageEmoji], at: float = None):
+        at = time.time() if at is None else at
+        index = self._writer_index(source.guild_id)
+        if self._buffered[index] + len(emojis) > self._max_buffered:
+            self._drop(index, len(emojis))
+            if self._message_cache is not None:
+                for emoji_obj in emojis:
+                    self._message_cache.discard(source, emoji_obj)
+            return
+        buffer = self._buffers[index]
+        for emoji_obj in emojis:
+            if not buffer or not isinstance(buffer[-1], list) or len(buffer[-1]) >= self._cfg.chunk_size:
+                buffer.append([])
+            buffer[-1].append(encode_record(source, emoji_obj, at))
+        self._buffered[index] += len(emojis)
+        self.stats.enqueued += len(emojis)
+        if len(buffer) > 1 or len(buffer[-1]) >= self._cfg.chunk_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._cfg.flush_interval, self._flush)
+        if self._monitor_task is None:
+            self._monitor_task = asyncio.ensure_future(self._monitor())
+
+    async def submit_corrections(self, records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]):
+        if not records and not removed:
+            return
+        # Corrections are made per message, so all of them belong to one guild
+        guild_id = (records[0][0] if records else removed[0][0]).guild_id
+        index = self._writer_index(guild_id)
+        correction = encode_correction(records, removed)
+        if self._buffered[index] + item_size(correction) > self._max_buffered:
+            # The message cache already reflects the correction
+            self._drop(index, 1)
+            return
+        self._buffers[index].append(correction)
+        self._buffered[index] += item_size(correction)
+        self.stats.corrections += 1
+        self._flush()
+        if self._monitor_task is None:
+            self._monitor_task = asyncio.ensure_future(self._monitor())
+
+    async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        self.put(EmojiSource(guild_id, message_id, user_id, reaction=True),
+                 [emoji_obj.with_count(1)])
+
+    async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        self.put(EmojiSource(guild_id, message_id, user_id, reaction=True),
+                 [emoji_obj.with_count(-1)])
+
+    async def close(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            self._monitor_task = None
+        self._flush()
+        while any(self._buffers):
+            await asyncio.sleep(self._cfg.flush_interval)
+            self._flush()
+        loop = asyncio.get_event_loop()
+        for (index, writer) in enumerate(self._writers):
+            if writer is not None and writer.is_alive():
+                # Every writer stops after it takes a None
+                await loop.run_in_executor(None, self._queues[index].put, None)
+        await loop.run_in_executor(None, self._join_writers)
+
+    def _writer_index(self, guild_id: typing.Optional[int]) -> int:
+        return (guild_id or 0) % len(self._writers)
+
+    def _drop(self, index: int, count: int):
+        self.stats.dropped += count
+        EVENT_QUEUE_DROPPED.inc(count)
+        if index not in self._overflowing:
+            self._overflowing.add(index)
+            self.log.warning(f'Writer {index} is {self._cfg.max_chunks // len(self._writers)} chunks behind, '
+                             f'dropping its records until it catches up')
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        full = False
+        for (index, buffer) in enumerate(self._buffers):
+            while buffer:
+                item = buffer[0]
+                size = item_size(item)
+                with self._depth.get_lock():
+                    self._depth.value += size
+                try:
+                    self._queues[index].put_nowait(item)
+                except queue.Full:
+                    with self._depth.get_lock():
+                        self._depth.value -= size
+                    full = True
+                    break
+                del buffer[0]
+                self._buffered[index] -= size
+                if isinstance(item, list):
+                    self.stats.chunks += 1
+            if not buffer and index in self._overflowing:
+                self._overflowing.discard(index)
+                self.log.info(f'Writer {index} caught up, its records are queued again')
+        if full:
+            self.stats.full += 1
+            self._flush_handle = asyncio.get_event_loop().call_later(self._cfg.flush_interval, self._flush)
+
+    def _start_writer(self, index: int):
+        writer = self._context.Process(
+            target=_run_writer,
+            name=f'writer-{index}',
+            args=(self._cfg_file, index, self._queues[index], self._depth, self._debug)
+        )
+        writer.start()
+        self._writers[index] = writer
+        self.log.info(f'Started writer {index} (pid {writer.pid})')
+
+    def _join_writers(self):
+        for writer in self._writers:
+            if writer is None:
+                continue
+            writer.join(60)
+            if writer.is_alive():
+                self.log.error(f'Writer {writer.name} did not stop in time, terminating it')
+                writer.terminate()
+
+    async def _monitor(self):
+        next_report_at = time.monotonic() + self._cfg.report_interval
+        while True:
+            await asyncio.sleep(1)
+            for (index, writer) in enumerate(self._writers):
+                if writer is not None and not writer.is_alive():
+                    self.log.error(f'Writer {index} exited with code {writer.exitcode}, restarting it')
+                    self.stats.writer_restarts += 1
+                    self._start_writer(index)
+            if time.monotonic() >= next_report_at:
+                next_report_at = time.monotonic() + self._cfg.report_interval
+                self.log.info(f'Event queue: {self.stats.enqueued} records enqueued in {self.stats.chunks} chunks, '
+                              f'{self.stats.corrections} corrections, depth {self.depth}, '
+                              f'{self.stats.full} flushes postponed, {self.stats.dropped} dropped')
+
+
+class EventWriter:
+    """
+
+    EventWriter takes chunks of records from the queue and writes them to the backend once `batch_size`
+    records are collected or `batch_interval` seconds after the first record of the batch arrived.
+    Corrections are applied once the batch collected before them is written. A failed batch or correction
+    is retried, only the writes that were not applied if it failed partway, and dropped after `retries`
+    attempts. Batch sizes and the lag between the event and the end of its write are logged every
+    `report_interval` seconds
+
+    """
+
+    _batch: typing.List[EventRecord]
+
+    def __init__(self, index: int, backend: EmojiBackend, records: multiprocessing.Queue, depth,
+                 cfg: EventQueueConfig):
+        self._index = index
+        self._backend = backend
+        self._records = records
+        self._depth = depth
+        self._cfg = cfg
+        self._batch = []
+        self.stats = WriterStats()
+        self.log = get_logger(EventWriter)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        await self._backend.init()
+        deadline = None
+        next_report_at = time.monotonic() + self._cfg.report_interval
+        stopping = False
+        while not stopping:
+            if deadline is None:
+                timeout = max(0.0, next_report_at - time.monotonic())
+            else:
+                timeout = max(0.0, min(deadline, next_report_at) - time.monotonic())
+            item = await loop.run_in_executor(None, self._get, timeout)
+            correction = None
+            if item is None:
+                stopping = True
+            elif item:
+                with self._depth.get_lock():
+                    self._depth.value -= item_size(item)
+                if isinstance(item, list):
+                    self._batch += item
+                    if deadline is None:
+                        deadline = time.monotonic() + self._cfg.batch_interval
+                else:
+                    correction = item
+
+            while len(self._batch) >= self._cfg.batch_size:
+                await self._write(self._batch[:self._cfg.batch_size])
+                del self._batch[:self._cfg.batch_size]
+            if self._batch and (stopping or correction is not None or time.monotonic() >= deadline):
+                await self._write(self._batch)
+                self._batch = []
+            if not self._batch:
+                deadline = None
+            if correction is not None:
+                await self._correct(correction)
+
+            if time.monotonic() >= next_report_at:
+                next_report_at = time.monotonic() + self._cfg.report_interval
+                self._report()
+        self._report()
+        await self._backend.close()
+
+    def _get(self, timeout: float) -> typing.Optional[QueueItem]:
+        try:
+            return self._records.get(timeout=timeout)
+        except queue.Empty:
+            return []
+
+    async def _write(self, records: typing.List[EventRecord]):
+        if not await self._apply(partial(self._backend.submit_events, decode_batch(records)),
+                                 f'a batch of {len(records)} records'):
+            self.stats.dropped += len(records)
+            return
+
+        now = time.time()
+        lags = [now - record[-1] for record in records]
+        stats = self.stats
+        stats.records += len(records)
+        stats.batches += 1
+        stats.max_batch = max(stats.max_batch, len(records))
+        stats.lag_total += sum(lags)
+        stats.max_lag = max(stats.max_lag, max(lags))
+
+    async def _correct(self, correction: CorrectionRecord):
+        (records, removed) = decode_correction(correction)
+        if await self._apply(partial(self._backend.submit_corrections, records, removed),
+                             f'a correction of {len(records)} counter deltas and {len(removed)} removals'):
+            self.stats.corrections += 1
+        else:
+            self.stats.dropped += 1
+
+    async def _apply(self, write: typing.Callable[[], typing.Awaitable], what: str) -> bool:
+        """
+        Runs the write with retries, returns False if it was dropped
+        """
+        for attempt in range(self._cfg.retries + 1):
+            try:
+                await write()
+                return True
+            except Exception as exc:
+                if isinstance(exc, PartialWriteError):
+                    # Writes that were applied must not be repeated
+                    write = exc.retry
+                if attempt == self._cfg.retries:
+                    self.stats.failures += 1
+                    self.log.error(f'Failed to write {what}, dropped: {exc}')
+                    return False
+                self.log.warning(f'Failed to write {what}, retrying: {exc}')
+                await asyncio.sleep(2 ** attempt)
+
+    def _report(self):
+        stats = self.stats
+        self.log.info(f'Writer {self._index}: {stats.records} records in {stats.batches} batches '
+                      f'(avg {stats.avg_batch:.0f}, max {stats.max_batch}), {stats.corrections} corrections, '
+                      f'lag avg {stats.avg_lag:.3f}s max {stats.max_lag:.3f}s, queue depth {self._depth.value}, '
+                      f'{stats.dropped} dropped')
+        self.stats = WriterStats()
+
+
+def _run_writer(cfg_file: str, index: int, records: multiprocessing.Queue, depth, debug: bool):
+    # Ctrl+C reaches the whole process group, writers stop when the bot process closes the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_debug(debug)
+    config = Config(cfg_file)
+    configure_logging(config.logging_cfg)
+    backend = get_backend_class(config.backend)(config)
+    asyncio.run(EventWriter(index, backend, records, depth, config.event_queue_cfg).run())
@@ -0,0 +1,342 @@
+import asyncio
+import time
+import typing
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+
+from emoji_maniac.bot.config import IngestionConfig
+from emoji_maniac.bot.message_cache import MessageCache
+from emoji_maniac.log import get_logger
+from emoji_maniac.metrics import REGISTRY
+from emoji_maniac.persistence.counters import Counters
+from emoji_maniac.persistence.emoji_backend import EmojiBackend
+from emoji_maniac.persistence.models import EmojiSource, MessageEmoji, Emoji, EmojiBatch, HistoryRecord, \
+    EventRemoval, utc_timestamp
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'counters_only')
+
+INGESTION_PENDING = REGISTRY.gauge('emoji_maniac_ingestion_pending',
+                                   'Records and counter deltas waiting in the ingestion stage', ('kind',))
+INGESTION_DROPPED = REGISTRY.counter('emoji_maniac_ingestion_dropped_total', 'Records dropped by the ingestion stage',
+                                     ('reason',))
+INGESTION_DEGRADED = REGISTRY.counter('emoji_maniac_ingestion_degraded_total',
+                                      'Records written as counter deltas without raw events')
+INGESTION_WRITE_SECONDS = REGISTRY.histogram('emoji_maniac_ingestion_write_seconds',
+                                             'Duration of ingestion batch writes', ('mode',))
+LOOP_LAG = REGISTRY.histogram('emoji_maniac_event_loop_lag_seconds', 'Delay of the event loop behind its timers',
+                              buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+# Seconds between event loop lag measurements
+LAG_INTERVAL = 0.5
+
+# (source, emoji, unix time of the event)
+PendingRecord = typing.Tuple[EmojiSource, MessageEmoji, float]
+# (guild id, user id, reaction, emoji uid, day of the event in the guild's timezone)
+CounterKey = typing.Tuple[int, int, bool, str, str]
+
+
+@dataclass
+class IngestionStats:
+    received: int = 0
+    written: int = 0
+    # Records written as counter deltas only
+    degraded: int = 0
+    dropped: int = 0
+    # Puts that waited for room
+    blocked: int = 0
+    failures: int = 0
+
+
+class _PendingCounter:
+    __slots__ = ('source', 'emoji', 'count', 'at')
+
+    def __init__(self, source: EmojiSource, emoji_obj: MessageEmoji, at: float):
+        self.source = source
+        self.emoji = emoji_obj
+        self.count = 0
+        self.at = at
+
+
+class _Correction:
+    __slots__ = ('records', 'removed')
+
+    def __init__(self, records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]):
+        self.records = records
+        self.removed = removed
+
+
+class IngestionStage:
+    """
+
+    IngestionStage keeps the listeners from awaiting the backend. Emojis are put to a bounded queue and
+    `workers` writers drain it in batches with `submit_events`, so a slow database delays writes instead of
+    piling up listener tasks. Once `max_pending` records are waiting the overflow policy applies: `block`
+    makes listeners wait for room, `drop_oldest` drops the oldest records and `counters_only` sums new
+    records into counter deltas that are written with `update_counters`, without raw events.
+    The policy also applies while the event loop lags more than `max_loop_lag` seconds, so the gateway
+    heartbeat is not delayed by work the bot cannot keep up with anyway. Dropped records are discarded from
+    the message cache, so edits and deletes do not subtract what was never written.
+    Corrections of edits, deletes and cleared reactions queue behind the records put before them and are
+    written once those are, so raw events are not removed before they are stored
+
+    """
+
+    _records: typing.Deque[typing.Union[PendingRecord, _Correction]]
+    _counters: typing.Dict[CounterKey, _PendingCounter]
+
+    def __init__(self, backend: EmojiBackend, cfg: IngestionConfig, message_cache: MessageCache = None):
+        if cfg.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {cfg.overflow}, expected one of {", ".join(OVERFLOW_POLICIES)}')
+        self._backend = backend
+        self._cfg = cfg
+        self._message_cache = message_cache
+        self._records = deque()
+        self._counters = {}
+        self._workers: typing.Optional[typing.List[asyncio.Task]] = None
+        self._monitor_task: typing.Optional[asyncio.Task] = None
+        # Set when there is something to write and when the stage closes
+        self._wakeup = asyncio.Event()
+        # Set when there is room for records
+        self._room = asyncio.Event()
+        self._blocked = 0
+        # Sequence numbers of the chunks taken by the writers and not written yet
+        self._taken = 0
+        self._in_flight: typing.Set[int] = set()
+        self._written = asyncio.Condition()
+        self._lagging = False
+        self._closing = False
+        self.stats = IngestionStats()
+        self.log = get_logger(IngestionStage)
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of records and counter deltas waiting to be written
+        """
+        return len(self._records) + len(self._counters)
+
+    @property
+    def overloaded(self) -> bool:
+        return len(self._records) >= self._cfg.max_pending or self._lagging
+
+    async def put(self, source: EmojiSource, emojis: typing.List[MessageEmoji], at: float = None):
+        if self._workers is None:
+            self._start()
+        at = time.time() if at is None else at
+        self.stats.received += len(emojis)
+        if self.overloaded and self._cfg.overflow == 'counters_only':
+            await self._add_counters(source, emojis, at)
+            return
+        await self._enqueue([(source, emoji_obj, at) for emoji_obj in emojis])
+
+    async def submit_corrections(self, records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]):
+        if self._workers is None:
+            self._start()
+        if self.overloaded and self._cfg.overflow == 'counters_only':
+            for (source, emoji_obj, at) in records:
+                await self._add_counters(source, [emoji_obj], utc_timestamp(at))
+            # Raw events are not written in this mode, the ones queued before are dropped with their removal
+            if removed:
+                self._drop('overflow', [_Correction([], removed)])
+            return
+        await self._enqueue([_Correction(records, removed)])
+
+    async def _enqueue(self, items: typing.List[typing.Union[PendingRecord, _Correction]]):
+        if self.overloaded:
+            if self._cfg.overflow == 'drop_oldest':
+                self._drop_oldest(len(self._records) + len(items) - self._cfg.max_pending if not self._lagging
+                                  else len(items))
+            elif not await self._wait_for_room(items):
+                return
+        self._records += items
+        self._wakeup.set()
+
+    async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self.put(EmojiSource(guild_id, message_id, user_id, reaction=True), [emoji_obj.with_count(1)])
+
+    async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self.put(EmojiSource(guild_id, message_id, user_id, reaction=True), [emoji_obj.with_count(-1)])
+
+    async def close(self):
+        """
+        Writes everything pending and stops the writers
+        """
+        if self._workers is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await asyncio.gather(*self._workers)
+        self._monitor_task.cancel()
+        self._workers = None
+        self._monitor_task = None
+        self._report()
+
+    def _start(self):
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(max(1, self._cfg.workers))]
+        self._monitor_task = asyncio.ensure_future(self._monitor())
+
+    def _drop(self, reason: str, items: typing.List[typing.Union[PendingRecord, _Correction]]):
+        if self._message_cache is not None:
+            # The message cache already reflects dropped corrections
+            for item in items:
+                if not isinstance(item, _Correction):
+                    self._message_cache.discard(item[0], item[1])
+        self.stats.dropped += len(items)
+        INGESTION_DROPPED.inc(len(items), reason=reason)
+
+    def _drop_oldest(self, count: int):
+        dropped = [self._records.popleft() for _ in range(min(count, len(self._records)))]
+        if dropped:
+            self._drop('overflow', dropped)
+
+    async def _wait_for_room(self, items: typing.List[typing.Union[PendingRecord, _Correction]]) -> bool:
+        """
+        Waits until the items can be put without going over max_pending, returns False if they were dropped
+        instead
+        """
+        # Waiting does not help while the loop itself is behind, and every waiting listener holds a task
+        if self._lagging or self._blocked >= self._cfg.max_blocked:
+            self._drop('overflow', items)
+            return False
+        self.stats.blocked += 1
+        self._blocked += 1
+        deadline = time.monotonic() + self._cfg.block_timeout
+        try:
+            while len(self._records) >= self._cfg.max_pending:
+                self._room.clear()
+                try:
+                    await asyncio.wait_for(self._room.wait(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self._drop('block_timeout', items)
+                    return False
+            return True
+        finally:
+            self._blocked -= 1
+
+    async def _add_counters(self, source: EmojiSource, emojis: typing.List[MessageEmoji], at: float):
+        # Deltas of one local day of the guild fall into the same day, week, month and year counters
+        tz = await self._backend.get_guild_tz(source.guild_id)
+        day = Counters.daily_modifiers(tz, datetime.utcfromtimestamp(at))[-1]
+        for emoji_obj in emojis:
+            key = (source.guild_id, source.user_id, source.reaction, emoji_obj.uid, day)
+            entry = self._counters.get(key)
+            if entry is None:
+                if len(self._counters) >= self._cfg.max_pending:
+                    self._drop('overflow', [(source, emoji_obj, at)])
+                    continue
+                entry = self._counters[key] = _PendingCounter(source, emoji_obj, at)
+            entry.count += emoji_obj.count
+        self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            if self._counters:
+                (counters, self._counters) = (self._counters, {})
+                await self._write_counters(list(counters.values()))
+            elif self._records:
+                chunk = self._take()
+                self._taken += 1
+                seq = self._taken
+                self._in_flight.add(seq)
+                if len(self._records) < self._cfg.max_pending:
+                    self._room.set()
+                try:
+                    if isinstance(chunk, _Correction):
+                        await self._correct(chunk, seq)
+                    else:
+                        await self._write(chunk)
+                finally:
+                    self._in_flight.discard(seq)
+                    async with self._written:
+                        self._written.notify_all()
+            elif self._closing:
+                return
+            else:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+    def _take(self) -> typing.Union[typing.List[PendingRecord], _Correction]:
+        """
+        Takes the next correction or the records up to it, at most batch_size
+        """
+        if isinstance(self._records[0], _Correction):
+            return self._records.popleft()
+        chunk = []
+        while self._records and len(chunk) < self._cfg.batch_size and not isinstance(self._records[0], _Correction):
+            chunk.append(self._records.popleft())
+        return chunk
+
+    async def _write(self, records: typing.List[PendingRecord]):
+        batch = EmojiBatch()
+        for (source, emoji_obj, at) in records:
+            batch.append(source.guild_id, source.message_id, source.user_id, source.reaction, emoji_obj,
+                         emoji_obj.count, at)
+        try:
+            with INGESTION_WRITE_SECONDS.time(mode='history'):
+                await asyncio.wait_for(self._backend.submit_events(batch), self._cfg.write_timeout)
+        except Exception as exc:
+            self.stats.failures += 1
+            self._drop('write_error', records)
+            self.log.error(f'Failed to write a batch of {len(records)} records, batch dropped: {exc!r}')
+            return
+        self.stats.written += len(records)
+
+    async def _correct(self, correction: _Correction, seq: int):
+        # Chunks taken before the correction may still be written by other workers
+        async with self._written:
+            await self._written.wait_for(lambda: min(self._in_flight) == seq)
+        try:
+            with INGESTION_WRITE_SECONDS.time(mode='corrections'):
+                await asyncio.wait_for(self._backend.submit_corrections(correction.records, correction.removed),
+                                       self._cfg.write_timeout)
+        except Exception as exc:
+            self.stats.failures += 1
+            self._drop('write_error', [correction])
+            self.log.error(f'Failed to write a correction of {len(correction.records)} counter deltas and '
+                           f'{len(correction.removed)} removals, correction dropped: {exc!r}')
+
+    async def _write_counters(self, counters: typing.List[_PendingCounter]):
+        records = [(entry.source, entry.emoji.with_count(entry.count), datetime.utcfromtimestamp(entry.at))
+                   for entry in counters if entry.count]
+        if not records:
+            return
+        try:
+            with INGESTION_WRITE_SECONDS.time(mode='counters'):
+                await asyncio.wait_for(self._backend.update_counters(records), self._cfg.write_timeout)
+        except Exception as exc:
+            self.stats.failures += 1
+            # Sums are not tracked per message, so the message cache keeps them
+            self.stats.dropped += len(records)
+            INGESTION_DROPPED.inc(len(records), reason='write_error')
+            self.log.error(f'Failed to write {len(records)} counter deltas, deltas dropped: {exc!r}')
+            return
+        self.stats.degraded += len(records)
+        INGESTION_DEGRADED.inc(len(records))
+
+    async def _monitor(self):
+        next_report_at = time.monotonic() + self._cfg.report_interval
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(0.0, time.monotonic() - started_at - LAG_INTERVAL)
+            LOOP_LAG.observe(lag)
+            lagging = lag > self._cfg.max_loop_lag
+            if lagging != self._lagging:
+                self._lagging = lagging
+                if lagging:
+                    self.log.warning(f'Event loop lags {lag:.2f}s behind, shedding records '
+                                     f'({self._cfg.overflow} policy) until it catches up')
+                else:
+                    self.log.info('Event loop caught up, records are queued again')
+            INGESTION_PENDING.set(len(self._records), kind='records')
+            INGESTION_PENDING.set(len(self._counters), kind='counters')
+            if time.monotonic() >= next_report_at:
+                next_report_at = time.monotonic() + self._cfg.report_interval
+                self._report()
+
+    def _report(self):
+        stats = self.stats
+        self.log.info(f'Ingestion: {stats.received} records received, {stats.written} written, '
+                      f'{stats.degraded} counter deltas, {stats.dropped} dropped, {stats.blocked} puts blocked, '
+                      f'depth {self.depth}')
@@ -0,0 +1,98 @@
+import time
+import typing
+
+from emoji_maniac.persistence.cache import LRUCache
+from emoji_maniac.persistence.models import MessageEmoji, EmojiSource
+
+# (user id, emoji uid) -> (emoji, count, unix time of the first reaction)
+Reactions = typing.Dict[typing.Tuple[int, str], typing.Tuple[MessageEmoji, int, float]]
+
+
+class CachedMessage:
+    __slots__ = ('guild_id', 'author_id', 'emojis', 'reactions')
+
+    def __init__(self, guild_id: int, author_id: typing.Optional[int] = None,
+                 emojis: typing.Optional[typing.Tuple[MessageEmoji, ...]] = None):
+        self.guild_id = guild_id
+        # None if only reactions of the message were seen
+        self.author_id = author_id
+        self.emojis = emojis
+        self.reactions: typing.Optional[Reactions] = None
+
+
+class MessageCache:
+    """
+
+    MessageCache keeps the emojis of recently counted messages and the reactions added to recent messages,
+    so edits, deletes and cleared reactions can be turned into counter deltas without recounting anything.
+    Messages that are not in the cache (evicted or posted before the bot started) are not corrected
+
+    """
+
+    def __init__(self, size: int):
+        self._messages = LRUCache(size)
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def stats(self):
+        return self._messages.stats
+
+    def get(self, message_id: int) -> typing.Optional[CachedMessage]:
+        return self._messages.get(message_id)
+
+    def pop(self, message_id: int) -> typing.Optional[CachedMessage]:
+        entry = self._messages.peek(message_id)
+        if entry is not None:
+            self._messages.invalidate(message_id)
+        return entry
+
+    def add_message(self, message_id: int, guild_id: int, author_id: int, emojis: typing.Sequence[MessageEmoji]):
+        entry = self._messages.peek(message_id)
+        if entry is None:
+            self._messages.put(message_id, CachedMessage(guild_id, author_id, tuple(emojis)))
+        else:
+            # Reactions may arrive before the message is counted
+            entry.author_id = author_id
+            entry.emojis = tuple(emojis)
+
+    def add_reaction(self, message_id: int, guild_id: int, user_id: int, emoji_obj: MessageEmoji, delta: int):
+        entry = self._messages.get(message_id)
+        if entry is None:
+            entry = CachedMessage(guild_id)
+            self._messages.put(message_id, entry)
+        if entry.reactions is None:
+            entry.reactions = {}
+        key = (user_id, emoji_obj.uid)
+        (_, count, at) = entry.reactions.get(key, (emoji_obj, 0, time.time()))
+        if count + delta > 0:
+            entry.reactions[key] = (emoji_obj, count + delta, at)
+        else:
+            entry.reactions.pop(key, None)
+
+    def discard(self, source: EmojiSource, emoji_obj: MessageEmoji):
+        """
+        Forgets an emoji that was counted here but not written, so edits and deletes do not subtract it.
+        Emojis of the message are no longer tracked at all, a reaction is taken back
+        """
+        entry = self._messages.peek(source.message_id)
+        if entry is None:
+            return
+        if not source.reaction:
+            entry.emojis = None
+            return
+        self.add_reaction(source.message_id, source.guild_id, source.user_id, emoji_obj, -emoji_obj.count)
+
+    @staticmethod
+    def emoji_delta(old: typing.Sequence[MessageEmoji],
+                    new: typing.Sequence[MessageEmoji]) -> typing.List[MessageEmoji]:
+        """
+        Returns emojis whose count changed between the old and the new content, with the difference as count
+        """
+        counts = {}
+        for (emojis, sign) in ((old, -1), (new, 1)):
+            for emoji_obj in emojis:
+                (_, count) = counts.get(emoji_obj.uid, (emoji_obj, 0))
+                counts[emoji_obj.uid] = (emoji_obj, count + sign * emoji_obj.count)
+        return [emoji_obj.with_count(count) for (emoji_obj, count) in counts.values() if count != 0]
@@ -0,0 +1,100 @@
+import asyncio
+import time
+import typing
+from dataclasses import dataclass, field
+
+from emoji_maniac.bot.config import RetentionConfig
+from emoji_maniac.log import get_logger
+from emoji_maniac.metrics import REGISTRY
+from emoji_maniac.persistence.emoji_backend import EmojiBackend, RetentionStats
+
+RETENTION_DOCUMENTS = REGISTRY.counter('emoji_maniac_retention_documents_total',
+                                       'Documents folded, deleted or archived by retention', ('collection', 'action'))
+RETENTION_RECLAIMED = REGISTRY.counter('emoji_maniac_retention_reclaimed_bytes_total',
+                                       'Estimated bytes reclaimed by retention', ('collection',))
+RETENTION_SECONDS = REGISTRY.histogram('emoji_maniac_retention_run_seconds', 'Duration of retention runs',
+                                       buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600))
+
+
+@dataclass
+class RetentionRun:
+    started_at: float
+    duration: float = 0
+    stats: typing.List[RetentionStats] = field(default_factory=list)
+    error: typing.Optional[str] = None
+
+    @property
+    def documents(self) -> int:
+        return sum(stats.documents for stats in self.stats)
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return sum(stats.reclaimed_bytes for stats in self.stats)
+
+
+class RetentionScheduler:
+    """
+
+    RetentionScheduler applies the retention policies of the backend in the background, first after
+    `first_run_delay` seconds and then every `interval` seconds. Runs are logged with per-collection
+    throughput and reclaimed space. It stops if the backend does not support retention
+
+    """
+
+    last_run: typing.Optional[RetentionRun] = None
+
+    def __init__(self, backend: EmojiBackend, cfg: RetentionConfig):
+        self._backend = backend
+        self._cfg = cfg
+        self._task: typing.Optional[asyncio.Task] = None
+        self.log = get_logger(RetentionScheduler)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(self._cfg.first_run_delay)
+        while True:
+            run = await self.run_once()
+            if run is None:
+                self.log.warning(f'{type(self._backend).__name__} does not support retention, scheduler stopped')
+                return
+            await asyncio.sleep(self._cfg.interval)
+
+    async def run_once(self) -> typing.Optional[RetentionRun]:
+        run = RetentionRun(started_at=time.time())
+        started_at = time.perf_counter()
+        try:
+            stats = await self._backend.apply_retention(self._cfg)
+        except Exception as e:
+            run.error = str(e)
+            self.log.exception('Retention run failed')
+            stats = []
+        if stats is None:
+            return None
+        run.stats = stats
+        run.duration = time.perf_counter() - started_at
+        RETENTION_SECONDS.observe(run.duration)
+        for item in stats:
+            RETENTION_DOCUMENTS.inc(item.documents, collection=item.collection, action=item.action)
+            RETENTION_RECLAIMED.inc(item.reclaimed_bytes, collection=item.collection)
+            self.log.info(f'{item.collection}: {item.documents} documents {item.action} in {item.duration:.1f}s '
+                          f'({item.documents_per_second:.0f}/s), ~{item.reclaimed_bytes / 2 ** 20:.1f} MB reclaimed')
+        self.log.info(f'Retention run finished in {run.duration:.1f}s: {run.documents} documents, '
+                      f'~{run.reclaimed_bytes / 2 ** 20:.1f} MB reclaimed')
+        self.last_run = run
+        return run
@@ -0,0 +1,322 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+import typing
+from dataclasses import dataclass, asdict
+
+from discord.ext import commands
+from discord.http import HTTPClient
+
+from emoji_maniac.log import get_logger, set_debug, configure_logging
+from .bot import Bot
+from .config import Config, ShardingConfig
+
+# Gateway dispatch events that carry the guild id as "id"
+_GUILD_EVENTS = ('GUILD_CREATE', 'GUILD_UPDATE', 'GUILD_DELETE')
+
+
+def shard_ranges(shard_count: int, processes: int) -> typing.List[typing.List[int]]:
+    """
+    Splits shard ids into contiguous ranges of almost the same size, one per process
+    """
+    processes = max(1, min(processes, shard_count))
+    (size, extra) = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def fetch_shard_count(token: str) -> int:
+    """
+    Returns the number of shards recommended by Discord for the bot
+    """
+    http = HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        (shards, _) = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards
+
+
+class ShardEventRates:
+    """
+
+    ShardEventRates counts gateway dispatch events per shard. The shard of an event is computed from its guild
+    id the same way Discord routes guild events, events without a guild go to shard 0
+
+    """
+
+    _counts: typing.Dict[int, int]
+
+    def __init__(self):
+        self._counts = {}
+        self._snapshot = {}
+        self._snapshot_at = time.monotonic()
+
+    def count(self, msg: dict, shard_count: typing.Optional[int]):
+        if msg.get('op') != 0:
+            return
+        shard_id = 0
+        if shard_count:
+            data = msg.get('d')
+            guild_id = None
+            if isinstance(data, dict):
+                guild_id = data.get('id') if msg.get('t') in _GUILD_EVENTS else data.get('guild_id')
+            if guild_id is not None:
+                shard_id = (int(guild_id) >> 22) % shard_count
+        self._counts[shard_id] = self._counts.get(shard_id, 0) + 1
+
+    def totals(self) -> typing.Dict[int, int]:
+        return dict(self._counts)
+
+    def rates(self) -> typing.Dict[int, float]:
+        """
+        Returns events per second of every shard since the previous call
+        """
+        now = time.monotonic()
+        elapsed = now - self._snapshot_at
+        rates = {shard_id: (count - self._snapshot.get(shard_id, 0)) / elapsed if elapsed else 0
+                 for (shard_id, count) in self._counts.items()}
+        self._snapshot = dict(self._counts)
+        self._snapshot_at = now
+        return rates
+
+
+@dataclass
+class ShardReport:
+    process_index: int
+    pid: int
+    shard_id: int
+    events_per_second: float
+    events_total: int
+    latency_ms: typing.Optional[float]
+    reported_at: float
+
+
+class ShardedBot(Bot, commands.AutoShardedBot):
+    """
+
+    ShardedBot runs the shards given by `shard_ids` (all of them if None) on one event loop and reports their
+    event rates and latencies every `report_interval` seconds to the log and to the supervisor's queue
+
+    """
+
+    shard_rates: ShardEventRates
+    _report_task: typing.Optional[asyncio.Task] = None
+
+    def __init__(self, backend=None, cfg_file='emoji_cfg.yaml', process_index: int = 0, reports=None, **kwargs):
+        super(ShardedBot, self).__init__(backend, cfg_file, **kwargs)
+        self.shard_rates = ShardEventRates()
+        self._process_index = process_index
+        self._reports = reports
+        self.metrics_port_offset = process_index
+        self.runs_maintenance = process_index == 0
+
+    def dispatch(self, event_name, *args, **kwargs):
+        # Counted inline instead of with an on_socket_response listener, which would cost a task per event
+        if event_name == 'socket_response':
+            self.shard_rates.count(args[0], self.shard_count)
+        super(ShardedBot, self).dispatch(event_name, *args, **kwargs)
+
+    async def on_ready(self):
+        await super(ShardedBot, self).on_ready()
+        if self._report_task is None:
+            self._report_task = asyncio.ensure_future(self._report_loop())
+
+    async def on_shard_ready(self, shard_id: int):
+        self.log.info(f'Shard {shard_id} is ready')
+
+    async def on_shard_disconnect(self, shard_id: int):
+        self.log.warning(f'Shard {shard_id} disconnected')
+
+    async def on_shard_resumed(self, shard_id: int):
+        self.log.info(f'Shard {shard_id} resumed')
+
+    async def close(self):
+        if self._report_task is not None:
+            self._report_task.cancel()
+            self._report_task = None
+        await super(ShardedBot, self).close()
+
+    def shard_reports(self) -> typing.List[ShardReport]:
+        rates = self.shard_rates.rates()
+        totals = self.shard_rates.totals()
+        latencies = dict(self.latencies)
+        now = time.time()
+        return [
+            ShardReport(
+                process_index=self._process_index,
+                pid=os.getpid(),
+                shard_id=shard_id,
+                events_per_second=rates.get(shard_id, 0),
+                events_total=totals.get(shard_id, 0),
+                latency_ms=latencies[shard_id] * 1000 if latencies.get(shard_id) is not None else None,
+                reported_at=now
+            )
+            for shard_id in sorted(self.shards)
+        ]
+
+    async def _report_loop(self):
+        interval = self.config.sharding_cfg.report_interval
+        while True:
+            await asyncio.sleep(interval)
+            reports = self.shard_reports()
+            self.log.info('Shard event rates: ' + ', '.join(
+                f'{r.shard_id}: {r.events_per_second:.1f}/s' for r in reports))
+            if self._reports is not None:
+                self._reports.put([asdict(r) for r in reports])
+
+
+def _run_shard_process(cfg_file: str, shard_ids: typing.List[int], shard_count: int, process_index: int,
+                       reports, debug: bool):
+    set_debug(debug)
+    bot = ShardedBot(cfg_file=cfg_file, shard_ids=shard_ids, shard_count=shard_count,
+                     process_index=process_index, reports=reports)
+    bot.run()
+
+
+class _ShardProcess:
+    __slots__ = ('index', 'shard_ids', 'process', 'start_at', 'started_at', 'failures')
+
+    def __init__(self, index: int, shard_ids: typing.List[int], start_at: float):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process: typing.Optional[multiprocessing.Process] = None
+        self.start_at = start_at
+        self.started_at = 0.0
+        self.failures = 0
+
+    @property
+    def name(self):
+        return f'shards-{self.shard_ids[0]}-{self.shard_ids[-1]}'
+
+
+class ShardSupervisor:
+    """
+
+    ShardSupervisor spreads shard ranges across OS processes, every process runs a ShardedBot with its own
+    backend client. Processes that exit are restarted with exponential backoff, which is reset once a process
+    stays up for `stable_after` seconds. Per-shard event rates the processes report are logged and, if
+    `stats_file` is set, written there as JSON
+
+    """
+
+    _latest: typing.Dict[int, dict]
+
+    def __init__(self, cfg_file: str = 'emoji_cfg.yaml', debug: bool = False):
+        self._cfg_file = cfg_file
+        self._debug = debug
+        config = Config(cfg_file)
+        configure_logging(config.logging_cfg)
+        self._token = config.token
+        self._cfg: ShardingConfig = config.sharding_cfg
+        self._context = multiprocessing.get_context('spawn')
+        self._reports = self._context.Queue()
+        self._latest = {}
+        self.log = get_logger(ShardSupervisor)
+
+    def run(self):
+        """
+        Starts shard processes and supervises them until interrupted. Blocking call
+        """
+        shard_count = self._cfg.shard_count or asyncio.run(fetch_shard_count(self._token))
+        ranges = shard_ranges(shard_count, self._cfg.processes)
+        self.log.info(f'Running {shard_count} shards in {len(ranges)} processes')
+
+        now = time.monotonic()
+        processes = []
+        delay = 0.0
+        for (index, shard_ids) in enumerate(ranges):
+            processes.append(_ShardProcess(index, shard_ids, now + delay))
+            delay += len(shard_ids) * self._cfg.identify_interval
+
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        next_report_at = now + self._cfg.report_interval
+        try:
+            while True:
+                now = time.monotonic()
+                for process in processes:
+                    if process.process is None:
+                        if now >= process.start_at:
+                            self._start(process, shard_count)
+                    elif not process.process.is_alive():
+                        self._schedule_restart(process, now)
+                self._receive_reports(timeout=1.0)
+                if now >= next_report_at:
+                    next_report_at = now + self._cfg.report_interval
+                    self._write_stats()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop(processes)
+
+    def _start(self, process: _ShardProcess, shard_count: int):
+        process.process = self._context.Process(
+            target=_run_shard_process,
+            name=process.name,
+            args=(self._cfg_file, process.shard_ids, shard_count, process.index, self._reports, self._debug)
+        )
+        process.process.start()
+        process.started_at = time.monotonic()
+        self.log.info(f'Started process {process.name} (pid {process.process.pid})')
+
+    def _schedule_restart(self, process: _ShardProcess, now: float):
+        exitcode = process.process.exitcode
+        uptime = now - process.started_at
+        process.process = None
+        if uptime >= self._cfg.stable_after:
+            process.failures = 0
+        delay = min(self._cfg.restart_delay * 2 ** process.failures, self._cfg.max_restart_delay)
+        process.failures += 1
+        process.start_at = now + delay
+        for shard_id in process.shard_ids:
+            self._latest.pop(shard_id, None)
+        self.log.error(f'Process {process.name} exited with code {exitcode} after {uptime:.0f}s, '
+                       f'restarting in {delay:.1f}s')
+
+    def _receive_reports(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                reports = self._reports.get(timeout=remaining)
+            except queue.Empty:
+                return
+            for report in reports:
+                self._latest[report['shard_id']] = report
+
+    def _write_stats(self):
+        if not self._latest:
+            return
+        by_process = {}
+        for report in self._latest.values():
+            by_process.setdefault(report['process_index'], []).append(report)
+        for (index, reports) in sorted(by_process.items()):
+            self.log.info(f'Process {index}: {sum(r["events_per_second"] for r in reports):.1f} events/s, ' +
+                          ', '.join(f'shard {r["shard_id"]} {r["events_per_second"]:.1f}/s'
+                                    for r in sorted(reports, key=lambda r: r['shard_id'])))
+        if self._cfg.stats_file:
+            with open(self._cfg.stats_file, 'w') as f:
+                json.dump(sorted(self._latest.values(), key=lambda r: r['shard_id']), f, indent=2)
+
+    def _stop(self, processes: typing.List[_ShardProcess]):
+        running = [p.process for p in processes if p.process is not None and p.process.is_alive()]
+        for process in running:
+            # discord.py closes the bot on SIGTERM, so pending writes are flushed
+            process.terminate()
+        for process in running:
+            process.join(30)
+            if process.is_alive():
+                process.kill()
@@ -1,38 +1,113 @@
+import atexit
+import json
 import logging
+import queue
+import random
 import sys
+import time
 import typing
 import inspect
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+if typing.TYPE_CHECKING:
+    from emoji_maniac.bot.config import LoggingConfig
 
 LOGGER_NAME = 'EmojiManiac'
 _initialized_loggers = []
 _is_debug = False
+_cfg: typing.Optional['LoggingConfig'] = None
+_queue: typing.Optional[queue.Queue] = None
+_listener: typing.Optional[QueueListener] = None
 
 
-def _initialize_logger(logger: logging.Logger):
-    level = logging.DEBUG if _is_debug else logging.INFO
-    logger.setLevel(level)
-    logger.handlers.clear()
+def _create_stream_handlers(level: int) -> typing.List[logging.Handler]:
+    formatter = json_formatter_instance if _cfg is not None and _cfg.format == 'json' else base_formatter_instance
 
     stderr_h = logging.StreamHandler(sys.stderr)
     stderr_h.setLevel(level)
     stderr_h.addFilter(above_warning_filter)
-    stderr_h.setFormatter(base_formatter_instance)
+    stderr_h.setFormatter(formatter)
 
     stdout_h = logging.StreamHandler(sys.stdout)
     stdout_h.setLevel(level)
     stdout_h.addFilter(below_warning_filter)
-    stdout_h.setFormatter(base_formatter_instance)
+    stdout_h.setFormatter(formatter)
 
-    logger.handlers = [stdout_h, stderr_h]
+    return [stdout_h, stderr_h]
+
+
+def _initialize_logger(logger: logging.Logger):
+    level = logging.DEBUG if _is_debug else logging.INFO
+    logger.setLevel(level)
+    logger.handlers.clear()
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, RateLimitFilter):
+            logger.removeFilter(log_filter)
+
+    if _queue is not None:
+        logger.handlers = [DroppingQueueHandler(_queue)]
+    else:
+        logger.handlers = _create_stream_handlers(level)
     logger.propagate = False
 
+    limits = _get_limits(logger.name)
+    if limits:
+        logger.addFilter(RateLimitFilter(**limits))
+
     logger.debug(f'Logger {logger.name} is ready')
     return logger
 
 
+def _get_limits(name: str) -> typing.Optional[dict]:
+    if _cfg is None:
+        return None
+    # Loggers are configured by their name without the "EmojiManiac." prefix or by the full name
+    return _cfg.loggers.get(name) or _cfg.loggers.get(name.split('.', 1)[-1])
+
+
+def _reinitialize_loggers():
+    for logger in _initialized_loggers:
+        _initialize_logger(logger)
+
+
 def set_debug(debug: bool):
     global _is_debug
     _is_debug = debug
+    _reinitialize_loggers()
+
+
+def is_debug() -> bool:
+    return _is_debug
+
+
+def configure_logging(cfg: 'LoggingConfig'):
+    """
+    Applies the "logging" configuration to the loggers created so far and the ones created later.
+    With `async_handlers` the loggers only put records to a queue and the console is written from
+    a background thread
+    """
+    global _cfg, _queue, _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    _cfg = cfg
+    _queue = None
+    if cfg.async_handlers:
+        _queue = queue.Queue(cfg.queue_size)
+        # Levels are checked by the loggers, so the handlers of the listener take every record
+        _listener = QueueListener(_queue, *_create_stream_handlers(logging.DEBUG), respect_handler_level=True)
+        _listener.start()
+    _reinitialize_loggers()
+
+
+def _stop_listener():
+    if _listener is not None:
+        # Writes out the records that are still in the queue
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
 
 
 def get_logger(name: typing.Union[str, type] = None):
@@ -44,6 +119,7 @@ def get_logger(name: typing.Union[str, type] = None):
 
     if logger not in _initialized_loggers:
         _initialize_logger(logger)
+        _initialized_loggers.append(logger)
 
     return logger
 
@@ -63,9 +139,105 @@ below_warning_filter = LoggingRecordLevelFilter(lambda level: level < logging.WA
 above_warning_filter = LoggingRecordLevelFilter(lambda level: level >= logging.WARNING)
 
 
+class RateLimitFilter(logging.Filter):
+    """
+
+    RateLimitFilter passes a `sample_rate` share of the records of a logger and at most `rate_limit` records
+    per second with bursts of up to `burst` records. Warnings and errors always pass.
+    It runs before the record is formatted, so records logged with %-style arguments that are dropped
+    cost no string formatting
+
+    """
+
+    def __init__(self, sample_rate: float = 1.0, rate_limit: typing.Optional[float] = None,
+                 burst: typing.Optional[int] = None):
+        super(RateLimitFilter, self).__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else max(1, int(rate_limit or 1))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.suppressed += 1
+            return False
+        if self.rate_limit is not None:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_limit)
+            self._updated_at = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+
+    DroppingQueueHandler puts records to a bounded queue and drops them when the queue is full instead of
+    blocking the event loop
+
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord):
+        # Formats the message and the traceback now, the formatter of the listener does the rest
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = base_formatter_instance.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
 class BaseFormatter(logging.Formatter):
     def __init__(self):
         super(BaseFormatter, self).__init__('%(asctime)s %(processName)-10s %(name)s %(levelname)-8s %(message)s')
 
 
-base_formatter_instance = BaseFormatter()
\ No newline at end of file
+# Attributes every LogRecord has, anything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+
+    JsonFormatter writes a record as one line of JSON with its time, level, logger, process and message.
+    Fields passed with `extra` are added as they are
+
+    """
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage(),
+        }
+        for (key, value) in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+base_formatter_instance = BaseFormatter()
+json_formatter_instance = JsonFormatter()
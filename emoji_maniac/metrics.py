@@ -0,0 +1,282 @@
+import bisect
+import functools
+import inspect
+import time
+import typing
+
+from emoji_maniac.log import get_logger
+
+LabelValues = typing.Tuple[str, ...]
+
+# Latency buckets, seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str], extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for (name, value) in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind: str = None
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> typing.List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    _values: typing.Dict[LabelValues, float]
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        super(Counter, self).__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def values(self) -> typing.Dict[LabelValues, float]:
+        return dict(self._values)
+
+    def render(self) -> typing.List[str]:
+        lines = super(Counter, self).render()
+        for (key, value) in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramValue:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets: int):
+        # The last bucket is +Inf
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_key', '_started_at')
+
+    def __init__(self, histogram: 'Histogram', key: LabelValues):
+        self._histogram = histogram
+        self._key = key
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram._observe(self._key, time.perf_counter() - self._started_at)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    _values: typing.Dict[LabelValues, _HistogramValue]
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key: LabelValues, value: float):
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = _HistogramValue(len(self.buckets))
+        entry.counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry.sum += value
+        entry.count += 1
+
+    def time(self, **labels) -> _Timer:
+        """
+        Returns a context manager that observes the time spent in its block
+        """
+        return _Timer(self, self._key(labels))
+
+    def labels(self) -> typing.List[LabelValues]:
+        return list(self._values.keys())
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry.count if entry is not None else 0
+
+    def total(self, **labels) -> float:
+        entry = self._values.get(self._key(labels))
+        return entry.sum if entry is not None else 0
+
+    def quantile(self, q: float, **labels) -> typing.Optional[float]:
+        """
+        Returns the upper bound of the bucket the q-quantile falls into, the largest finite bucket for +Inf
+        """
+        entry = self._values.get(self._key(labels))
+        if entry is None or entry.count == 0:
+            return None
+        rank = q * entry.count
+        seen = 0
+        for (index, count) in enumerate(entry.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def render(self) -> typing.List[str]:
+        lines = super(Histogram, self).render()
+        for (key, entry) in sorted(self._values.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), entry.counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {entry.sum}')
+            lines.append(f'{self.name}_count{labels} {entry.count}')
+        return lines
+
+
+class Registry:
+    """
+
+    Registry keeps metrics of the process and renders them in the Prometheus text format.
+    Metrics are created once by name, asking for an existing name returns the existing metric
+
+    """
+
+    _metrics: typing.Dict[str, Metric]
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get_or_create(self, cls: typing.Type[Metric], name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise TypeError(f'Metric {name} is a {metric.kind}')
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels: typing.Sequence[str] = (),
+                  buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labels, buckets)
+
+    def get(self, name: str) -> typing.Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self._metrics):
+            lines += self._metrics[name].render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def instrument_coroutines(cls: type, names: typing.Iterable[str], histogram: Histogram, errors: Counter,
+                          **labels):
+    """
+    Wraps coroutine methods of the class, including the inherited ones, so their calls are timed by
+    the histogram (labeled with `method` and the given labels) and failures are counted
+    """
+    for name in names:
+        func = getattr(cls, name, None)
+        if not inspect.iscoroutinefunction(func) or getattr(func, '__instrumented__', False):
+            continue
+        key = histogram._key(dict(labels, method=name))
+
+        def wrap(func, key):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc(**dict(zip(histogram.label_names, key)))
+                    raise
+                finally:
+                    histogram._observe(key, time.perf_counter() - started_at)
+            wrapper.__instrumented__ = True
+            return wrapper
+
+        setattr(cls, name, wrap(func, key))
+
+
+class MetricsServer:
+    """
+
+    MetricsServer serves the registry in the Prometheus text format at /metrics
+
+    """
+
+    def __init__(self, registry: Registry, host: str, port: int):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._runner = None
+        self.log = get_logger(MetricsServer)
+
+    async def start(self):
+        from aiohttp import web
+
+        async def handle(_):
+            return web.Response(body=self._registry.render().encode('utf-8'),
+                                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        self.log.info(f'Serving metrics at http://{self._host}:{self._port}/metrics')
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
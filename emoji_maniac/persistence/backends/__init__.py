@@ -0,0 +1,16 @@
+import importlib
+import typing
+
+# Backends are imported on demand, so only the dependencies of the configured one are needed
+BACKENDS = {
+    'motor': 'emoji_maniac.persistence.backends.motor:MotorEmojiBackend',
+    'memory': 'emoji_maniac.persistence.backends.memory:MemoryEmojiBackend',
+    'sqlite': 'emoji_maniac.persistence.backends.sqlite:SQLiteEmojiBackend',
+}
+
+
+def get_backend_class(name: str) -> typing.Type:
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown emoji backend "{name}", available backends: {", ".join(BACKENDS.keys())}')
+    module_name, class_name = BACKENDS[name].split(':')
+    return getattr(importlib.import_module(module_name), class_name)
@@ -0,0 +1,213 @@
+import heapq
+import time
+import typing
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import discord
+
+from emoji_maniac.bot.config import Config
+from emoji_maniac.persistence.counters import Counters
+from emoji_maniac.persistence.emoji_backend import EmojiBackend, EmojiSource, Emoji, MessageEmoji
+from emoji_maniac.persistence.models import StatsEmoji
+
+
+class _RawEvent(typing.NamedTuple):
+    gld_id: int
+    msg_id: int
+    usr_id: int
+    src_uid: str
+    count: int
+    is_reaction: bool
+    emoji_uid: str
+    at: datetime
+
+
+class MemoryEmojiBackend(EmojiBackend):
+    """
+
+    MemoryEmojiBackend keeps everything in process memory, nothing survives a restart.
+    It is meant for local development, tests and as a reference point for benchmarks
+
+    """
+
+    # (guild id, user id or None for guild-wide counters, period) -> {emoji uid: hits}
+    _counters: typing.Dict[typing.Tuple[int, typing.Optional[int], str], typing.Dict[str, int]]
+    _events: typing.List[_RawEvent]
+    _cache: typing.Dict[str, typing.Tuple[float, typing.Any]]
+    _persistent: typing.Dict[typing.Tuple[str, typing.Any], dict]
+    in_process = True
+
+    def __init__(self, config: Config):
+        super(MemoryEmojiBackend, self).__init__(config)
+        self._counters = {}
+        self._events = []
+        self._cache = {}
+        self._persistent = {}
+
+    def _increment(self, guild_id: int, user_id: int, values: typing.Dict[str, int], periods: typing.Iterable[str]):
+        for period in periods:
+            for key in ((guild_id, None, period), (guild_id, user_id, period)):
+                counters = self._counters.setdefault(key, {})
+                for (emoji_uid, hits) in values.items():
+                    counters[emoji_uid] = counters.get(emoji_uid, 0) + hits
+
+    async def _submit_counters(self, guild_id: int, user_id: int, values: typing.Dict[str, int]):
+        tz = await self.get_guild_tz(guild_id)
+        self._increment(guild_id, user_id, values, Counters.period_modifiers(tz))
+        await self.invalidate_stats_cache(guild_id)
+
+    async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self._submit_counters(guild_id, user_id, {emoji_obj.uid: 1})
+
+    async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self._submit_counters(guild_id, user_id, {emoji_obj.uid: -1})
+
+    async def submit_message(self, message: discord.Message, emojis: typing.List[MessageEmoji]):
+        values = {}
+        for em in emojis:
+            values[em.uid] = values.get(em.uid, 0) + em.count
+        await self._submit_counters(message.guild.id, message.author.id, values)
+
+    async def submit_history(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]]):
+        await self._write_history(records, True)
+
+    async def update_counters(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]]):
+        await self._write_history(records, False)
+
+    async def _write_history(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]],
+                             raw_events: bool):
+        written = set()
+        for (source, emoji_obj, at) in records:
+            tz = await self.get_guild_tz(source.guild_id)
+            self._increment(source.guild_id, source.user_id, {emoji_obj.uid: emoji_obj.count},
+                            Counters.period_modifiers(tz, at))
+            if raw_events:
+                self._events.append(self._make_event(source, emoji_obj, at))
+            written.add(source.guild_id)
+        for guild_id in written:
+            await self.invalidate_stats_cache(guild_id)
+
+    def _top10(self, guild_id: int, user_id: typing.Optional[int], period: str) -> typing.List[StatsEmoji]:
+        counters = self._counters.get((guild_id, user_id, period), {})
+        top = heapq.nlargest(10, ((uid, hits) for (uid, hits) in counters.items() if hits > 0), key=itemgetter(1))
+        return self._make_stats(top)
+
+    async def get_emojis_top10(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        return self._top10(guild_id, user_id, 'total')
+
+    async def get_emojis_top10_yearly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return self._top10(guild_id, user_id, Counters.year_modifier(tz))
+
+    async def get_emojis_top10_monthly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return self._top10(guild_id, user_id, Counters.month_modifier(tz))
+
+    async def get_emojis_top10_weekly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return self._top10(guild_id, user_id, Counters.week_modifier(tz))
+
+    async def get_emojis_top10_daily(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return self._top10(guild_id, user_id, Counters.day_modifier(tz))
+
+    @staticmethod
+    def _make_event(source: EmojiSource, emoji_obj: MessageEmoji, at: datetime = None) -> _RawEvent:
+        return _RawEvent(
+            gld_id=source.guild_id,
+            msg_id=source.message_id,
+            usr_id=source.user_id,
+            src_uid=source.uid,
+            count=emoji_obj.count,
+            is_reaction=source.reaction,
+            emoji_uid=emoji_obj.uid,
+            at=at or datetime.utcnow()
+        )
+
+    async def submit_emoji(self, source: EmojiSource, emoji_obj: MessageEmoji):
+        self._events.append(self._make_event(source, emoji_obj))
+
+    async def submit_bulk(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji]]):
+        self._events += [self._make_event(s, e) for (s, e) in records]
+
+    async def remove_emoji_source(self, source: EmojiSource):
+        self._events = [e for e in self._events if e.src_uid != source.uid]
+
+    async def remove_emoji(self, source: EmojiSource, emoji_obj: Emoji):
+        uid = emoji_obj.uid
+        self._events = [
+            e for e in self._events
+            if not (e.src_uid == source.uid and e.is_reaction == source.reaction and e.emoji_uid == uid)
+        ]
+
+    async def get_stored_messages(self, guild_id: int, message_ids: typing.Collection[int]) -> typing.Set[int]:
+        message_ids = set(message_ids)
+        return {e.msg_id for e in self._events
+                if e.gld_id == guild_id and not e.is_reaction and e.msg_id in message_ids}
+
+    async def get_emojis_top(self, guild_id: int = None, last_n_days: int = None,
+                             user_id: int = None, limit: int = None) -> typing.List[StatsEmoji]:
+        since = None if last_n_days is None else datetime.utcnow() - timedelta(days=last_n_days)
+        counts = {}
+        for e in self._events:
+            if guild_id is not None and e.gld_id != guild_id or user_id is not None and e.usr_id != user_id:
+                continue
+            if since is not None and e.at <= since:
+                continue
+            counts[e.emoji_uid] = counts.get(e.emoji_uid, 0) + e.count
+        if limit is None:
+            top = sorted(counts.items(), key=itemgetter(1), reverse=True)
+        else:
+            top = heapq.nlargest(max(limit, 1), counts.items(), key=itemgetter(1))
+        return self._make_stats(top)
+
+    async def _put_cache(self, key: str, value, age: timedelta):
+        self._cache[key] = (time.monotonic() + age.total_seconds(), value)
+
+    async def _get_cache(self, key: str):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._cache[key]
+            return None
+        return entry[1]
+
+    async def _clear_cache(self):
+        self._cache.clear()
+
+    async def _invalidate_cache(self, prefixes: typing.List[str]):
+        prefixes = tuple(prefixes)
+        for key in [key for key in self._cache.keys() if key.startswith(prefixes)]:
+            del self._cache[key]
+
+    async def get_persistent_config(self, name: str, key: str):
+        return self._get_persistent_config('custom', name, key)
+
+    async def update_persistent_config(self, name: str, data: dict, override: bool = False):
+        self._update_persistent_config('custom', name, data, override)
+
+    async def get_guild_config(self, guild_id: int, key: str = None):
+        return self._get_persistent_config('guild', guild_id, key)
+
+    async def _update_guild_config(self, guild_id: int, data: dict, override: bool = False):
+        self._update_persistent_config('guild', guild_id, data, override)
+
+    async def has_guild_config(self, guild_id: int) -> bool:
+        return ('guild', guild_id) in self._persistent
+
+    def _get_persistent_config(self, domain: str, name, key: str):
+        doc = self._persistent.get((domain, name))
+        if key is None:
+            return None if doc is None else dict(doc)
+        if doc:
+            return doc.get(key)
+        else:
+            return None
+
+    def _update_persistent_config(self, domain: str, name, data: dict, override: bool = False):
+        if override or (domain, name) not in self._persistent:
+            self._persistent[(domain, name)] = {'_id': name, **data}
+        else:
+            self._persistent[(domain, name)].update(data)
@@ -1,18 +1,28 @@
 import asyncio
+import heapq
 import pickle
+import re
+import time
 import typing
-from dataclasses import dataclass, field, asdict
+import uuid
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from itertools import product
-from math import ceil
+from operator import itemgetter
 
-import emoji
 import discord
-from pymongo import UpdateOne
+from pymongo import InsertOne, UpdateOne, ReplaceOne, IndexModel, ASCENDING, DESCENDING, WriteConcern
+from pymongo.errors import BulkWriteError, OperationFailure
 
-from emoji_maniac.bot.config import Config
-from emoji_maniac.persistence.emoji_backend import EmojiBackend, EmojiSource, Emoji, MessageEmoji
-from emoji_maniac.persistence.models import StatsEmoji
+from emoji_maniac.bot.config import Config, RetentionConfig
+from emoji_maniac.persistence.emoji_backend import EmojiBackend, EmojiSource, Emoji, MessageEmoji, RetentionStats, \
+    PartialWriteError
+from emoji_maniac.persistence.counters import Counters
+from emoji_maniac.persistence.leaderboard import Leaderboards
+from emoji_maniac.persistence.backends.motor_monitoring import CommandMonitor
+from emoji_maniac.persistence.models import StatsEmoji, EmojiBatch, HistoryRecord, MODEL_OPTIONS, source_uid
+from emoji_maniac.persistence.write_behind import CounterBuffer, PartialFlushError
 
 try:
     import motor.motor_asyncio as mas
@@ -23,15 +33,189 @@ except Exception as e:
 
 DEFAULT_MONGODB_URI = 'mongodb://localhost:27017'
 DEFAULT_MONGODB_NAME = 'emoji_maniac'
+COUNTER_MODES = ('periods', 'daily')
+# Persistent config (ds_cfg_custom) that records the counter mode the data is stored in
+COUNTER_MODE_CONFIG = 'counters'
+# Day (yyyymmdd), week (yyyymmw) and month (yyyymm) suffixes of ds_emoji_gld_counters names
+PERIOD_COUNTER_NAME = re.compile(r'^(.+)_(\d{8}|\d{7}|\d{6})$')
+# Daily counters of a month are folded only once the whole month is older than this
+MIN_DAY_COUNTERS_DAYS = 31
+# Raw events of a day are aggregated into its ds_emoji_day_partials documents this long after the day ended
+WINDOW_CLOSE_DELAY = timedelta(minutes=5)
+# Error code of unique index violations, e.g. when a unique index is built over duplicate documents
+DUPLICATE_KEY = 11000
+# (collection, bulk write requests, leaderboard deltas of counter requests or None)
+WritePart = typing.Tuple[str, list, typing.Optional[typing.List[typing.Tuple[dict, int]]]]
+# Lifetime of the ds_cache token that changes whenever day partials of a guild are dropped
+PARTIALS_VERSION_AGE = timedelta(days=1)
 
 
 @dataclass
 class MotorConfig:
     uri: str = DEFAULT_MONGODB_URI
     dbname: str = DEFAULT_MONGODB_NAME
+    write_behind: bool = False
+    write_behind_flush_interval: float = 1.0
+    write_behind_max_keys: int = 5000
+    write_behind_log_stats: bool = False
+    check_query_plans: bool = False
+    # "periods" writes total, year, month, week and day counters for every emoji hit, "daily" writes only
+    # total and daily counters and sums daily counters up at query time.
+    # Existing data is converted with python -m emoji_maniac.persistence.backends.motor_migrate
+    counter_mode: str = 'periods'
+    # Sums of the days before today do not change, so they are cached for a long time
+    rollup_cache_ttl: int = 3600
+    # Answer top-10 queries from top-K leaderboards kept in memory and updated with written counter deltas
+    leaderboards: bool = False
+    leaderboard_size: int = 50
+    leaderboard_max_boards: int = 10000
+    # Record duration, collection, operation and document count of a sample of commands
+    command_monitoring: bool = False
+    command_sample_rate: float = 1.0
+    # Recorded commands slower than this are logged by EmojiManiac.SlowQuery with the shape of their query
+    slow_query_ms: float = 100
+    # Store raw emoji events in ds_emoji_buckets, one document per guild and hour with an array of compact
+    # entries, instead of a ds_emojies document per event. Events already in ds_emojies are still read
+    event_buckets: bool = False
+    # Entries per bucket document, a full bucket is continued in a new document of the same hour
+    event_bucket_size: int = 1000
+    # Answer get_emojis_top of the last N days from per-day partial aggregates of closed days kept in
+    # ds_emoji_day_partials and raw events of the first and of the current day only
+    window_partials: bool = True
+    # Connection pool of the client all writes go through, None keeps the driver defaults
+    max_pool_size: typing.Optional[int] = None
+    min_pool_size: typing.Optional[int] = None
+    # Write concern of counter and event writes (w, e.g. 1 or "majority", and wtimeout), None keeps the
+    # server default
+    write_concern: typing.Optional[typing.Union[int, str]] = None
+    write_concern_timeout_ms: typing.Optional[int] = None
+    write_concern_journal: typing.Optional[bool] = None
+    # Stats reads (top-10 and top queries) use a separate client with its own pool and this read preference,
+    # e.g. secondaryPreferred. Secondaries may lag up to max_staleness seconds (at least 90, -1 for no limit),
+    # sums of the previous days are cached, so they may miss writes of that lag for up to rollup_cache_ttl
+    read_preference: str = 'primary'
+    max_staleness: int = -1
+    read_max_pool_size: typing.Optional[int] = None
+    # Server time limit of stats reads per operation in ms ("top10" for counters, "top" for raw events)
+    max_time_ms: typing.Dict[str, int] = field(default_factory=dict)
 
 
-@dataclass
+INDEXES = {
+    'ds_emoji_counters': [
+        IndexModel([('gld_id', ASCENDING), ('period', ASCENDING), ('usr_id', ASCENDING), ('emoji_uid', ASCENDING)],
+                   name='counter_key', unique=True),
+        IndexModel([('gld_id', ASCENDING), ('period', ASCENDING), ('usr_id', ASCENDING), ('hits', DESCENDING)],
+                   name='user_top'),
+        IndexModel([('gld_id', ASCENDING), ('period', ASCENDING), ('hits', DESCENDING)], name='guild_top'),
+    ],
+    'ds_emoji_daily': [
+        IndexModel([('gld_id', ASCENDING), ('day', ASCENDING), ('usr_id', ASCENDING), ('emoji_uid', ASCENDING)],
+                   name='counter_key', unique=True),
+        IndexModel([('gld_id', ASCENDING), ('usr_id', ASCENDING), ('day', ASCENDING)], name='user_days'),
+    ],
+    'ds_emojies': [
+        IndexModel([('src_uid', ASCENDING)], name='source'),
+        IndexModel([('gld_id', ASCENDING), ('usr_id', ASCENDING), ('at', ASCENDING)], name='user_events'),
+        IndexModel([('gld_id', ASCENDING), ('at', ASCENDING)], name='guild_events'),
+    ],
+    'ds_emoji_day_partials': [
+        IndexModel([('gld_id', ASCENDING), ('usr_id', ASCENDING), ('day', ASCENDING)], name='partial_key',
+                   unique=True),
+        IndexModel([('gld_id', ASCENDING), ('day', ASCENDING)], name='guild_days'),
+    ],
+    'ds_emoji_buckets': [
+        IndexModel([('gld_id', ASCENDING), ('hour', ASCENDING), ('n', ASCENDING)], name='guild_hours'),
+    ],
+    'ds_cache': [
+        IndexModel([('expires_at', ASCENDING)], name='expiration', expireAfterSeconds=0),
+    ],
+}
+
+# Query shapes that are explained when MotorConfig.check_query_plans is enabled, (name, collection, command)
+QUERY_SHAPES = [
+    ('user top10', 'ds_emoji_counters', {
+        'find': 'ds_emoji_counters', 'filter': {'gld_id': 0, 'period': 'total', 'usr_id': 0},
+        'sort': {'hits': -1}, 'limit': 10
+    }),
+    ('guild top10', 'ds_emoji_counters', {
+        'find': 'ds_emoji_counters', 'filter': {'gld_id': 0, 'period': 'total'}, 'sort': {'hits': -1}, 'limit': 10
+    }),
+    ('user daily rollup', 'ds_emoji_daily', {
+        'aggregate': 'ds_emoji_daily', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'usr_id': 0, 'day': {'$gte': 0, '$lte': 0}}},
+            {'$group': {'_id': '$emoji_uid', 'hits': {'$sum': '$hits'}}}
+        ]
+    }),
+    ('guild daily rollup', 'ds_emoji_daily', {
+        'aggregate': 'ds_emoji_daily', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'day': {'$gte': 0, '$lte': 0}}},
+            {'$group': {'_id': '$emoji_uid', 'hits': {'$sum': '$hits'}}}
+        ]
+    }),
+    ('guild leaderboard', 'ds_emoji_counters', {
+        'aggregate': 'ds_emoji_counters', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'period': 'total'}},
+            {'$group': {'_id': '$emoji_uid', 'hits': {'$sum': '$hits'}}},
+            {'$sort': {'hits': -1}},
+            {'$limit': 51}
+        ]
+    }),
+    ('emoji source lookup', 'ds_emojies', {
+        'find': 'ds_emojies', 'filter': {'src_uid': ''}
+    }),
+    ('user emojis top', 'ds_emojies', {
+        'aggregate': 'ds_emojies', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'usr_id': 0, 'at': {'$gt': datetime(1970, 1, 1)}}},
+            {'$group': {'_id': '$emoji_uid', 'count': {'$sum': '$count'}}}
+        ]
+    }),
+    ('guild emojis top', 'ds_emojies', {
+        'aggregate': 'ds_emojies', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'at': {'$gt': datetime(1970, 1, 1)}}},
+            {'$group': {'_id': '$emoji_uid', 'count': {'$sum': '$count'}}}
+        ]
+    }),
+    ('guild emojis top (buckets)', 'ds_emoji_buckets', {
+        'aggregate': 'ds_emoji_buckets', 'cursor': {}, 'pipeline': [
+            {'$match': {'gld_id': 0, 'hour': {'$gte': datetime(1970, 1, 1)}}},
+            {'$unwind': '$ev'},
+            {'$group': {'_id': '$ev.e', 'count': {'$sum': '$ev.c'}}}
+        ]
+    }),
+    ('guild day partials', 'ds_emoji_day_partials', {
+        'find': 'ds_emoji_day_partials', 'filter': {'gld_id': 0, 'usr_id': None, 'day': {'$gte': 0, '$lte': 0}}
+    }),
+    ('emoji source lookup (buckets)', 'ds_emoji_buckets', {
+        'find': 'ds_emoji_buckets', 'filter': {'gld_id': 0, 'hour': {'$gte': datetime(1970, 1, 1)}, 'ev.m': 0}
+    }),
+]
+
+
+# Period kind -> key of the current period in the given timezone
+PERIOD_MODIFIERS = {
+    'year': Counters.year_modifier,
+    'month': Counters.month_modifier,
+    'week': Counters.week_modifier,
+    'day': Counters.day_modifier,
+}
+
+
+def _winning_plan_stages(explain: typing.Any, inside_plan: bool = False) -> typing.List[str]:
+    stages = []
+    if isinstance(explain, dict):
+        if inside_plan and 'stage' in explain:
+            stages.append(explain['stage'])
+        for (key, value) in explain.items():
+            if key in ('rejectedPlans', 'allPlansExecution'):
+                continue
+            stages += _winning_plan_stages(value, inside_plan or key in ('winningPlan', 'queryPlan'))
+    elif isinstance(explain, list):
+        for value in explain:
+            stages += _winning_plan_stages(value, inside_plan)
+    return stages
+
+
+@dataclass(**MODEL_OPTIONS)
 class EmojiEntry:
     gld_id: int
     msg_id: int
@@ -44,7 +228,7 @@ class EmojiEntry:
     at: datetime = field(default_factory=datetime.utcnow)
 
     @classmethod
-    def create(cls, source: EmojiSource, emoji_obj: MessageEmoji) -> 'EmojiEntry':
+    def create(cls, source: EmojiSource, emoji_obj: MessageEmoji, at: datetime = None) -> 'EmojiEntry':
         return EmojiEntry(
             gld_id=source.guild_id,
             usr_id=source.user_id,
@@ -52,103 +236,339 @@ class EmojiEntry:
             src_uid=source.uid,
             count=emoji_obj.count,
             emoji_uid=emoji_obj.uid,
-            is_reaction=source.reaction
+            is_reaction=source.reaction,
+            at=at if at is not None else datetime.utcnow()
         )
 
-
-class _Counters:
     @staticmethod
-    def _week_number_util(dt):
-        first_day = dt.replace(day=1)
+    def document(guild_id: int, message_id: int, user_id: int, reaction: bool, emoji_uid: str, count: int,
+                 at: datetime) -> dict:
+        """
+        Returns the ds_emojies document of an emoji without creating an EmojiEntry, the fields are the same
+        as the ones of the dataclass
+        """
+        return {
+            'gld_id': guild_id,
+            'msg_id': message_id,
+            'usr_id': user_id,
+            'src_uid': source_uid(reaction, guild_id, user_id, message_id),
+            'count': count,
+            'is_reaction': reaction,
+            'emoji_uid': emoji_uid,
+            'at': at,
+        }
 
-        dom = dt.day
-        adjusted_dom = dom + first_day.weekday()
+    @classmethod
+    def source_document(cls, source: EmojiSource, emoji_obj: MessageEmoji, at: datetime = None) -> dict:
+        return cls.document(source.guild_id, source.message_id, source.user_id, source.reaction, emoji_obj.uid,
+                            emoji_obj.count, at if at is not None else datetime.utcnow())
 
-        return int(ceil(adjusted_dom / 7.0))
+    def to_doc(self) -> dict:
+        return {
+            'gld_id': self.gld_id,
+            'msg_id': self.msg_id,
+            'usr_id': self.usr_id,
+            'src_uid': self.src_uid,
+            'count': self.count,
+            'is_reaction': self.is_reaction,
+            'emoji_uid': self.emoji_uid,
+            'at': self.at,
+        }
 
-    @classmethod
-    def period_modifiers(cls, tz: timezone):
-        now = datetime.now(tz)
-        year = str(now.year)
-        month = str(now.year * 100 + now.month)
-        week = str(now.year * 1000 + now.month * 10 + cls._week_number_util(now))
-        day = str(now.year * 10000 + now.month * 100 + now.day)
-        return 'total', year, month, week, day
 
-    @staticmethod
-    def year_modifier(tz: timezone):
-        return str(datetime.now(tz).year)
+def _hour(at: datetime) -> datetime:
+    return at.replace(minute=0, second=0, microsecond=0)
 
-    @staticmethod
-    def month_modifier(tz: timezone):
-        now = datetime.now(tz)
-        return str(now.year * 100 + now.month)
 
-    @classmethod
-    def week_modifier(cls, tz: timezone):
-        now = datetime.now(tz)
-        return str(now.year * 1000 + now.month * 10 + cls._week_number_util(now))
+def _utc_day(at: datetime) -> datetime:
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    @staticmethod
-    def day_modifier(tz: timezone):
-        now = datetime.now(tz)
-        return str(now.year * 10000 + now.month * 100 + now.day)
 
-    @classmethod
-    def guild_counters(cls, guild_id: int, tz: timezone):
-        return [
-            f'g{guild_id}_' + item
-            for item in cls.period_modifiers(tz)
-        ]
+def _utc_day_of_key(day: int) -> datetime:
+    return datetime.combine(Counters.date_of_key(day), datetime.min.time())
 
-    @classmethod
-    def user_counters(cls, guild_id: int, user_id: int, tz: timezone):
-        return [
-            f'u{guild_id}-{user_id}_' + item
-            for item in cls.period_modifiers(tz)
-        ]
 
-    @classmethod
-    def emoji_counters(cls, emoji_uid: str, guild_id: int, tz: timezone):
-        return [(f'{emoji_uid}-{guild_id}', mod) for mod in cls.period_modifiers(tz)]
+def bucket_updates(documents: typing.Iterable[dict], bucket_size: int) -> typing.List[UpdateOne]:
+    """
+    Groups ds_emojies documents by guild and hour and returns upserts that push them as compact entries
+    (u: user id, e: emoji uid, c: count, m: message id, r: reaction) into ds_emoji_buckets. An upsert
+    goes to a bucket of the hour with less than `bucket_size` entries or creates a new one, so the size
+    is a soft cap: a bucket can end up with up to `bucket_size` - 1 entries more
+    """
+    buckets = {}
+    for doc in documents:
+        key = (doc['gld_id'], _hour(doc['at']))
+        buckets.setdefault(key, []).append({
+            'u': doc['usr_id'], 'e': doc['emoji_uid'], 'c': doc['count'], 'm': doc['msg_id'], 'r': doc['is_reaction']
+        })
+    updates = []
+    for ((guild_id, hour), entries) in buckets.items():
+        for start in range(0, len(entries), bucket_size):
+            chunk = entries[start:start + bucket_size]
+            updates.append(UpdateOne(
+                {'gld_id': guild_id, 'hour': hour, 'n': {'$lt': bucket_size}},
+                {'$push': {'ev': {'$each': chunk}}, '$inc': {'n': len(chunk)}},
+                upsert=True
+            ))
+    return updates
 
 
 class MotorEmojiBackend(EmojiBackend):
     motor_client: mas.AsyncIOMotorClient
+    # Client of stats reads, the same as motor_client if reads go to the primary with the shared pool
+    read_client: mas.AsyncIOMotorClient
     _cfg: MotorConfig
     _db_name: str
     _db: mas.AsyncIOMotorDatabase
+    _read_db: mas.AsyncIOMotorDatabase
+    _counter_buffer: typing.Optional[CounterBuffer] = None
+    _daily: bool
+    _leaderboards: typing.Optional[Leaderboards] = None
+    _command_monitor: typing.Optional[CommandMonitor] = None
 
     def __init__(self, config: Config):
         super(MotorEmojiBackend, self).__init__(config)
         self._cfg = config.require_backend_config_as('motor', MotorConfig)
+        if self._cfg.counter_mode not in COUNTER_MODES:
+            raise ValueError(f'Unknown counter mode "{self._cfg.counter_mode}", '
+                             f'must be one of: {", ".join(COUNTER_MODES)}')
+        self._daily = self._cfg.counter_mode == 'daily'
         self.log.info(f'MongoDB uri = {self._cfg.uri}, dbname = {self._cfg.dbname}')
-        self.motor_client = mas.AsyncIOMotorClient(self._cfg.uri)
-        self._db = self.motor_client[self._cfg.dbname]
+        listeners = []
+        if self._cfg.command_monitoring:
+            self._command_monitor = CommandMonitor(self._cfg.slow_query_ms, self._cfg.command_sample_rate)
+            listeners.append(self._command_monitor)
+        self.motor_client = mas.AsyncIOMotorClient(self._cfg.uri, event_listeners=listeners, **self._pool_options(
+            self._cfg.max_pool_size, self._cfg.min_pool_size))
+        self._db = self.motor_client.get_database(self._cfg.dbname, write_concern=self._write_concern())
+        if self._cfg.read_preference == 'primary' and self._cfg.read_max_pool_size is None:
+            self.read_client = self.motor_client
+        else:
+            self.log.info(f'Stats reads use read preference {self._cfg.read_preference}, '
+                          f'max staleness {self._cfg.max_staleness}s')
+            self.read_client = mas.AsyncIOMotorClient(
+                self._cfg.uri, event_listeners=listeners, readPreference=self._cfg.read_preference,
+                maxStalenessSeconds=self._cfg.max_staleness, **self._pool_options(self._cfg.read_max_pool_size))
+        self._read_db = self.read_client[self._cfg.dbname]
+        if self._cfg.write_behind:
+            self._counter_buffer = CounterBuffer(
+                self._flush_counters,
+                flush_interval=self._cfg.write_behind_flush_interval,
+                max_keys=self._cfg.write_behind_max_keys,
+                log_stats=self._cfg.write_behind_log_stats
+            )
+        if self._cfg.leaderboards:
+            self._leaderboards = Leaderboards(self._cfg.leaderboard_size, self._cfg.leaderboard_max_boards)
+
+    @staticmethod
+    def _pool_options(max_pool_size: typing.Optional[int], min_pool_size: typing.Optional[int] = None) -> dict:
+        options = {}
+        if max_pool_size is not None:
+            options['maxPoolSize'] = max_pool_size
+        if min_pool_size is not None:
+            options['minPoolSize'] = min_pool_size
+        return options
+
+    def _write_concern(self) -> typing.Optional[WriteConcern]:
+        cfg = self._cfg
+        if cfg.write_concern is None and cfg.write_concern_timeout_ms is None and cfg.write_concern_journal is None:
+            return None
+        return WriteConcern(w=cfg.write_concern, wtimeout=cfg.write_concern_timeout_ms, j=cfg.write_concern_journal)
+
+    def _time_limit(self, operation: str, option: str = 'max_time_ms') -> dict:
+        """
+        Returns the keyword argument that limits the server time of a stats read, `maxTimeMS` for aggregations
+        """
+        max_time_ms = self._cfg.max_time_ms.get(operation)
+        return {option: max_time_ms} if max_time_ms else {}
 
     async def init(self):
-        pass
+        await self._check_counter_mode()
+        if self._counter_buffer is not None:
+            self._counter_buffer.start()
+        await self._ensure_indexes()
+        if self._cfg.check_query_plans:
+            await self.check_query_plans()
+
+    async def _check_counter_mode(self):
+        stored = await self.get_persistent_config(COUNTER_MODE_CONFIG, 'mode')
+        if stored is None:
+            # Databases created before counter modes existed use the periods layout
+            if await self._db.ds_emoji_counters.find_one({}, projection=['_id']) is not None:
+                stored = 'periods'
+            else:
+                stored = self._cfg.counter_mode
+            await self.update_persistent_config(COUNTER_MODE_CONFIG, {'mode': stored})
+        if stored != self._cfg.counter_mode:
+            raise RuntimeError(f'Counters are stored in "{stored}" mode, but counter_mode is '
+                               f'"{self._cfg.counter_mode}". Change the configuration or migrate the data: python -m '
+                               f'emoji_maniac.persistence.backends.motor_migrate --to {self._cfg.counter_mode}')
+
+    async def _ensure_indexes(self):
+        collections = list(INDEXES.keys())
+        results = await asyncio.gather(*(
+            self._db[collection].create_indexes(INDEXES[collection]) for collection in collections
+        ), return_exceptions=True)
+        duplicates = []
+        for (collection, result) in zip(collections, results):
+            if isinstance(result, OperationFailure) and result.code == DUPLICATE_KEY:
+                duplicates.append(collection)
+            elif isinstance(result, Exception):
+                self.log.error(f'Failed to create indexes on {collection}: {result}')
+        if duplicates:
+            # Upserts of counters without the unique index would keep adding to arbitrary duplicates
+            raise RuntimeError(f'Unique indexes cannot be built, {", ".join(duplicates)} contain duplicate documents. '
+                               f'Stop the bot and merge them: python -m '
+                               f'emoji_maniac.persistence.backends.motor_migrate --merge-duplicates')
+
+        existing = await asyncio.gather(*(
+            self._db[collection].index_information() for collection in collections
+        ), return_exceptions=True)
+        for (collection, indexes) in zip(collections, existing):
+            if isinstance(indexes, Exception):
+                self.log.error(f'Failed to list indexes of {collection}: {indexes}')
+                continue
+            missing = [model.document['name'] for model in INDEXES[collection] if model.document['name'] not in indexes]
+            if missing:
+                self.log.warning(f'Collection {collection} is missing indexes: {", ".join(missing)}')
+
+    async def check_query_plans(self) -> typing.Dict[str, typing.List[str]]:
+        """
+        Explains every known query shape and warns about the ones that are not covered by an index
+        """
+        results = await asyncio.gather(*(
+            self._db.command('explain', command, verbosity='queryPlanner') for (_, _, command) in QUERY_SHAPES
+        ), return_exceptions=True)
+        plans = {}
+        for ((name, collection, _), explain) in zip(QUERY_SHAPES, results):
+            if isinstance(explain, Exception):
+                self.log.error(f'Failed to explain "{name}" query on {collection}: {explain}')
+                continue
+            stages = _winning_plan_stages(explain)
+            plans[name] = stages
+            if 'COLLSCAN' in stages:
+                self.log.warning(f'Query "{name}" on {collection} is not covered by an index (collection scan)')
+            elif 'SORT' in stages:
+                self.log.warning(f'Query "{name}" on {collection} sorts in memory')
+            else:
+                self.log.debug(f'Query "{name}" on {collection}: {" <- ".join(stages)}')
+        return plans
+
+    async def close(self):
+        if self._counter_buffer is not None:
+            await self._counter_buffer.close()
+        if self.read_client is not self.motor_client:
+            self.read_client.close()
+        self.motor_client.close()
+
+    @property
+    def counter_buffer_stats(self):
+        if self._counter_buffer is None:
+            return None
+        return self._counter_buffer.stats
+
+    @property
+    def leaderboard_stats(self):
+        if self._leaderboards is None:
+            return None
+        return self._leaderboards.stats
+
+    @property
+    def command_stats(self):
+        """
+        Per-operation stats of the recorded MongoDB commands, None unless command_monitoring is enabled
+        """
+        if self._command_monitor is None:
+            return None
+        return self._command_monitor.stats
+
+    @property
+    def stats_cacheable(self) -> bool:
+        return self._leaderboards is None
+
+    async def _flush_counters(self, collection: str, documents: typing.List[typing.Tuple[dict, typing.Dict[str, int]]]):
+        failed = set()
+        try:
+            await self._db[collection].bulk_write([
+                UpdateOne(filter_, {'$inc': inc}, upsert=True) for (filter_, inc) in documents
+            ], ordered=False)
+        except BulkWriteError as exc:
+            # Unordered bulk writes apply every update but the failed ones
+            failed = {error['index'] for error in exc.details.get('writeErrors', [])}
+            if not failed:
+                raise
+        if collection in ('ds_emoji_counters', 'ds_emoji_daily'):
+            applied = [document for (index, document) in enumerate(documents) if index not in failed]
+            self._apply_leaderboard_deltas((filter_, inc['hits']) for (filter_, inc) in applied)
+            try:
+                for guild_id in {filter_['gld_id'] for (filter_, _) in applied}:
+                    await self.invalidate_stats_cache(guild_id)
+            except Exception as exc:
+                # The counters are written, so the deltas must not be retried
+                self.log.error(f'Failed to invalidate stats cache after flushing {collection}: {exc}')
+        if failed:
+            raise PartialFlushError(f'{len(failed)} of {len(documents)} updates of {collection} failed', failed)
 
     async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
         # Increment counters
         tz = await self.get_guild_tz(guild_id)
-        counters = _Counters.guild_counters(guild_id, tz) + _Counters.user_counters(guild_id, user_id, tz)
+        counters = Counters.guild_counters(guild_id, tz, daily=self._daily) + \
+                   Counters.user_counters(guild_id, user_id, tz, daily=self._daily)
         await self._update_guild_counters(counters, {emoji_obj.uid: 1})
 
         # Increment per-emoji counters
         await self._increment_emoji_counters(guild_id, user_id, {emoji_obj.uid: 1})
 
+    def _period_modifiers(self, tz: timezone, at: datetime = None):
+        if self._daily:
+            return Counters.daily_modifiers(tz, at)
+        return Counters.period_modifiers(tz, at)
+
+    def _emoji_counter(self, guild_id: int, user_id: int, emoji_uid: str, period: str) -> typing.Tuple[str, dict]:
+        """
+        Returns collection and filter of the per-emoji counter
+        """
+        filter_ = {'usr_id': user_id, 'emoji_uid': emoji_uid, 'gld_id': guild_id}
+        if self._daily and period != 'total':
+            filter_['day'] = int(period)
+            return 'ds_emoji_daily', filter_
+        filter_['period'] = period
+        return 'ds_emoji_counters', filter_
+
     async def _increment_emoji_counters(self, guild_id: int, user_id: int, emojis: typing.Dict[str, int]):
-        updates = []
         tz = await self.get_guild_tz(guild_id)
+        periods = self._period_modifiers(tz)
+        if self._counter_buffer is not None:
+            for (emoji_uid, hits) in emojis.items():
+                for period in periods:
+                    collection, filter_ = self._emoji_counter(guild_id, user_id, emoji_uid, period)
+                    self._counter_buffer.add(collection, (user_id, emoji_uid, guild_id, period), filter_,
+                                             {'hits': hits})
+            return
+
+        updates = {}
+        deltas = []
         for (emoji_uid, hits) in emojis.items():
-            updates = [
-                UpdateOne(
-                    {'usr_id': user_id, 'emoji_uid': emoji_uid, 'gld_id': guild_id, 'period': period},
-                    {'$inc': {'hits': hits}}, upsert=True)
-                for period in _Counters.period_modifiers(tz)
-            ]
-        await self._db.ds_emoji_counters.bulk_write(updates)
+            for period in periods:
+                collection, filter_ = self._emoji_counter(guild_id, user_id, emoji_uid, period)
+                updates.setdefault(collection, []).append(UpdateOne(filter_, {'$inc': {'hits': hits}}, upsert=True))
+                deltas.append((filter_, hits))
+        await asyncio.gather(*(
+            self._db[collection].bulk_write(requests) for (collection, requests) in updates.items()
+        ))
+        self._apply_leaderboard_deltas(deltas)
+        await self.invalidate_stats_cache(guild_id)
+
+    def _apply_leaderboard_deltas(self, deltas: typing.Iterable[typing.Tuple[dict, int]]):
+        """
+        Feeds written per-emoji counter deltas (counter filter, hits) to the leaderboards
+        """
+        if self._leaderboards is None:
+            return
+        for (filter_, hits) in deltas:
+            day = filter_.get('day')
+            periods = (filter_['period'],) if day is None else Counters.period_keys_of_day(day)
+            self._leaderboards.apply(filter_['gld_id'], filter_['usr_id'], filter_['emoji_uid'], periods, hits)
 
     async def _increment_multiple_emoji_counters(self, counters: typing.List[str], value: int):
         await self._db.ds_emoji_counters.bulk_write([
@@ -156,7 +576,10 @@ class MotorEmojiBackend(EmojiBackend):
         ])
 
     async def _update_guild_counters(self, names: typing.Union[str, typing.List[str]], values: dict):
-        if isinstance(names, str):
+        if self._counter_buffer is not None:
+            for name in ([names] if isinstance(names, str) else names):
+                self._counter_buffer.add('ds_emoji_gld_counters', name, {'_id': name}, values)
+        elif isinstance(names, str):
             # We have only one counter to update
             await self._db.ds_emoji_gld_counters.update_many({'_id': names}, {
                 '$inc': values
@@ -170,17 +593,19 @@ class MotorEmojiBackend(EmojiBackend):
     async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
         # Decrement counters
         tz = await self.get_guild_tz(guild_id)
-        counters = _Counters.guild_counters(guild_id, tz) + _Counters.user_counters(guild_id, user_id, tz)
+        counters = Counters.guild_counters(guild_id, tz, daily=self._daily) + \
+                   Counters.user_counters(guild_id, user_id, tz, daily=self._daily)
         await self._update_guild_counters(counters, {emoji_obj.uid: -1})
 
         # Decrement per-emoji counters
-        await self._increment_emoji_counters(guild_id, user_id, {emoji_obj.uid: 1})
+        await self._increment_emoji_counters(guild_id, user_id, {emoji_obj.uid: -1})
 
     async def submit_message(self, message: discord.Message, emojis: typing.List[MessageEmoji]):
         guild_id = message.guild.id
         user_id = message.author.id
         tz = await self.get_guild_tz(guild_id)
-        counters = _Counters.guild_counters(guild_id, tz) + _Counters.user_counters(guild_id, user_id, tz)
+        counters = Counters.guild_counters(guild_id, tz, daily=self._daily) + \
+                   Counters.user_counters(guild_id, user_id, tz, daily=self._daily)
         values = {em.uid: em.count for em in emojis}
         await self._update_guild_counters(counters, values)
 
@@ -199,116 +624,683 @@ class MotorEmojiBackend(EmojiBackend):
 
     async def _get_emojis_top10(self, guild_id: int, user_id: int, period: str):
         return self._make_emojis_top(
-            await self._db.ds_emoji_counters.find(
+            await self._read_db.ds_emoji_counters.find(
                 self._top_match(period, guild_id, user_id),
-                sort=[('hits', -1)], limit=10).to_list(None)
+                sort=[('hits', -1)], limit=10, **self._time_limit('top10')).to_list(None)
         )
 
     async def get_emojis_top10(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
-        return await self._get_emojis_top10(guild_id, user_id, 'total')
+        return await self._get_top10(guild_id, user_id, 'total')
 
     async def get_emojis_top10_yearly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
-        tz = await self.get_guild_tz(guild_id)
-        return await self._get_emojis_top10(guild_id, user_id, _Counters.year_modifier(tz))
+        return await self._get_top10(guild_id, user_id, 'year')
 
     async def get_emojis_top10_monthly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
-        tz = await self.get_guild_tz(guild_id)
-        return await self._get_emojis_top10(guild_id, user_id, _Counters.month_modifier(tz))
+        return await self._get_top10(guild_id, user_id, 'month')
 
     async def get_emojis_top10_weekly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
-        tz = await self.get_guild_tz(guild_id)
-        return await self._get_emojis_top10(guild_id, user_id, _Counters.week_modifier(tz))
+        return await self._get_top10(guild_id, user_id, 'week')
 
     async def get_emojis_top10_daily(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        return await self._get_top10(guild_id, user_id, 'day')
+
+    async def _get_top10(self, guild_id: int, user_id: typing.Optional[int], kind: str) -> typing.List[StatsEmoji]:
         tz = await self.get_guild_tz(guild_id)
-        return await self._get_emojis_top10(guild_id, user_id, _Counters.day_modifier(tz))
+        period = 'total' if kind == 'total' else PERIOD_MODIFIERS[kind](tz)
+        if self._leaderboards is not None:
+            return self._make_stats(await self._leaderboards.top(
+                guild_id, user_id, period,
+                lambda limit: self._load_leaderboard(guild_id, user_id, kind, period, tz, limit)
+            ))
+        if self._daily and kind != 'total':
+            counts = await self._get_rollup_counts(guild_id, user_id, kind, tz)
+            return self._make_stats(
+                heapq.nlargest(10, ((uid, hits) for (uid, hits) in counts.items() if hits > 0), key=itemgetter(1))
+            )
+        return await self._get_emojis_top10(guild_id, user_id, period)
+
+    async def _load_leaderboard(self, guild_id: int, user_id: typing.Optional[int], kind: str, period: str,
+                                tz: timezone, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        # Boards are kept up to date with deltas from the load on, a board loaded from a lagging secondary
+        # would miss the writes it is behind for good, so they are loaded from the primary
+        if self._daily and kind != 'total':
+            counts = await self._get_rollup_counts(guild_id, user_id, kind, tz, primary=True)
+            return heapq.nlargest(limit, counts.items(), key=itemgetter(1))
+        if user_id is not None:
+            docs = await self._db.ds_emoji_counters.find(
+                self._top_match(period, guild_id, user_id), sort=[('hits', -1)], limit=limit,
+                **self._time_limit('top10')
+            ).to_list(None)
+            return [(doc['emoji_uid'], doc['hits']) for doc in docs]
+        # Counters are per user, the guild leaderboard sums them up
+        result = self._db.ds_emoji_counters.aggregate([
+            {'$match': self._top_match(period, guild_id)},
+            {'$group': {'_id': '$emoji_uid', 'hits': {'$sum': '$hits'}}},
+            {'$sort': {'hits': -1}},
+            {'$limit': limit}
+        ], **self._time_limit('top10', 'maxTimeMS'))
+        return [(doc['_id'], doc['hits']) async for doc in result]
+
+    async def _get_rollup_counts(self, guild_id: int, user_id: typing.Optional[int], period: str,
+                                 tz: timezone, primary: bool = False) -> typing.Dict[str, int]:
+        first_day, today = Counters.period_days(period, tz)
+        counts = await self._sum_daily_counters(guild_id, user_id, today, today, primary)
+        yesterday = Counters.previous_day(today)
+        if first_day <= yesterday:
+            # Only today's counters change, the sum of the previous days of the period is cached
+            key = f'rollup:{guild_id}:{"guild" if user_id is None else user_id}:{first_day}-{yesterday}'
+            previous_days = await self.get_cache(key)
+            if previous_days is None:
+                previous_days = await self._sum_daily_counters(guild_id, user_id, first_day, yesterday, primary)
+                await self.put_cache(key, previous_days, timedelta(seconds=self._cfg.rollup_cache_ttl))
+            for (emoji_uid, hits) in previous_days.items():
+                counts[emoji_uid] = counts.get(emoji_uid, 0) + hits
+        return counts
+
+    async def _sum_daily_counters(self, guild_id: int, user_id: typing.Optional[int],
+                                  first_day: int, last_day: int, primary: bool = False) -> typing.Dict[str, int]:
+        match = {'gld_id': guild_id, 'day': {'$gte': first_day, '$lte': last_day}}
+        if user_id is not None:
+            match['usr_id'] = user_id
+        db = self._db if primary else self._read_db
+        result = db.ds_emoji_daily.aggregate([
+            {'$match': match},
+            {'$group': {'_id': '$emoji_uid', 'hits': {'$sum': '$hits'}}}
+        ], **self._time_limit('top10', 'maxTimeMS'))
+        return {doc['_id']: doc['hits'] async for doc in result}
+
+    async def invalidate_rollup_cache(self, guild_ids: typing.Iterable[int]):
+        """
+        Drops cached sums of daily counters, must be called after counters of the previous days are written
+        """
+        await self.invalidate_cache([f'rollup:{guild_id}:' for guild_id in guild_ids])
 
     @staticmethod
     def _make_emojis_top(values: typing.List[dict]) -> typing.List[StatsEmoji]:
-        results = []
-        for d in values:
-            uid = d.get('emoji_uid')
-            hits = d.get('hits')
-            if uid is None or hits is None:
-                # TODO Warning to log
-                continue
-            results.append(
-                StatsEmoji(emoji=Emoji.from_uid(uid), total_mentions=hits, percentage=0)
+        return EmojiBackend._make_stats((d.get('emoji_uid'), d.get('hits')) for d in values)
+
+    async def _insert_events(self, documents: typing.List[dict]):
+        if not documents:
+            return
+        if self._cfg.event_buckets:
+            await self._db.ds_emoji_buckets.bulk_write(bucket_updates(documents, self._cfg.event_bucket_size),
+                                                       ordered=False)
+        else:
+            await self._db.ds_emojies.insert_many(documents, ordered=False)
+
+    def _event_requests(self, documents: typing.List[dict]) -> WritePart:
+        if self._cfg.event_buckets:
+            return ('ds_emoji_buckets', bucket_updates(documents, self._cfg.event_bucket_size), None)
+        return ('ds_emojies', [InsertOne(document) for document in documents], None)
+
+    async def _write_parts(self, parts: typing.List[WritePart], invalidate: typing.Callable[[], typing.Awaitable]):
+        """
+        Runs unordered bulk writes of the parts concurrently, applies leaderboard deltas of the requests that
+        were applied and calls `invalidate`. Raises PartialWriteError that repeats only the failed requests
+        """
+        parts = [part for part in parts if part[1]]
+        results = await asyncio.gather(*(
+            self._db[collection].bulk_write(requests, ordered=False) for (collection, requests, _) in parts
+        ), return_exceptions=True)
+        failed_parts = []
+        errors = []
+        for ((collection, requests, deltas), result) in zip(parts, results):
+            failed = self._failed_requests(collection, requests, result)
+            if deltas is not None:
+                self._apply_leaderboard_deltas(delta for (index, delta) in enumerate(deltas) if index not in failed)
+            if failed:
+                failed = sorted(failed)
+                failed_parts.append((collection, [requests[index] for index in failed],
+                                     None if deltas is None else [deltas[index] for index in failed]))
+                errors.append(result)
+        await invalidate()
+        if failed_parts:
+            raise PartialWriteError(
+                f'{sum(len(requests) for (_, requests, _) in failed_parts)} of '
+                f'{sum(len(requests) for (_, requests, _) in parts)} writes failed: {errors[0]!r}',
+                partial(self._write_parts, failed_parts, invalidate)
             )
-        total = sum(s.total_mentions for s in results)
-        for s in results:
-            s.percentage = s.total_mentions / total * 100
-        return results
+
+    @staticmethod
+    def _failed_requests(collection: str, requests: list, result) -> typing.Set[int]:
+        if not isinstance(result, BaseException):
+            return set()
+        if isinstance(result, BulkWriteError) and result.details.get('writeErrors'):
+            # Events of a retry that ran into their own _id were inserted by the attempt that failed
+            return {error['index'] for error in result.details['writeErrors']
+                    if not (collection == 'ds_emojies' and error.get('code') == DUPLICATE_KEY)}
+        return set(range(len(requests)))
+
+    async def _remove_events(self, source: EmojiSource, filter_: dict, entry: dict):
+        """
+        Deletes raw events matching `filter_` from ds_emojies and entries matching `entry` from ds_emoji_buckets
+        """
+        # Events of a message are never older than the message, so only buckets since its hour are searched
+        created_at = discord.utils.snowflake_time(source.message_id)
+        bucket_filter = {'gld_id': source.guild_id, 'hour': {'$gte': _hour(created_at)}, 'ev': {'$elemMatch': entry}}
+        oldest = None
+        if self._cfg.window_partials and created_at < _utc_day(datetime.utcnow() - WINDOW_CLOSE_DELAY):
+            # Partials of closed days are dropped only if the message had events on them
+            found = [await self._db.ds_emojies.find_one(filter_, projection=['at'], sort=[('at', ASCENDING)])]
+            if self._cfg.event_buckets:
+                doc = await self._db.ds_emoji_buckets.find_one(bucket_filter, projection=['hour'],
+                                                               sort=[('hour', ASCENDING)])
+                found.append({'at': doc['hour']} if doc is not None else None)
+            oldest = min((doc['at'] for doc in found if doc is not None), default=None)
+
+        await self._db.ds_emojies.delete_many(filter_)
+        if self._cfg.event_buckets:
+            await self._db.ds_emoji_buckets.update_many(bucket_filter, {'$pull': {'ev': entry}})
+            await self._db.ds_emoji_buckets.delete_many({
+                'gld_id': source.guild_id, 'hour': bucket_filter['hour'], 'ev': {'$size': 0}
+            })
+        if oldest is not None:
+            await self._invalidate_day_partials({source.guild_id: oldest})
 
     async def submit_emoji(self, source: EmojiSource, emoji_obj: MessageEmoji):
-        record = EmojiEntry.create(source, emoji_obj)
-        await self._db.ds_emojies.insert_one(asdict(record))
+        await self._insert_events([EmojiEntry.source_document(source, emoji_obj)])
 
     async def remove_emoji_source(self, source: EmojiSource):
-        await self._db.ds_emojies.delete_many({'src_uid': source.uid})
+        await self._remove_events(source, {'src_uid': source.uid},
+                                  {'m': source.message_id, 'u': source.user_id, 'r': source.reaction})
+
+    async def submit_history(self, records: typing.Union[typing.List[HistoryRecord], EmojiBatch]):
+        await self._write_history(EmojiBatch.of(records), True)
+
+    async def update_counters(self, records: typing.Union[typing.List[HistoryRecord], EmojiBatch]):
+        await self._write_history(EmojiBatch.of(records), False)
+
+    async def _write_history(self, batch: EmojiBatch, raw_events: bool):
+        if not batch:
+            return
+        entries = []
+        guild_counters = {}
+        emoji_counters = {}
+        past_days = set()
+        # guild id -> time of its oldest record
+        oldest = {}
+        # guild id -> (timezone, today)
+        guild_days = {}
+        for (guild_id, message_id, user_id, reaction, emoji_obj, count, timestamp) in batch.rows():
+            guild_day = guild_days.get(guild_id)
+            if guild_day is None:
+                tz = await self.get_guild_tz(guild_id)
+                guild_day = guild_days[guild_id] = (tz, self._period_modifiers(tz)[-1])
+            (tz, today) = guild_day
+            at = datetime.utcfromtimestamp(timestamp)
+            emoji_uid = emoji_obj.uid
+            periods = self._period_modifiers(tz, at)
+            if self._daily and periods[-1] != today:
+                past_days.add(guild_id)
+            for period in periods:
+                for name in (f'g{guild_id}_' + period, f'u{guild_id}-{user_id}_' + period):
+                    values = guild_counters.setdefault(name, {})
+                    values[emoji_uid] = values.get(emoji_uid, 0) + count
+                key = (user_id, emoji_uid, guild_id, period)
+                emoji_counters[key] = emoji_counters.get(key, 0) + count
+            if not raw_events:
+                continue
+            if guild_id not in oldest or at < oldest[guild_id]:
+                oldest[guild_id] = at
+            entries.append(EmojiEntry.document(guild_id, message_id, user_id, bool(reaction), emoji_uid, count, at))
+
+        # collection -> (requests, leaderboard deltas)
+        emoji_updates = {}
+        for ((user_id, emoji_uid, guild_id, period), hits) in emoji_counters.items():
+            collection, filter_ = self._emoji_counter(guild_id, user_id, emoji_uid, period)
+            if self._counter_buffer is not None:
+                # Flushes apply the leaderboard deltas and invalidate the stats cache
+                self._counter_buffer.add(collection, (user_id, emoji_uid, guild_id, period), filter_, {'hits': hits})
+                continue
+            (requests, deltas) = emoji_updates.setdefault(collection, ([], []))
+            requests.append(UpdateOne(filter_, {'$inc': {'hits': hits}}, upsert=True))
+            deltas.append((filter_, hits))
+
+        async def invalidate():
+            for guild_id in guild_days:
+                await self.invalidate_stats_cache(guild_id)
+            if past_days:
+                # Rollups only cover the days before today, records of today (e.g. from the event queue) keep them
+                await self.invalidate_rollup_cache(past_days)
+            if self._cfg.window_partials:
+                await self._invalidate_day_partials(oldest)
+
+        # The writes are independent, if some fail only those are repeated by a retry
+        await self._write_parts([
+            self._event_requests(entries),
+            ('ds_emoji_gld_counters', [
+                UpdateOne({'_id': name}, {'$inc': values}, upsert=True) for (name, values) in guild_counters.items()
+            ], None),
+            *((collection, requests, deltas) for (collection, (requests, deltas)) in emoji_updates.items())
+        ], invalidate)
 
-    async def submit_bulk(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji]]):
-        records = [EmojiEntry.create(s, e) for (s, e) in records]
-        records = list(asdict(r) for r in records)
-        await self._db.ds_emojies.insert_many(records)
+    async def submit_bulk(self, records: typing.Union[typing.List[typing.Tuple[EmojiSource, MessageEmoji]],
+                                                      EmojiBatch]):
+        oldest = {}
+        if isinstance(records, EmojiBatch):
+            documents = [
+                EmojiEntry.document(guild_id, message_id, user_id, bool(reaction), emoji_obj.uid, count,
+                                    datetime.utcfromtimestamp(at))
+                for (guild_id, message_id, user_id, reaction, emoji_obj, count, at) in records.rows()
+            ]
+            for doc in documents:
+                if doc['gld_id'] not in oldest or doc['at'] < oldest[doc['gld_id']]:
+                    oldest[doc['gld_id']] = doc['at']
+        else:
+            at = datetime.utcnow()
+            documents = [EmojiEntry.source_document(source, emoji_obj, at) for (source, emoji_obj) in records]
+        await self._insert_events(documents)
+        if self._cfg.window_partials:
+            await self._invalidate_day_partials(oldest)
 
     async def remove_emoji(self, source: EmojiSource, emoji_obj: Emoji):
-        await self._db.ds_emojies.delete_many({
+        await self._remove_events(source, {
             'src_uid': source.uid,
             'is_reaction': source.reaction,
             'emoji_uid': emoji_obj.uid
-        })
+        }, {'m': source.message_id, 'u': source.user_id, 'r': source.reaction, 'e': emoji_obj.uid})
+
+    async def get_stored_messages(self, guild_id: int, message_ids: typing.Collection[int]) -> typing.Set[int]:
+        if not message_ids:
+            return set()
+        message_ids = list(message_ids)
+        # Events of content emojis are stored at the message's time, the range lets the guild indexes be used
+        first_hour = _hour(discord.utils.snowflake_time(min(message_ids)))
+        last_hour = _hour(discord.utils.snowflake_time(max(message_ids)))
+        docs = await self._db.ds_emojies.find({
+            'gld_id': guild_id, 'at': {'$gte': first_hour, '$lt': last_hour + timedelta(hours=1)},
+            'msg_id': {'$in': message_ids}, 'is_reaction': False
+        }, projection=['msg_id']).to_list(None)
+        stored = {doc['msg_id'] for doc in docs}
+        if self._cfg.event_buckets:
+            wanted = set(message_ids)
+            entry = {'m': {'$in': message_ids}, 'r': False}
+            async for doc in self._db.ds_emoji_buckets.find({
+                'gld_id': guild_id, 'hour': {'$gte': first_hour, '$lte': last_hour}, 'ev': {'$elemMatch': entry}
+            }, projection=['ev']):
+                stored.update(event['m'] for event in doc['ev'] if not event['r'] and event['m'] in wanted)
+        return stored
 
     async def get_emojis_top(self, guild_id: int = None, last_n_days: int = None,
                              user_id: int = None, limit: int = None) -> typing.List[StatsEmoji]:
+        if limit is not None:
+            limit = max(limit, 1)
+        since = None if last_n_days is None else datetime.utcnow() - timedelta(days=last_n_days)
+        if since is not None and guild_id is not None and self._cfg.window_partials:
+            top = self._top_of(await self._get_window_counts(guild_id, user_id, since), limit)
+        elif self._cfg.event_buckets:
+            top = self._top_of(await self._count_events(guild_id, user_id, since), limit)
+        else:
+            top = await self._aggregate_events_top(guild_id, user_id, since, None, limit)
+        decoded = []
+        for (id_, count) in top:
+            emoji_obj = Emoji.from_uid(id_)
+            if emoji_obj is None:
+                self.log.error(f'Failed to decode emoji id = "{id_}"')
+                continue
+            decoded.append((emoji_obj, count))
+        total = sum(count for (_, count) in decoded)
+        return [StatsEmoji(emoji=emoji_obj, total_mentions=count, percentage=count / total * 100)
+                for (emoji_obj, count) in decoded]
+
+    @staticmethod
+    def _top_of(counts: typing.Dict[str, int], limit: typing.Optional[int]) -> typing.List[typing.Tuple[str, int]]:
+        if limit is not None:
+            return heapq.nlargest(limit, counts.items(), key=itemgetter(1))
+        return sorted(counts.items(), key=itemgetter(1), reverse=True)
+
+    @staticmethod
+    def _time_range(since: typing.Optional[datetime], until: typing.Optional[datetime]) -> dict:
+        range_ = {}
+        if since is not None:
+            range_['$gte'] = since
+        if until is not None:
+            range_['$lt'] = until
+        return range_
+
+    async def _count_events(self, guild_id: typing.Optional[int], user_id: typing.Optional[int],
+                            since: typing.Optional[datetime], until: typing.Optional[datetime] = None,
+                            by_day: bool = False, primary: bool = False) -> dict:
+        """
+        Sums up counts of raw events per emoji, or per UTC day (as a day key) and emoji if `by_day` is set.
+        Events written before buckets were enabled stay in ds_emojies, so both are counted.
+        Events are read with the read preference of stats reads unless `primary` is set
+        """
+        aggregations = [self._aggregate_events_top(guild_id, user_id, since, until, None, by_day, primary)]
+        if self._cfg.event_buckets:
+            aggregations.append(self._aggregate_buckets_top(guild_id, user_id, since, until, by_day, primary))
+        counts = {}
+        for result in await asyncio.gather(*aggregations):
+            for (key, count) in result:
+                if by_day:
+                    (day, key) = key
+                    values = counts.setdefault(day, {})
+                else:
+                    values = counts
+                values[key] = values.get(key, 0) + count
+        return counts
+
+    @staticmethod
+    def _group_key(emoji_field: str, time_field: str, by_day: bool):
+        if not by_day:
+            return emoji_field
+        return {'day': {'$dateToString': {'format': '%Y%m%d', 'date': time_field}}, 'emoji': emoji_field}
+
+    @staticmethod
+    def _group_result(doc: dict, by_day: bool):
+        if not by_day:
+            return doc['_id'], doc.get('count')
+        return (int(doc['_id']['day']), doc['_id']['emoji']), doc.get('count')
+
+    async def _aggregate_events_top(self, guild_id: typing.Optional[int], user_id: typing.Optional[int],
+                                    since: typing.Optional[datetime], until: typing.Optional[datetime],
+                                    limit: typing.Optional[int], by_day: bool = False,
+                                    primary: bool = False) -> typing.List[tuple]:
         pipeline = []
-        if not (guild_id is None and last_n_days is None and user_id is None):
-            match = {}
-            if guild_id is not None:
-                match['gld_id'] = guild_id
-            if user_id is not None:
-                match['usr_id'] = user_id
-            if last_n_days is not None:
-                match['at'] = {
-                    '$gt': datetime.utcnow() - timedelta(days=last_n_days)
-                }
+        match = {}
+        if guild_id is not None:
+            match['gld_id'] = guild_id
+        if user_id is not None:
+            match['usr_id'] = user_id
+        if since is not None or until is not None:
+            match['at'] = self._time_range(since, until)
+        if match:
             pipeline.append({'$match': match})
         pipeline.append({
             '$group': {
-                '_id': '$emoji_uid',
+                '_id': self._group_key('$emoji_uid', '$at', by_day),
                 'count': {
                     '$sum': '$count'
                 }
             }
         })
-        pipeline.append({
-            '$sort': {
-                'count': -1
-            }
-        })
         if limit is not None:
-            limit = max(limit, 1)
+            pipeline.append({
+                '$sort': {
+                    'count': -1
+                }
+            })
             pipeline.append({
                 '$limit': limit
             })
-        result = self._db.ds_emojies.aggregate(pipeline)
-        stats = []
-        async for doc in result:
-            id_ = doc['_id']
-            emoji_obj = Emoji.from_uid(id_)
-            if emoji_obj is None:
-                self.log.error(f'Failed to decode emoji id = "{id_}"')
-                continue
-            stats.append(StatsEmoji(emoji=emoji_obj, total_mentions=doc.get('count'), percentage=0))
-        total = sum(r.total_mentions for r in stats)
-        for r in stats:
-            r.percentage = r.total_mentions / total * 100
-        return stats
+        db = self._db if primary else self._read_db
+        return [self._group_result(doc, by_day)
+                async for doc in db.ds_emojies.aggregate(pipeline, **self._time_limit('top', 'maxTimeMS'))]
+
+    async def _aggregate_buckets_top(self, guild_id: typing.Optional[int], user_id: typing.Optional[int],
+                                     since: typing.Optional[datetime], until: typing.Optional[datetime],
+                                     by_day: bool = False, primary: bool = False) -> typing.List[tuple]:
+        """
+        Sums up counts of the entries of ds_emoji_buckets per emoji. Buckets are per hour, so `since`
+        includes the whole hour it falls into
+        """
+        match = {}
+        if guild_id is not None:
+            match['gld_id'] = guild_id
+        if since is not None or until is not None:
+            match['hour'] = self._time_range(_hour(since) if since is not None else None, until)
+        if user_id is not None:
+            match['ev.u'] = user_id
+        pipeline = [{'$match': match}] if match else []
+        pipeline.append({'$unwind': '$ev'})
+        if user_id is not None:
+            pipeline.append({'$match': {'ev.u': user_id}})
+        pipeline.append({'$group': {'_id': self._group_key('$ev.e', '$hour', by_day), 'count': {'$sum': '$ev.c'}}})
+        db = self._db if primary else self._read_db
+        return [self._group_result(doc, by_day)
+                async for doc in db.ds_emoji_buckets.aggregate(pipeline, **self._time_limit('top', 'maxTimeMS'))]
 
-    async def put_cache(self, key: str, value, age: timedelta = timedelta(minutes=10)):
-        if not self.config.cache_cfg.enabled:
+    async def _get_window_counts(self, guild_id: int, user_id: typing.Optional[int],
+                                 since: datetime) -> typing.Dict[str, int]:
+        """
+        Counts emojis of raw events since the given time from three parts: events of the partial first day,
+        per-day partials of the closed days in between and events since the start of the current day.
+        A day is closed WINDOW_CLOSE_DELAY after it ended, so late writes of the day are still counted
+        """
+        today = _utc_day(datetime.utcnow() - WINDOW_CLOSE_DELAY)
+        first_closed = _utc_day(since)
+        if first_closed < since:
+            first_closed += timedelta(days=1)
+        if first_closed >= today:
+            return await self._count_events(guild_id, user_id, since)
+        (head, live, closed) = await asyncio.gather(
+            self._count_events(guild_id, user_id, since, first_closed),
+            self._count_events(guild_id, user_id, today),
+            self._get_closed_days_counts(guild_id, user_id, Counters.day_key(first_closed),
+                                         Counters.day_key(today - timedelta(days=1)))
+        )
+        counts = dict(closed)
+        for part in (head, live):
+            for (emoji_uid, count) in part.items():
+                counts[emoji_uid] = counts.get(emoji_uid, 0) + count
+        return counts
+
+    async def _get_closed_days_counts(self, guild_id: int, user_id: typing.Optional[int],
+                                      first_day: int, last_day: int) -> typing.Dict[str, int]:
+        # Partials of closed days only change with late writes, which drop them and the cached sums.
+        # They are stored, so they are read and computed on the primary
+        key = f'window:{guild_id}:{"guild" if user_id is None else user_id}:{first_day}-{last_day}'
+        counts = await self.get_cache(key)
+        if counts is not None:
+            return counts
+        docs = await self._db.ds_emoji_day_partials.find(
+            {'gld_id': guild_id, 'usr_id': user_id, 'day': {'$gte': first_day, '$lte': last_day}},
+            projection=['day', 'emojis']
+        ).to_list(None)
+        partials = {doc['day']: doc['emojis'] for doc in docs}
+        missing = []
+        day = first_day
+        while day <= last_day:
+            if day not in partials:
+                missing.append(day)
+            day = Counters.day_key(Counters.date_of_key(day) + timedelta(days=1))
+        if missing:
+            # A late write that drops partials while they are computed would be undone by the upsert, so the
+            # guild's partials version is compared before and after and partials of a changed version dropped
+            version_key = f'partials-version:{guild_id}'
+            version = await self._get_cache(version_key)
+            computed = await self._count_events(guild_id, user_id, _utc_day_of_key(missing[0]),
+                                                _utc_day_of_key(missing[-1]) + timedelta(days=1), by_day=True,
+                                                primary=True)
+            updates = []
+            for day in missing:
+                emojis = [[emoji_uid, count] for (emoji_uid, count) in computed.get(day, {}).items() if count]
+                partials[day] = emojis
+                updates.append(UpdateOne({'gld_id': guild_id, 'usr_id': user_id, 'day': day},
+                                         {'$set': {'emojis': emojis}}, upsert=True))
+            await self._db.ds_emoji_day_partials.bulk_write(updates, ordered=False)
+            if await self._get_cache(version_key) != version:
+                await self._db.ds_emoji_day_partials.delete_many(
+                    {'gld_id': guild_id, 'usr_id': user_id, 'day': {'$in': missing}}
+                )
+                key = None
+        counts = {}
+        for emojis in partials.values():
+            for (emoji_uid, count) in emojis:
+                counts[emoji_uid] = counts.get(emoji_uid, 0) + count
+        if key is not None:
+            await self.put_cache(key, counts, timedelta(seconds=self._cfg.rollup_cache_ttl))
+        return counts
+
+    async def _invalidate_day_partials(self, first_days: typing.Dict[int, datetime]):
+        """
+        Drops per-day partials of the guilds since the given times and the cached sums of the guilds,
+        must be called after raw events of a closed day are written or removed
+        """
+        today = _utc_day(datetime.utcnow() - WINDOW_CLOSE_DELAY)
+        first_days = {guild_id: at for (guild_id, at) in first_days.items() if at < today}
+        if not first_days:
             return
+        # The version changes first, partials computed concurrently are then dropped by their writer
+        await asyncio.gather(*(
+            self._put_cache(f'partials-version:{guild_id}', uuid.uuid4().hex, PARTIALS_VERSION_AGE)
+            for guild_id in first_days
+        ))
+        await asyncio.gather(*(
+            self._db.ds_emoji_day_partials.delete_many({'gld_id': guild_id, 'day': {'$gte': Counters.day_key(at)}})
+            for (guild_id, at) in first_days.items()
+        ))
+        await self.invalidate_cache([f'window:{guild_id}:' for guild_id in first_days])
+
+    async def apply_retention(self, cfg: RetentionConfig) -> typing.List[RetentionStats]:
+        """
+        In periods mode every hit is also counted in the coarser periods, so expired day, week and month
+        counters are deleted. In daily mode year, month and week stats are sums of daily counters, so daily
+        counters of expired months are folded into the counter of the first day of their month, which keeps
+        the sums of every period the same
+        """
+        now = datetime.utcnow()
+        results = []
+        if self._daily:
+            if cfg.day_counters_days is not None:
+                cutoff = now - timedelta(days=max(cfg.day_counters_days, MIN_DAY_COUNTERS_DAYS))
+                first_kept = Counters.day_key(cutoff.replace(day=1))
+                results.append(await self._fold_daily_counters(first_kept, cfg))
+                results.append(await self._compact_guild_counters({8: first_kept}, cfg, fold=True))
+        else:
+            # Keys of a period are compared with the key of the same length of the cutoff
+            expired = {}
+            if cfg.day_counters_days is not None:
+                expired[8] = Counters.day_key(now - timedelta(days=cfg.day_counters_days))
+            if cfg.week_counters_days is not None:
+                # Weeks are counted within months, a week expires with the month it belongs to
+                cutoff = now - timedelta(days=cfg.week_counters_days)
+                expired[7] = (cutoff.year * 100 + cutoff.month) * 10
+            if cfg.month_counters_days is not None:
+                cutoff = now - timedelta(days=cfg.month_counters_days)
+                expired[6] = cutoff.year * 100 + cutoff.month
+            if expired:
+                results.append(await self._delete_in_batches('ds_emoji_counters', {'$or': [
+                    {'period': {'$regex': f'^\\d{{{length}}}$', '$lt': str(first_kept)}}
+                    for (length, first_kept) in expired.items()
+                ]}, cfg))
+                results.append(await self._compact_guild_counters(expired, cfg, fold=False))
+        if cfg.raw_events_days is not None:
+            cutoff = now - timedelta(days=cfg.raw_events_days)
+            results.append(await self._delete_in_batches('ds_emojies', {'at': {'$lt': cutoff}}, cfg,
+                                                         cfg.archive_raw_events))
+            if self._cfg.event_buckets:
+                results.append(await self._delete_in_batches('ds_emoji_buckets', {'hour': {'$lt': _hour(cutoff)}},
+                                                             cfg, cfg.archive_raw_events))
+        return results
+
+    async def _average_document_size(self, collection: str) -> int:
+        try:
+            return int((await self._db.command('collStats', collection)).get('avgObjSize', 0))
+        except Exception:
+            return 0
+
+    async def _delete_in_batches(self, collection: str, filter_: dict, cfg: RetentionConfig,
+                                 archive: bool = False) -> RetentionStats:
+        """
+        Deletes documents matching the filter in batches, copying them to <collection>_archive first if
+        `archive` is set. Archived documents are written with their ids, so an interrupted run can be repeated
+        """
+        stats = RetentionStats(collection, 'archived' if archive else 'deleted')
+        started_at = time.perf_counter()
+        average_size = await self._average_document_size(collection)
+        docs = []
+
+        async def flush():
+            if archive:
+                await self._db[f'{collection}_archive'].bulk_write([
+                    ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in docs
+                ], ordered=False)
+            result = await self._db[collection].delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            stats.documents += result.deleted_count
+            docs.clear()
+            await asyncio.sleep(cfg.batch_delay)
+
+        async for doc in self._db[collection].find(filter_, projection=None if archive else ['_id'],
+                                                   batch_size=cfg.batch_size):
+            docs.append(doc)
+            if len(docs) >= cfg.batch_size:
+                await flush()
+        if docs:
+            await flush()
+        stats.reclaimed_bytes = stats.documents * average_size
+        stats.duration = time.perf_counter() - started_at
+        return stats
+
+    async def _fold_daily_counters(self, first_kept: int, cfg: RetentionConfig) -> RetentionStats:
+        stats = RetentionStats('ds_emoji_daily', 'folded')
+        started_at = time.perf_counter()
+        average_size = await self._average_document_size('ds_emoji_daily')
+        docs = []
+
+        async def flush():
+            folded = {}
+            for doc in docs:
+                key = (doc['gld_id'], doc['usr_id'], doc['emoji_uid'], doc['day'] // 100 * 100 + 1)
+                folded[key] = folded.get(key, 0) + doc.get('hits', 0)
+            # Incremented before the folded counters are deleted, a failure in between counts them twice
+            await self._db.ds_emoji_daily.bulk_write([
+                UpdateOne({'gld_id': guild_id, 'usr_id': user_id, 'emoji_uid': emoji_uid, 'day': day},
+                          {'$inc': {'hits': hits}}, upsert=True)
+                for ((guild_id, user_id, emoji_uid, day), hits) in folded.items()
+            ], ordered=False)
+            result = await self._db.ds_emoji_daily.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            stats.documents += result.deleted_count
+            docs.clear()
+            await asyncio.sleep(cfg.batch_delay)
 
+        # Counters of the first day of a month hold the folded days, they are never folded themselves
+        async for doc in self._db.ds_emoji_daily.find({'day': {'$lt': first_kept, '$not': {'$mod': [100, 1]}}},
+                                                      batch_size=cfg.batch_size):
+            docs.append(doc)
+            if len(docs) >= cfg.batch_size:
+                await flush()
+        if docs:
+            await flush()
+        stats.reclaimed_bytes = stats.documents * average_size
+        stats.duration = time.perf_counter() - started_at
+        return stats
+
+    async def _compact_guild_counters(self, expired: typing.Dict[int, int], cfg: RetentionConfig,
+                                      fold: bool) -> RetentionStats:
+        """
+        Deletes ds_emoji_gld_counters of periods older than the first kept key of the same length or,
+        with `fold`, adds day counters to the counter of the first day of their month
+        """
+        stats = RetentionStats('ds_emoji_gld_counters', 'folded' if fold else 'deleted')
+        started_at = time.perf_counter()
+        average_size = await self._average_document_size('ds_emoji_gld_counters')
+        docs = []
+
+        async def flush():
+            if fold:
+                folded = {}
+                for doc in docs:
+                    (prefix, day) = PERIOD_COUNTER_NAME.match(doc['_id']).groups()
+                    values = folded.setdefault(f'{prefix}_{int(day) // 100 * 100 + 1}', {})
+                    for (emoji_uid, hits) in doc.items():
+                        if emoji_uid != '_id':
+                            values[emoji_uid] = values.get(emoji_uid, 0) + hits
+                await self._db.ds_emoji_gld_counters.bulk_write([
+                    UpdateOne({'_id': name}, {'$inc': values}, upsert=True) for (name, values) in folded.items()
+                ], ordered=False)
+            result = await self._db.ds_emoji_gld_counters.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            stats.documents += result.deleted_count
+            docs.clear()
+            await asyncio.sleep(cfg.batch_delay)
+
+        async for doc in self._db.ds_emoji_gld_counters.find({'_id': {'$regex': PERIOD_COUNTER_NAME.pattern}},
+                                                             projection=None if fold else ['_id'],
+                                                             batch_size=cfg.batch_size):
+            period = PERIOD_COUNTER_NAME.match(doc['_id']).group(2)
+            first_kept = expired.get(len(period))
+            if first_kept is None or int(period) >= first_kept or (fold and int(period) % 100 == 1):
+                continue
+            docs.append(doc)
+            if len(docs) >= cfg.batch_size:
+                await flush()
+        if docs:
+            await flush()
+        stats.reclaimed_bytes = stats.documents * average_size
+        stats.duration = time.perf_counter() - started_at
+        return stats
+
+    async def _put_cache(self, key: str, value, age: timedelta):
         await self._db.ds_cache.update_one({
             '_id': key
         }, {
@@ -318,10 +1310,9 @@ class MotorEmojiBackend(EmojiBackend):
             }
         }, upsert=True)
 
-    async def get_cache(self, key: str):
-        if not self.config.cache_cfg.enabled:
-            return None
-        record = await self._db.ds_cache.find_one({'_id': key})
+    async def _get_cache(self, key: str):
+        # TTL monitor removes expired documents only once a minute
+        record = await self._db.ds_cache.find_one({'_id': key, 'expires_at': {'$gt': datetime.utcnow()}})
         if record is None:
             return None
         try:
@@ -331,9 +1322,14 @@ class MotorEmojiBackend(EmojiBackend):
             self.log.error('Failed to load cache: ' + str(exc))
             return None
 
-    async def clear_cache(self):
+    async def _clear_cache(self):
         await self._db.ds_cache.delete_many({})
 
+    async def _invalidate_cache(self, prefixes: typing.List[str]):
+        await self._db.ds_cache.delete_many({
+            '_id': {'$regex': '^(' + '|'.join(re.escape(prefix) for prefix in prefixes) + ')'}
+        })
+
     async def get_persistent_config(self, name: str, key: str):
         return await self._get_persistent_config('custom', name, key)
 
@@ -343,7 +1339,7 @@ class MotorEmojiBackend(EmojiBackend):
     async def get_guild_config(self, guild_id: int, key: str = None):
         return await self._get_persistent_config('guild', guild_id, key)
 
-    async def update_guild_config(self, guild_id: int, data: dict, override: bool = False):
+    async def _update_guild_config(self, guild_id: int, data: dict, override: bool = False):
         await self._update_persistent_config('guild', guild_id, data, override)
 
     async def has_guild_config(self, guild_id: int) -> bool:
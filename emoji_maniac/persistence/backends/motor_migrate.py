@@ -0,0 +1,231 @@
+"""
+
+Converts counters of the Motor backend between counter modes (see MotorConfig.counter_mode).
+Stop the bot before migrating and set emoji_backends.motor.counter_mode after the migration is done.
+
+    python -m emoji_maniac.persistence.backends.motor_migrate --to daily
+    python -m emoji_maniac.persistence.backends.motor_migrate --to periods --config emoji_cfg.yaml --dry-run
+    python -m emoji_maniac.persistence.backends.motor_migrate --merge-duplicates
+
+periods -> daily: day counters are copied to ds_emoji_daily, year, month and week counters are removed.
+daily -> periods: year, month and week counters are rebuilt from daily counters, ds_emoji_daily is dropped.
+Counters are written with $set, so an interrupted migration can be started again.
+
+--merge-duplicates sums counters that share the key of their unique index into one document, the bot
+does not start while the unique indexes cannot be built. Day partials are recomputed, so duplicates of
+them are removed. The document that is kept records the merged ids first, so an interrupted merge can be
+started again as well.
+
+"""
+import argparse
+import asyncio
+import re
+import sys
+import typing
+
+from pymongo import UpdateOne
+
+from emoji_maniac.bot.config import Config
+from emoji_maniac.log import get_logger
+from emoji_maniac.persistence.backends.motor import MotorConfig, COUNTER_MODES, COUNTER_MODE_CONFIG, INDEXES, mas
+from emoji_maniac.persistence.counters import Counters
+
+DAY_PERIOD = re.compile(r'^\d{8}$')
+# Year (yyyy), month (yyyymm) and week (yyyymmw) suffixes of ds_emoji_gld_counters names
+ROLLUP_COUNTER_NAME = r'_(\d{4}|\d{6}|\d{7})$'
+DAY_COUNTER_NAME = r'_\d{8}$'
+# Collections with unique indexes -> whether duplicates are summed (counters) or removed (recomputed data)
+UNIQUE_COLLECTIONS = {'ds_emoji_counters': True, 'ds_emoji_daily': True, 'ds_emoji_day_partials': False}
+
+log = get_logger('MotorMigrate')
+
+
+def _rollup_periods(day: int) -> typing.Tuple[str, str, str]:
+    """
+    Returns year, month and week keys of the day
+    """
+    return Counters.period_keys_of_day(day)[:3]
+
+
+class _BatchWriter:
+    def __init__(self, collection: mas.AsyncIOMotorCollection, batch_size: int, dry_run: bool):
+        self._collection = collection
+        self._batch_size = batch_size
+        self._dry_run = dry_run
+        self._requests = []
+        self.written = 0
+
+    async def add(self, request: UpdateOne):
+        self._requests.append(request)
+        if len(self._requests) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if self._requests and not self._dry_run:
+            await self._collection.bulk_write(self._requests, ordered=False)
+        self.written += len(self._requests)
+        self._requests = []
+
+
+async def get_counter_mode(db: mas.AsyncIOMotorDatabase) -> typing.Optional[str]:
+    doc = await db.ds_cfg_custom.find_one({'_id': COUNTER_MODE_CONFIG})
+    if doc is not None:
+        return doc.get('mode')
+    if await db.ds_emoji_counters.find_one({}, projection=['_id']) is not None:
+        return 'periods'
+    return None
+
+
+async def migrate_to_daily(db: mas.AsyncIOMotorDatabase, batch_size: int, dry_run: bool):
+    writer = _BatchWriter(db.ds_emoji_daily, batch_size, dry_run)
+    async for doc in db.ds_emoji_counters.find({'period': {'$regex': DAY_PERIOD.pattern}}):
+        filter_ = {'usr_id': doc['usr_id'], 'emoji_uid': doc['emoji_uid'], 'gld_id': doc['gld_id'],
+                   'day': int(doc['period'])}
+        await writer.add(UpdateOne(filter_, {'$set': {'hits': doc.get('hits', 0)}}, upsert=True))
+    await writer.flush()
+    log.info(f'{writer.written} daily counters written to ds_emoji_daily')
+
+    counters_filter = {'period': {'$ne': 'total'}}
+    names_filter = {'_id': {'$regex': ROLLUP_COUNTER_NAME}}
+    if dry_run:
+        log.info(f'{await db.ds_emoji_counters.count_documents(counters_filter)} counters of ds_emoji_counters and '
+                 f'{await db.ds_emoji_gld_counters.count_documents(names_filter)} counters of ds_emoji_gld_counters '
+                 f'would be removed')
+        return
+    removed = await db.ds_emoji_counters.delete_many(counters_filter)
+    removed_names = await db.ds_emoji_gld_counters.delete_many(names_filter)
+    log.info(f'{removed.deleted_count} counters removed from ds_emoji_counters, '
+             f'{removed_names.deleted_count} from ds_emoji_gld_counters')
+
+
+async def migrate_to_periods(db: mas.AsyncIOMotorDatabase, batch_size: int, dry_run: bool):
+    # Year, month and week sums are accumulated in memory, there are fewer of them than daily counters
+    emoji_counters = {}
+    writer = _BatchWriter(db.ds_emoji_counters, batch_size, dry_run)
+    async for doc in db.ds_emoji_daily.find({}):
+        hits = doc.get('hits', 0)
+        for period in _rollup_periods(doc['day']):
+            key = (doc['usr_id'], doc['emoji_uid'], doc['gld_id'], period)
+            emoji_counters[key] = emoji_counters.get(key, 0) + hits
+        filter_ = {'usr_id': doc['usr_id'], 'emoji_uid': doc['emoji_uid'], 'gld_id': doc['gld_id'],
+                   'period': str(doc['day'])}
+        await writer.add(UpdateOne(filter_, {'$set': {'hits': hits}}, upsert=True))
+    for ((user_id, emoji_uid, guild_id, period), hits) in emoji_counters.items():
+        await writer.add(UpdateOne({'usr_id': user_id, 'emoji_uid': emoji_uid, 'gld_id': guild_id, 'period': period},
+                                   {'$set': {'hits': hits}}, upsert=True))
+    await writer.flush()
+    log.info(f'{writer.written} counters written to ds_emoji_counters')
+
+    guild_counters = {}
+    async for doc in db.ds_emoji_gld_counters.find({'_id': {'$regex': DAY_COUNTER_NAME}}):
+        prefix, day = doc['_id'].rsplit('_', 1)
+        for period in _rollup_periods(int(day)):
+            values = guild_counters.setdefault(f'{prefix}_{period}', {})
+            for (emoji_uid, hits) in doc.items():
+                if emoji_uid != '_id':
+                    values[emoji_uid] = values.get(emoji_uid, 0) + hits
+    writer = _BatchWriter(db.ds_emoji_gld_counters, batch_size, dry_run)
+    for (name, values) in guild_counters.items():
+        await writer.add(UpdateOne({'_id': name}, {'$set': values}, upsert=True))
+    await writer.flush()
+    log.info(f'{writer.written} counters written to ds_emoji_gld_counters')
+
+    if not dry_run:
+        await db.ds_emoji_daily.drop()
+        log.info('ds_emoji_daily dropped')
+
+
+def _unique_key(collection: str) -> typing.List[str]:
+    return next(list(model.document['key']) for model in INDEXES[collection] if model.document.get('unique'))
+
+
+async def merge_duplicates(db: mas.AsyncIOMotorDatabase, dry_run: bool):
+    for (collection, summed) in UNIQUE_COLLECTIONS.items():
+        fields = _unique_key(collection)
+        groups = db[collection].aggregate([
+            {'$group': {'_id': {field: '$' + field for field in fields},
+                        'docs': {'$push': {'_id': '$_id', 'hits': '$hits', 'merged': '$merged'}},
+                        'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}}
+        ], allowDiskUse=True)
+        keys = 0
+        removed = 0
+        async for group in groups:
+            docs = group['docs']
+            keys += 1
+            removed += len(docs) - 1 if summed else len(docs)
+            if dry_run:
+                continue
+            if not summed:
+                await db[collection].delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+                continue
+            # Duplicates merged by an interrupted run are already counted in the document that was kept
+            kept = next((doc for doc in docs if doc.get('merged')), docs[0])
+            merged = set(kept.get('merged') or ())
+            others = [doc for doc in docs if doc is not kept]
+            hits = (kept.get('hits') or 0) + sum(doc.get('hits') or 0 for doc in others if doc['_id'] not in merged)
+            await db[collection].update_one({'_id': kept['_id']}, {'$set': {
+                'hits': hits, 'merged': list(merged | {doc['_id'] for doc in others})
+            }})
+            await db[collection].delete_many({'_id': {'$in': [doc['_id'] for doc in others]}})
+            await db[collection].update_one({'_id': kept['_id']}, {'$unset': {'merged': ''}})
+        log.info(f'{keys} duplicated keys in {collection}, {removed} documents ' +
+                 ('would be removed' if dry_run else 'removed'))
+    if not dry_run:
+        # Cached stats may have been computed from the duplicates
+        await db.ds_cache.delete_many({})
+
+
+async def migrate(cfg: MotorConfig, target: str, batch_size: int = 1000, dry_run: bool = False):
+    client = mas.AsyncIOMotorClient(cfg.uri)
+    db = client[cfg.dbname]
+    try:
+        current = await get_counter_mode(db)
+        if current == target:
+            log.info(f'Counters are already stored in "{target}" mode')
+            return
+        log.info(f'Migrating counters of {cfg.dbname} from "{current}" to "{target}" mode' +
+                 (' (dry run)' if dry_run else ''))
+        if current is not None:
+            if target == 'daily':
+                await migrate_to_daily(db, batch_size, dry_run)
+            else:
+                await migrate_to_periods(db, batch_size, dry_run)
+        if not dry_run:
+            await db.ds_cfg_custom.update_one({'_id': COUNTER_MODE_CONFIG}, {'$set': {'mode': target}}, upsert=True)
+            # Cached stats were computed from the old layout
+            await db.ds_cache.delete_many({})
+            log.info(f'Done, set emoji_backends.motor.counter_mode to "{target}"')
+    finally:
+        client.close()
+
+
+async def _merge(cfg: MotorConfig, dry_run: bool):
+    client = mas.AsyncIOMotorClient(cfg.uri)
+    try:
+        await merge_duplicates(client[cfg.dbname], dry_run)
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate counters of the Motor backend between counter modes')
+    parser.add_argument('--to', choices=COUNTER_MODES, dest='target')
+    parser.add_argument('--merge-duplicates', action='store_true',
+                        help='merge counters that share the key of their unique index, before migrating')
+    parser.add_argument('--config', default='emoji_cfg.yaml')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be written and removed')
+    args = parser.parse_args(argv)
+    if args.target is None and not args.merge_duplicates:
+        parser.error('one of --to and --merge-duplicates is required')
+
+    cfg = Config(args.config).require_backend_config_as('motor', MotorConfig)
+    if args.merge_duplicates:
+        asyncio.run(_merge(cfg, args.dry_run))
+    if args.target is not None:
+        asyncio.run(migrate(cfg, args.target, args.batch_size, args.dry_run))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
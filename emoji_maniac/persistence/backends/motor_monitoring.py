@@ -0,0 +1,147 @@
+import json
+import random
+import threading
+import typing
+from dataclasses import dataclass
+
+from pymongo import monitoring
+
+from emoji_maniac.log import get_logger
+from emoji_maniac.metrics import REGISTRY
+
+COMMAND_SECONDS = REGISTRY.histogram('emoji_maniac_mongo_command_seconds', 'Duration of MongoDB commands',
+                                     ('operation', 'collection'))
+SLOW_COMMANDS = REGISTRY.counter('emoji_maniac_mongo_slow_commands_total', 'MongoDB commands over the slow threshold',
+                                 ('operation', 'collection'))
+
+# Handshake, authentication and session housekeeping
+IGNORED_COMMANDS = {'hello', 'ismaster', 'isMaster', 'ping', 'buildinfo', 'buildInfo', 'saslStart',
+                    'saslContinue', 'authenticate', 'getnonce', 'endSessions', 'killCursors'}
+# Write command -> field with its statements
+WRITE_STATEMENTS = {'insert': 'documents', 'update': 'updates', 'delete': 'deletes'}
+
+# (operation, collection, statements or None when documents are counted from the reply, query shape)
+_Pending = typing.Tuple[str, str, typing.Optional[int], typing.Any]
+
+
+@dataclass
+class CommandStats:
+    count: int = 0
+    failures: int = 0
+    slow: int = 0
+    documents: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0
+
+
+def query_shape(value: typing.Any) -> typing.Any:
+    """
+    Replaces values of a filter, update or pipeline with "?", keeping field names, operators and field paths
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for (key, item) in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]
+    if isinstance(value, str) and value.startswith('$'):
+        return value
+    return '?'
+
+
+def describe_command(command_name: str, command: typing.Mapping) -> _Pending:
+    """
+    Returns the operation, collection, number of write statements and query of a command. Writes of more than
+    one statement are reported as bulk_write and finds limited to one document as find_one
+    """
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        collection = command.get('collection', '')
+    if command_name in WRITE_STATEMENTS:
+        statements = command.get(WRITE_STATEMENTS[command_name]) or []
+        operation = 'bulk_write' if len(statements) > 1 else command_name
+        query = statements[0].get('q') if statements and command_name != 'insert' else None
+        return operation, collection, len(statements), query
+    if command_name == 'find':
+        single = command.get('limit') in (1, -1) and command.get('singleBatch', command.get('limit') == -1)
+        return 'find_one' if single else 'find', collection, None, command.get('filter')
+    if command_name == 'aggregate':
+        return 'aggregate', collection, None, command.get('pipeline')
+    return command_name, collection, None, command.get('query') or command.get('filter')
+
+
+def _reply_documents(reply: typing.Mapping) -> int:
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+    return reply.get('n', 0) if isinstance(reply.get('n'), int) else 0
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+
+    CommandMonitor records duration, collection, operation and document count of a sample of MongoDB
+    commands and keeps per-operation stats. Recorded commands slower than `slow_ms` are logged to
+    the SlowQuery logger with the shape of their query, values are never logged.
+    pymongo calls listeners from its threads, so the stats are guarded by a lock
+
+    """
+
+    _pending: typing.Dict[typing.Tuple[int, typing.Any], _Pending]
+    _stats: typing.Dict[str, CommandStats]
+
+    def __init__(self, slow_ms: float = 100, sample_rate: float = 1.0):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._pending = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.log = get_logger('SlowQuery')
+
+    @property
+    def stats(self) -> typing.Dict[str, CommandStats]:
+        with self._lock:
+            return {operation: CommandStats(**vars(stats)) for (operation, stats) in self._stats.items()}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self._pending[(event.request_id, event.connection_id)] = describe_command(event.command_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is not None:
+            self._record(pending, event.duration_micros / 1000, False, event.reply)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is not None:
+            self._record(pending, event.duration_micros / 1000, True, None)
+
+    def _record(self, pending: _Pending, duration_ms: float, failed: bool, reply: typing.Optional[typing.Mapping]):
+        (operation, collection, statements, query) = pending
+        documents = statements if statements is not None else _reply_documents(reply or {})
+        slow = duration_ms >= self.slow_ms
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                stats = self._stats[operation] = CommandStats()
+            stats.count += 1
+            stats.documents += documents
+            stats.total_ms += duration_ms
+            stats.max_ms = max(stats.max_ms, duration_ms)
+            if failed:
+                stats.failures += 1
+            if slow:
+                stats.slow += 1
+            COMMAND_SECONDS.observe(duration_ms / 1000, operation=operation, collection=collection)
+            if slow:
+                SLOW_COMMANDS.inc(operation=operation, collection=collection)
+        if slow:
+            shape = json.dumps(query_shape(query), default=str) if query is not None else '-'
+            self.log.warning(f'{duration_ms:.1f}ms {operation} {collection} documents={documents}'
+                             f'{" failed" if failed else ""} query={shape}')
@@ -0,0 +1,339 @@
+import asyncio
+import pickle
+import sqlite3
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from os import path
+
+import discord
+
+from emoji_maniac.bot.config import Config
+from emoji_maniac.persistence.counters import Counters
+from emoji_maniac.persistence.emoji_backend import EmojiBackend, EmojiSource, Emoji, MessageEmoji
+from emoji_maniac.persistence.models import StatsEmoji
+
+# usr_id of guild-wide counters
+GUILD_USER_ID = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counters (
+    gld_id INTEGER NOT NULL,
+    usr_id INTEGER NOT NULL,
+    period TEXT NOT NULL,
+    emoji_uid TEXT NOT NULL,
+    hits INTEGER NOT NULL,
+    PRIMARY KEY (gld_id, usr_id, period, emoji_uid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS counters_top ON counters (gld_id, usr_id, period, hits DESC);
+
+CREATE TABLE IF NOT EXISTS emojies (
+    gld_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    usr_id INTEGER NOT NULL,
+    src_uid TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    is_reaction INTEGER NOT NULL,
+    emoji_uid TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS emojies_source ON emojies (src_uid);
+CREATE INDEX IF NOT EXISTS emojies_user_events ON emojies (gld_id, usr_id, at);
+
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS config (
+    domain TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (domain, name)
+);
+'''
+
+INCREMENT_COUNTER = '''
+INSERT INTO counters (gld_id, usr_id, period, emoji_uid, hits) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (gld_id, usr_id, period, emoji_uid) DO UPDATE SET hits = hits + excluded.hits
+'''
+
+INSERT_EVENT = 'INSERT INTO emojies (gld_id, msg_id, usr_id, src_uid, count, is_reaction, emoji_uid, at) ' \
+               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+
+
+@dataclass
+class SQLiteConfig:
+    path: str = None
+    commit_interval: float = 0.5
+    commit_max_statements: int = 1000
+
+
+class SQLiteEmojiBackend(EmojiBackend):
+    """
+
+    SQLiteEmojiBackend stores everything in a single SQLite database in WAL mode.
+    All statements are executed by one worker thread, writes are grouped into transactions that are
+    committed every commit_interval seconds or after commit_max_statements statements
+
+    """
+
+    _cfg: SQLiteConfig
+    _conn: sqlite3.Connection
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, config: Config):
+        super(SQLiteEmojiBackend, self).__init__(config)
+        self._cfg = SQLiteConfig(**(config.get_backend_config('sqlite') or {}))
+        db_path = self._cfg.path or config.get_storage_dir('emoji_maniac.sqlite3')
+        self.log.info(f'SQLite database = {db_path}')
+        if db_path != ':memory:':
+            directory = path.dirname(db_path)
+            if directory and not path.isdir(directory):
+                raise FileNotFoundError(f'Directory {directory} does not exist')
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._uncommitted = 0
+        self._commit_task: typing.Optional[asyncio.Task] = None
+
+    async def init(self):
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.ensure_future(self._commit_loop())
+
+    async def close(self):
+        if self._commit_task is not None:
+            self._commit_task.cancel()
+            self._commit_task = None
+        await self._run(self._commit)
+        await self._run(self._conn.close)
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def _commit_loop(self):
+        while True:
+            await asyncio.sleep(self._cfg.commit_interval)
+            try:
+                await self._run(self._commit)
+            except Exception as exc:
+                self.log.error(f'Failed to commit: {exc}')
+
+    def _commit(self):
+        if self._uncommitted:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def _write_many(self, statements: typing.List[typing.Tuple[str, typing.List[tuple]]]):
+        for (sql, params) in statements:
+            if params:
+                self._conn.executemany(sql, params)
+                self._uncommitted += len(params)
+        if self._uncommitted >= self._cfg.commit_max_statements:
+            self._commit()
+
+    async def _write(self, sql: str, params: typing.List[tuple]):
+        await self._run(self._write_many, [(sql, params)])
+
+    def _fetch_all(self, sql: str, params: tuple = ()):
+        return self._conn.execute(sql, params).fetchall()
+
+    async def _fetch(self, sql: str, params: tuple = ()) -> typing.List[tuple]:
+        return await self._run(self._fetch_all, sql, params)
+
+    @staticmethod
+    def _counter_rows(guild_id: int, user_id: int, values: typing.Dict[str, int], periods: typing.Iterable[str]):
+        return [
+            (guild_id, usr_id, period, emoji_uid, hits)
+            for period in periods
+            for usr_id in (GUILD_USER_ID, user_id)
+            for (emoji_uid, hits) in values.items()
+        ]
+
+    async def _submit_counters(self, guild_id: int, user_id: int, values: typing.Dict[str, int]):
+        tz = await self.get_guild_tz(guild_id)
+        await self._write(INCREMENT_COUNTER, self._counter_rows(guild_id, user_id, values,
+                                                                Counters.period_modifiers(tz)))
+        await self.invalidate_stats_cache(guild_id)
+
+    async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self._submit_counters(guild_id, user_id, {emoji_obj.uid: 1})
+
+    async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji_obj: Emoji):
+        await self._submit_counters(guild_id, user_id, {emoji_obj.uid: -1})
+
+    async def submit_message(self, message: discord.Message, emojis: typing.List[MessageEmoji]):
+        values = {}
+        for em in emojis:
+            values[em.uid] = values.get(em.uid, 0) + em.count
+        await self._submit_counters(message.guild.id, message.author.id, values)
+
+    async def submit_history(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]]):
+        await self._write_history(records, True)
+
+    async def update_counters(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]]):
+        await self._write_history(records, False)
+
+    async def _write_history(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji, datetime]],
+                             raw_events: bool):
+        counter_rows = []
+        events = []
+        written = set()
+        for (source, emoji_obj, at) in records:
+            tz = await self.get_guild_tz(source.guild_id)
+            counter_rows += self._counter_rows(source.guild_id, source.user_id, {emoji_obj.uid: emoji_obj.count},
+                                               Counters.period_modifiers(tz, at))
+            if raw_events:
+                events.append(self._event_row(source, emoji_obj, at))
+            written.add(source.guild_id)
+        await self._run(self._write_many, [(INCREMENT_COUNTER, counter_rows), (INSERT_EVENT, events)])
+        for guild_id in written:
+            await self.invalidate_stats_cache(guild_id)
+
+    async def _top10(self, guild_id: int, user_id: typing.Optional[int], period: str) -> typing.List[StatsEmoji]:
+        rows = await self._fetch(
+            'SELECT emoji_uid, hits FROM counters WHERE gld_id = ? AND usr_id = ? AND period = ? AND hits > 0 '
+            'ORDER BY hits DESC LIMIT 10',
+            (guild_id, GUILD_USER_ID if user_id is None else user_id, period))
+        return self._make_stats(rows)
+
+    async def get_emojis_top10(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        return await self._top10(guild_id, user_id, 'total')
+
+    async def get_emojis_top10_yearly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return await self._top10(guild_id, user_id, Counters.year_modifier(tz))
+
+    async def get_emojis_top10_monthly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return await self._top10(guild_id, user_id, Counters.month_modifier(tz))
+
+    async def get_emojis_top10_weekly(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return await self._top10(guild_id, user_id, Counters.week_modifier(tz))
+
+    async def get_emojis_top10_daily(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
+        tz = await self.get_guild_tz(guild_id)
+        return await self._top10(guild_id, user_id, Counters.day_modifier(tz))
+
+    @staticmethod
+    def _timestamp(at: datetime = None) -> float:
+        if at is None:
+            return time.time()
+        if at.tzinfo is None:
+            # Naive datetimes (discord.py) are in UTC
+            at = at.replace(tzinfo=timezone.utc)
+        return at.timestamp()
+
+    @classmethod
+    def _event_row(cls, source: EmojiSource, emoji_obj: MessageEmoji, at: datetime = None) -> tuple:
+        return (source.guild_id, source.message_id, source.user_id, source.uid, emoji_obj.count,
+                int(source.reaction), emoji_obj.uid, cls._timestamp(at))
+
+    async def submit_emoji(self, source: EmojiSource, emoji_obj: MessageEmoji):
+        await self._write(INSERT_EVENT, [self._event_row(source, emoji_obj)])
+
+    async def submit_bulk(self, records: typing.List[typing.Tuple[EmojiSource, MessageEmoji]]):
+        await self._write(INSERT_EVENT, [self._event_row(s, e) for (s, e) in records])
+
+    async def remove_emoji_source(self, source: EmojiSource):
+        await self._write('DELETE FROM emojies WHERE src_uid = ?', [(source.uid,)])
+
+    async def remove_emoji(self, source: EmojiSource, emoji_obj: Emoji):
+        await self._write('DELETE FROM emojies WHERE src_uid = ? AND is_reaction = ? AND emoji_uid = ?',
+                          [(source.uid, int(source.reaction), emoji_obj.uid)])
+
+    async def get_stored_messages(self, guild_id: int, message_ids: typing.Collection[int]) -> typing.Set[int]:
+        if not message_ids:
+            return set()
+        rows = await self._fetch(
+            f'SELECT DISTINCT msg_id FROM emojies WHERE gld_id = ? AND is_reaction = 0 '
+            f'AND msg_id IN ({", ".join("?" * len(message_ids))})',
+            (guild_id, *message_ids)
+        )
+        return {msg_id for (msg_id,) in rows}
+
+    async def get_emojis_top(self, guild_id: int = None, last_n_days: int = None,
+                             user_id: int = None, limit: int = None) -> typing.List[StatsEmoji]:
+        conditions = []
+        params = []
+        if guild_id is not None:
+            conditions.append('gld_id = ?')
+            params.append(guild_id)
+        if user_id is not None:
+            conditions.append('usr_id = ?')
+            params.append(user_id)
+        if last_n_days is not None:
+            conditions.append('at > ?')
+            params.append(time.time() - timedelta(days=last_n_days).total_seconds())
+        sql = 'SELECT emoji_uid, SUM(count) AS total FROM emojies'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' GROUP BY emoji_uid ORDER BY total DESC'
+        if limit is not None:
+            sql += f' LIMIT {max(int(limit), 1)}'
+        return self._make_stats(await self._fetch(sql, tuple(params)))
+
+    async def _put_cache(self, key: str, value, age: timedelta):
+        await self._write('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                          [(key, pickle.dumps(value), time.time() + age.total_seconds())])
+
+    async def _get_cache(self, key: str):
+        rows = await self._fetch('SELECT value FROM cache WHERE key = ? AND expires_at > ?', (key, time.time()))
+        if not rows:
+            return None
+        try:
+            return pickle.loads(rows[0][0])
+        except Exception as exc:
+            self.log.error('Failed to load cache: ' + str(exc))
+            return None
+
+    async def _clear_cache(self):
+        await self._write('DELETE FROM cache', [()])
+
+    async def _invalidate_cache(self, prefixes: typing.List[str]):
+        await self._write('DELETE FROM cache WHERE substr(key, 1, length(?)) = ?', [(p, p) for p in prefixes])
+
+    async def get_persistent_config(self, name: str, key: str):
+        return await self._get_persistent_config('custom', name, key)
+
+    async def update_persistent_config(self, name: str, data: dict, override: bool = False):
+        await self._update_persistent_config('custom', name, data, override)
+
+    async def get_guild_config(self, guild_id: int, key: str = None):
+        return await self._get_persistent_config('guild', guild_id, key)
+
+    async def _update_guild_config(self, guild_id: int, data: dict, override: bool = False):
+        await self._update_persistent_config('guild', guild_id, data, override)
+
+    async def has_guild_config(self, guild_id: int) -> bool:
+        return (await self._get_persistent_config('guild', guild_id, None)) is not None
+
+    def _load_config_doc(self, domain: str, name) -> typing.Optional[dict]:
+        rows = self._fetch_all('SELECT data FROM config WHERE domain = ? AND name = ?', (domain, str(name)))
+        return pickle.loads(rows[0][0]) if rows else None
+
+    def _merge_config_doc(self, domain: str, name, data: dict, override: bool):
+        doc = None if override else self._load_config_doc(domain, name)
+        doc = {'_id': name, **(doc or {}), **data}
+        self._write_many([('INSERT OR REPLACE INTO config (domain, name, data) VALUES (?, ?, ?)',
+                           [(domain, str(name), pickle.dumps(doc))])])
+
+    async def _get_persistent_config(self, domain: str, name, key: str):
+        doc = await self._run(self._load_config_doc, domain, name)
+        if key is None:
+            return doc
+        if doc:
+            return doc.get(key)
+        else:
+            return None
+
+    async def _update_persistent_config(self, domain: str, name, data: dict, override: bool = False):
+        # Read and write happen in the worker thread, so concurrent updates do not overwrite each other
+        await self._run(self._merge_config_doc, domain, name, data, override)
@@ -0,0 +1,92 @@
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+
+class LRUCache:
+    """
+
+    LRUCache is a bounded in-process cache with per-entry expiration time, least recently used entries
+    are evicted once the cache is full
+
+    """
+
+    _data: 'OrderedDict[typing.Hashable, typing.Tuple[typing.Optional[float], typing.Any]]'
+
+    def __init__(self, max_size: int = 1024, ttl: typing.Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    @staticmethod
+    def _is_expired(entry) -> bool:
+        return entry[0] is not None and entry[0] <= time.monotonic()
+
+    def get(self, key: typing.Hashable, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return default
+        if self._is_expired(entry):
+            del self._data[key]
+            self.stats.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.stats.hits += 1
+        return entry[1]
+
+    def peek(self, key: typing.Hashable, default=None):
+        """
+        Returns the value without counting a hit or a miss and without making the entry recently used
+        """
+        entry = self._data.get(key)
+        if entry is None or self._is_expired(entry):
+            return default
+        return entry[1]
+
+    def put(self, key: typing.Hashable, value, ttl: typing.Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (None if ttl is None else time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats.evictions += 1
+
+    def invalidate(self, key: typing.Hashable):
+        if self._data.pop(key, None) is not None:
+            self.stats.invalidations += 1
+
+    def invalidate_if(self, predicate: typing.Callable[[typing.Hashable], bool]):
+        keys = [key for key in self._data.keys() if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        self.stats.invalidations += len(keys)
+
+    def clear(self):
+        self._data.clear()
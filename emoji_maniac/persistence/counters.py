@@ -0,0 +1,122 @@
+import typing
+from datetime import datetime, timezone, date, timedelta
+from math import ceil
+
+
+class Counters:
+    """
+
+    Counters builds period keys (total, year, month, week and day in the guild's timezone) and counter names.
+    Days are also represented as yyyymmdd numbers, daily counters are stored with such keys
+
+    """
+
+    @staticmethod
+    def _week_number_util(dt):
+        first_day = dt.replace(day=1)
+
+        dom = dt.day
+        adjusted_dom = dom + first_day.weekday()
+
+        return int(ceil(adjusted_dom / 7.0))
+
+    @staticmethod
+    def _local_time(tz: timezone, at: datetime = None):
+        if at is None:
+            return datetime.now(tz)
+        if at.tzinfo is None:
+            # Naive datetimes (discord.py, MongoDB) are in UTC
+            at = at.replace(tzinfo=timezone.utc)
+        return at.astimezone(tz)
+
+    @classmethod
+    def period_modifiers(cls, tz: timezone, at: datetime = None):
+        now = cls._local_time(tz, at)
+        year = str(now.year)
+        month = str(now.year * 100 + now.month)
+        week = str(now.year * 1000 + now.month * 10 + cls._week_number_util(now))
+        day = str(now.year * 10000 + now.month * 100 + now.day)
+        return 'total', year, month, week, day
+
+    @classmethod
+    def daily_modifiers(cls, tz: timezone, at: datetime = None):
+        return 'total', str(cls.day_key(cls._local_time(tz, at)))
+
+    @staticmethod
+    def day_key(dt: typing.Union[date, datetime]) -> int:
+        return dt.year * 10000 + dt.month * 100 + dt.day
+
+    @staticmethod
+    def date_of_key(day: int) -> date:
+        return date(day // 10000, day // 100 % 100, day % 100)
+
+    @classmethod
+    def previous_day(cls, day: int) -> int:
+        return cls.day_key(cls.date_of_key(day) - timedelta(days=1))
+
+    @classmethod
+    def period_keys_of_day(cls, day: int) -> typing.Tuple[str, str, str, str]:
+        """
+        Returns year, month, week and day keys of the day
+        """
+        at = cls.date_of_key(day)
+        return cls.period_modifiers(timezone.utc, datetime(at.year, at.month, at.day))[1:]
+
+    @classmethod
+    def period_days(cls, period: str, tz: timezone, at: datetime = None) -> typing.Tuple[int, int]:
+        """
+        Returns the first day of the current year, month, week or day and the current day as yyyymmdd numbers
+        """
+        now = cls._local_time(tz, at)
+        if period == 'year':
+            first = now.replace(month=1, day=1)
+        elif period == 'month':
+            first = now.replace(day=1)
+        elif period == 'week':
+            # Weeks are counted within the month, so the first and the last week of a month may be shorter
+            week = cls._week_number_util(now)
+            first = now.replace(day=max(1, 7 * (week - 1) - now.replace(day=1).weekday() + 1))
+        elif period == 'day':
+            first = now
+        else:
+            raise ValueError(f'Unknown period: {period}')
+        return cls.day_key(first), cls.day_key(now)
+
+    @staticmethod
+    def year_modifier(tz: timezone):
+        return str(datetime.now(tz).year)
+
+    @staticmethod
+    def month_modifier(tz: timezone):
+        now = datetime.now(tz)
+        return str(now.year * 100 + now.month)
+
+    @classmethod
+    def week_modifier(cls, tz: timezone):
+        now = datetime.now(tz)
+        return str(now.year * 1000 + now.month * 10 + cls._week_number_util(now))
+
+    @staticmethod
+    def day_modifier(tz: timezone):
+        now = datetime.now(tz)
+        return str(now.year * 10000 + now.month * 100 + now.day)
+
+    @classmethod
+    def guild_counters(cls, guild_id: int, tz: timezone, at: datetime = None, daily: bool = False):
+        modifiers = cls.daily_modifiers(tz, at) if daily else cls.period_modifiers(tz, at)
+        return [
+            f'g{guild_id}_' + item
+            for item in modifiers
+        ]
+
+    @classmethod
+    def user_counters(cls, guild_id: int, user_id: int, tz: timezone, at: datetime = None, daily: bool = False):
+        modifiers = cls.daily_modifiers(tz, at) if daily else cls.period_modifiers(tz, at)
+        return [
+            f'u{guild_id}-{user_id}_' + item
+            for item in modifiers
+        ]
+
+    @classmethod
+    def emoji_counters(cls, emoji_uid: str, guild_id: int, tz: timezone):
+        return [(f'{emoji_uid}-{guild_id}', mod) for mod in cls.period_modifiers(tz)]
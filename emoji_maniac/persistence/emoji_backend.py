@@ -1,28 +1,102 @@
 import abc
+import inspect
 import logging
 
 import typing
+import uuid
+from dataclasses import dataclass
+from functools import partial
 from datetime import timedelta, datetime, timezone
 
 import discord
 import discord.ext.commands as commands
 
-from emoji_maniac.bot.config import Config
+from emoji_maniac.bot.config import Config, RetentionConfig
 from emoji_maniac.log import get_logger
-from emoji_maniac.persistence.models import EmojiSource, Emoji, MessageEmoji, StatsEmoji
+from emoji_maniac.metrics import REGISTRY, instrument_coroutines
+from emoji_maniac.persistence.cache import LRUCache
+from emoji_maniac.persistence.models import EmojiSource, Emoji, MessageEmoji, StatsEmoji, GuildConfig, EmojiBatch, \
+    HistoryRecord, EventRemoval
+
+_MISSING = object()
+
+BACKEND_SECONDS = REGISTRY.histogram('emoji_maniac_backend_seconds', 'Duration of EmojiBackend calls',
+                                     ('backend', 'method'))
+BACKEND_ERRORS = REGISTRY.counter('emoji_maniac_backend_errors_total', 'EmojiBackend calls that raised',
+                                  ('backend', 'method'))
+
+
+class PartialWriteError(Exception):
+    """
+    Raised when only some of the writes of a call were applied, `retry` writes the rest. Repeating the whole
+    call would apply the others twice
+    """
+
+    def __init__(self, message: str, retry: typing.Callable[[], typing.Awaitable]):
+        super(PartialWriteError, self).__init__(message)
+        self.retry = retry
+
+
+async def write_steps(steps: typing.List[typing.Callable[[], typing.Awaitable]]):
+    """
+    Runs dependent writes in order. If one of them fails after others were applied, PartialWriteError
+    continues with the failed one
+    """
+    for (index, step) in enumerate(steps):
+        try:
+            await step()
+        except PartialWriteError as exc:
+            raise PartialWriteError(str(exc), partial(write_steps, [exc.retry] + steps[index + 1:])) from exc
+        except Exception as exc:
+            if index == 0:
+                raise
+            raise PartialWriteError(f'Write {index + 1} of {len(steps)} failed: {exc!r}',
+                                    partial(write_steps, steps[index:])) from exc
+
+
+@dataclass
+class RetentionStats:
+    collection: str
+    # folded, deleted or archived
+    action: str
+    documents: int = 0
+    # Estimated from the average document size of the collection, 0 if unknown
+    reclaimed_bytes: int = 0
+    duration: float = 0
+
+    @property
+    def documents_per_second(self) -> float:
+        return self.documents / self.duration if self.duration else 0
 
 
 class EmojiBackend(abc.ABC):
     log: logging.Logger
     config: Config
+    _guild_cfg_cache: LRUCache
+    _local_cache: LRUCache
+    # Guilds whose generation token was replaced in the shared cache tier within the last local_ttl seconds
+    _shared_generations: LRUCache
+    # Whether the data lives in the process memory, other processes (event queue writers) cannot share it
+    in_process: bool = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every public coroutine of the interface is timed per backend
+        instrument_coroutines(cls, INSTRUMENTED_METHODS, BACKEND_SECONDS, BACKEND_ERRORS, backend=cls.__name__)
 
     def __init__(self, config: Config):
         self.config = config
         self.log = get_logger(type(self).__name__)
+        self._guild_cfg_cache = LRUCache(config.cache_cfg.guild_config_size, config.cache_cfg.guild_config_ttl)
+        self._local_cache = LRUCache(config.cache_cfg.local_size, config.cache_cfg.local_ttl)
+        self._shared_generations = LRUCache(config.cache_cfg.local_size, config.cache_cfg.local_ttl)
 
     async def init(self):
         pass
 
+    async def close(self):
+        pass
+
     @abc.abstractmethod
     async def submit_reaction(self, guild_id: int, message_id: int, user_id: int, emoji: Emoji):
         pass
@@ -31,10 +105,84 @@ class EmojiBackend(abc.ABC):
     async def remove_reaction(self, guild_id: int, message_id: int, user_id: int, emoji: Emoji):
         pass
 
+    @abc.abstractmethod
+    async def remove_emoji_source(self, source: EmojiSource):
+        """
+        Deletes all raw events of the source without touching the counters
+        """
+        pass
+
+    @abc.abstractmethod
+    async def remove_emoji(self, source: EmojiSource, emoji: Emoji):
+        """
+        Deletes raw events of one emoji of the source without touching the counters
+        """
+        pass
+
     @abc.abstractmethod
     async def submit_message(self, message: discord.Message, emojis: typing.List[MessageEmoji]):
         pass
 
+    @abc.abstractmethod
+    async def submit_history(self, records: typing.Union[typing.List[HistoryRecord], EmojiBatch]):
+        """
+        Stores a batch of emojis from past messages and reactions, counters are updated for the periods
+        the emojis were posted in. An EmojiBatch iterates as a list of records
+        """
+        pass
+
+    @abc.abstractmethod
+    async def update_counters(self, records: typing.Union[typing.List[HistoryRecord], EmojiBatch]):
+        """
+        Adds counts of the records, negative for removed emojis, to the counters of the periods the records
+        were posted in without storing raw events. Used to correct counters of edited and deleted messages
+        """
+        pass
+
+    async def submit_events(self, batch: EmojiBatch):
+        """
+        Stores a batch of live events like submit_history, except for records with negative counts (removed
+        reactions): they are subtracted from the counters and delete the raw events of their source and emoji,
+        negative raw events would leave emojis with no mentions in the stats of raw events.
+        Raises PartialWriteError if it fails after some of the writes were applied
+        """
+        added = EmojiBatch()
+        removals = []
+        for (guild_id, message_id, user_id, reaction, emoji_obj, count, at) in batch.rows():
+            if count < 0:
+                removals.append((EmojiSource(guild_id, message_id, user_id, reaction), emoji_obj.with_count(count),
+                                 datetime.utcfromtimestamp(at)))
+            else:
+                added.append(guild_id, message_id, user_id, reaction, emoji_obj, count, at)
+        steps = []
+        if added:
+            steps.append(lambda: self.submit_history(added))
+        if removals:
+            steps.append(lambda: self.update_counters(removals))
+            removed = {(source, emoji_obj.with_count(1)) for (source, emoji_obj, _) in removals}
+            steps += [partial(self.remove_emoji, source, emoji_obj) for (source, emoji_obj) in removed]
+        await write_steps(steps)
+
+    async def submit_corrections(self, records: typing.List[HistoryRecord], removed: typing.List[EventRemoval]):
+        """
+        Adds the records to the counters without storing raw events and deletes the removed raw events, used to
+        correct edited and deleted messages and cleared reactions. Raises PartialWriteError if it fails after
+        some of the writes were applied
+        """
+        steps = []
+        if records:
+            steps.append(partial(self.update_counters, records))
+        steps += [partial(self.remove_emoji_source, source) if emoji_obj is None
+                  else partial(self.remove_emoji, source, emoji_obj) for (source, emoji_obj) in removed]
+        await write_steps(steps)
+
+    @abc.abstractmethod
+    async def get_stored_messages(self, guild_id: int, message_ids: typing.Collection[int]) -> typing.Set[int]:
+        """
+        Returns ids of the messages whose content emojis have raw events stored, reactions are not considered
+        """
+        pass
+
     @abc.abstractmethod
     async def get_emojis_top10(self, guild_id: int, user_id: int = None) -> typing.List[StatsEmoji]:
         pass
@@ -56,17 +204,102 @@ class EmojiBackend(abc.ABC):
         pass
 
     @abc.abstractmethod
-    async def get_cache(self, key: str):
+    async def _get_cache(self, key: str):
         pass
 
     @abc.abstractmethod
-    async def put_cache(self, key: str, value, age: timedelta = timedelta(minutes=10)):
+    async def _put_cache(self, key: str, value, age: timedelta):
         pass
 
     @abc.abstractmethod
-    async def clear_cache(self):
+    async def _clear_cache(self):
         pass
 
+    @abc.abstractmethod
+    async def _invalidate_cache(self, prefixes: typing.List[str]):
+        pass
+
+    async def get_cache(self, key: str):
+        """
+        Returns cached value from the in-process cache or, if it is not there, from the backend's cache storage
+        """
+        if not self.config.cache_cfg.enabled:
+            return None
+        value = self._local_cache.get(key)
+        if value is None:
+            value = await self._get_cache(key)
+            if value is not None:
+                self._local_cache.put(key, value)
+        return value
+
+    async def put_cache(self, key: str, value, age: timedelta = timedelta(minutes=10)):
+        if not self.config.cache_cfg.enabled:
+            return
+        self._local_cache.put(key, value, min(age.total_seconds(), self.config.cache_cfg.local_ttl))
+        await self._put_cache(key, value, age)
+
+    async def clear_cache(self):
+        self._local_cache.clear()
+        self._shared_generations.clear()
+        await self._clear_cache()
+
+    async def invalidate_cache(self, prefixes: typing.List[str]):
+        """
+        Drops entries whose keys start with one of the prefixes from both cache tiers
+        """
+        prefixes = tuple(prefixes)
+        self._local_cache.invalidate_if(lambda key: isinstance(key, str) and key.startswith(prefixes))
+        await self._invalidate_cache(list(prefixes))
+
+    @property
+    def stats_cacheable(self) -> bool:
+        """
+        Whether results of top-10 queries are worth caching, False for backends that answer them from memory
+        """
+        return True
+
+    @property
+    def local_cache_stats(self):
+        return self._local_cache.stats
+
+    @staticmethod
+    def stats_cache_key(guild_id: int, user_id: typing.Optional[int], period, generation: str = None) -> str:
+        return f'stats:{guild_id}:{generation or 0}:{"guild" if user_id is None else user_id}:{period}'
+
+    async def _stats_generation(self, guild_id: int) -> typing.Optional[str]:
+        """
+        Returns the token that stats cache keys of the guild include, it changes whenever counters of the guild
+        are written. Other processes see a new token once their in-process copy expires after local_ttl
+        """
+        return await self.get_cache(f'stats-gen:{guild_id}')
+
+    async def put_stats_cache(self, guild_id: int, user_id: typing.Optional[int], period, value):
+        generation = await self._stats_generation(guild_id)
+        await self.put_cache(self.stats_cache_key(guild_id, user_id, period, generation), value,
+                             timedelta(seconds=self.config.cache_cfg.stats_ttl))
+
+    async def get_stats_cache(self, guild_id: int, user_id: typing.Optional[int], period):
+        generation = await self._stats_generation(guild_id)
+        return await self.get_cache(self.stats_cache_key(guild_id, user_id, period, generation))
+
+    async def invalidate_stats_cache(self, guild_id: int):
+        """
+        Makes cached stats of the guild unreachable by replacing its generation token, must be called after
+        counters are written. Entries of the old token age out on their own. The token lives as long as the
+        entries, so keys without a token only match entries put before it.
+        The in-process token is replaced on every write, the shared one at most once per local_ttl seconds
+        per guild, which is as often as other processes read it anyway
+        """
+        cache_cfg = self.config.cache_cfg
+        if not cache_cfg.enabled:
+            return
+        key = f'stats-gen:{guild_id}'
+        generation = uuid.uuid4().hex
+        self._local_cache.put(key, generation, min(cache_cfg.stats_ttl, cache_cfg.local_ttl))
+        if guild_id not in self._shared_generations:
+            self._shared_generations.put(guild_id, True)
+            await self._put_cache(key, generation, timedelta(seconds=cache_cfg.stats_ttl))
+
     @abc.abstractmethod
     async def get_persistent_config(self, name: str, key: str):
         pass
@@ -84,14 +317,53 @@ class EmojiBackend(abc.ABC):
         pass
 
     @abc.abstractmethod
-    async def update_guild_config(self, guild_id: int, data: dict, override: bool = False):
+    async def _update_guild_config(self, guild_id: int, data: dict, override: bool = False):
         pass
 
+    async def update_guild_config(self, guild_id: int, data: dict, override: bool = False):
+        await self._update_guild_config(guild_id, data, override)
+        self._guild_cfg_cache.invalidate(guild_id)
+
+    async def get_guild_settings(self, guild_id: int) -> GuildConfig:
+        """
+        Returns decoded guild configuration, served from the in-process cache when possible
+        """
+        settings = self._guild_cfg_cache.get(guild_id, _MISSING)
+        if settings is _MISSING:
+            settings = GuildConfig.from_doc(await self.get_guild_config(guild_id))
+            self._guild_cfg_cache.put(guild_id, settings)
+        return settings
+
+    @property
+    def guild_config_cache_stats(self):
+        return self._guild_cfg_cache.stats
+
+    @staticmethod
+    def _make_stats(counts: typing.Iterable[typing.Tuple[str, int]]) -> typing.List[StatsEmoji]:
+        """
+        Converts (emoji uid, hits) pairs sorted by hits to StatsEmoji list with percentages
+        """
+        decoded = []
+        for (uid, hits) in counts:
+            if uid is None or hits is None:
+                continue
+            emoji_obj = Emoji.from_uid(uid)
+            if emoji_obj is None:
+                continue
+            decoded.append((emoji_obj, hits))
+        total = sum(hits for (_, hits) in decoded)
+        return [StatsEmoji(emoji=emoji_obj, total_mentions=hits, percentage=hits / total * 100 if total else 0)
+                for (emoji_obj, hits) in decoded]
+
+    async def apply_retention(self, cfg: RetentionConfig) -> typing.Optional[typing.List[RetentionStats]]:
+        """
+        Folds expired period counters into coarser ones and removes old raw events as configured, returns
+        what was done per collection or None if the backend does not support retention
+        """
+        return None
+
     async def get_guild_tz(self, guild_id: int):
-        offset = await self.get_guild_config(guild_id, 'tz_offset')
-        if offset is None:
-            return timezone.utc
-        return timezone(timedelta(hours=offset))
+        return (await self.get_guild_settings(guild_id)).tz
 
     async def set_guild_tz(self, guild_id: int, tz: timezone):
         await self.update_guild_config(guild_id, {
@@ -99,7 +371,7 @@ class EmojiBackend(abc.ABC):
         })
 
     async def get_guild_prefix(self, guild_id: int):
-        return await self.get_guild_config(guild_id, 'cmd_prefix')
+        return (await self.get_guild_settings(guild_id)).prefix
 
     async def set_guild_prefix(self, guild_id: int, prefix: str):
         await self.update_guild_config(guild_id, {
@@ -113,7 +385,7 @@ class EmojiBackend(abc.ABC):
         return datetime.utcnow()
 
     async def get_guild_lang(self, guild_id: int):
-        return await self.get_guild_config(guild_id, 'lang')
+        return (await self.get_guild_settings(guild_id)).lang
 
     async def set_guild_lang(self, guild_id: int, lang: str):
         await self.update_guild_config(guild_id, {
@@ -121,6 +393,10 @@ class EmojiBackend(abc.ABC):
         })
 
 
+INSTRUMENTED_METHODS = [name for (name, func) in vars(EmojiBackend).items()
+                        if not name.startswith('_') and inspect.iscoroutinefunction(func)]
+
+
 class BackendCog(commands.Cog):
     __backend: EmojiBackend
 
@@ -0,0 +1,163 @@
+import heapq
+import typing
+from dataclasses import dataclass
+from operator import itemgetter
+
+from emoji_maniac.persistence.cache import LRUCache
+
+# (guild id, user id or None for the guild leaderboard, period kind)
+BoardKey = typing.Tuple[int, typing.Optional[int], str]
+Loader = typing.Callable[[int], typing.Awaitable[typing.List[typing.Tuple[str, int]]]]
+
+
+def period_kind(key: str) -> str:
+    """
+    Returns the kind of a period key built by Counters: total, year (yyyy), month (yyyymm), week (yyyymmw)
+    or day (yyyymmdd)
+    """
+    if key == 'total':
+        return 'total'
+    return {4: 'year', 6: 'month', 7: 'week', 8: 'day'}[len(key)]
+
+
+@dataclass
+class LeaderboardStats:
+    hits: int = 0
+    loads: int = 0
+    reloads: int = 0
+    rotations: int = 0
+    deltas: int = 0
+
+
+class TopK:
+    """
+
+    TopK keeps the largest counters of one leaderboard (emoji uid -> hits) and applies deltas to them.
+    Counters of the emojis that are not in the board are only known to be at most `floor`, so the board
+    answers a top-N query as long as its N-th counter is not below floor plus the largest delta such emojis
+    received since the board was loaded. A complete board holds every counter and always answers
+
+    """
+
+    __slots__ = ('period', 'capacity', 'counts', 'complete', 'floor', '_outside', '_folded')
+
+    def __init__(self, period: str, capacity: int, rows: typing.List[typing.Tuple[str, int]]):
+        self.period = period
+        self.capacity = capacity
+        rows = sorted(rows, key=itemgetter(1), reverse=True)
+        self.complete = len(rows) <= capacity
+        # Emojis that were never counted have zero hits, so the floor is never negative
+        self.floor = 0 if self.complete else max(0, rows[capacity][1])
+        self.counts = dict(rows[:capacity])
+        # Deltas of the emojis outside of the board; when there are too many of them, their maximum is
+        # folded into _folded, which bounds the deltas of all outside emojis from above
+        self._outside = {}
+        self._folded = 0
+
+    def apply(self, emoji_uid: str, hits: int):
+        counts = self.counts
+        if emoji_uid in counts:
+            counts[emoji_uid] += hits
+        elif self.complete:
+            counts[emoji_uid] = hits
+            if len(counts) > self.capacity:
+                (evicted, evicted_hits) = min(counts.items(), key=itemgetter(1))
+                del counts[evicted]
+                self.complete = False
+                self.floor = max(0, evicted_hits)
+        else:
+            outside = self._outside
+            outside[emoji_uid] = outside.get(emoji_uid, 0) + hits
+            if len(outside) > self.capacity:
+                self._folded += max(0, max(outside.values()))
+                outside.clear()
+
+    def top(self, n: int) -> typing.Optional[typing.List[typing.Tuple[str, int]]]:
+        """
+        Returns the top-N counters or None if the board can not tell them apart from the counters outside
+        """
+        top = heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+        if not self.complete:
+            bound = self.floor + self._folded + max(0, max(self._outside.values(), default=0))
+            # Emojis with zero or less hits are not shown, so only a positive bound matters
+            if bound > 0 and (len(top) < n or top[-1][1] < bound):
+                return None
+        return [(emoji_uid, hits) for (emoji_uid, hits) in top if hits > 0]
+
+
+class Leaderboards:
+    """
+
+    Leaderboards keeps a bounded TopK per (guild, user or whole guild, period kind) in memory, so top-10
+    queries are answered without a database round trip.
+    Boards are loaded lazily from the database with the loader passed to `top`, receive the deltas the backend
+    writes and are reloaded when the period key (day, week, month or year) changes or when the board can not
+    answer anymore. Least recently used boards are dropped once there are more than `max_boards`
+
+    """
+
+    _boards: LRUCache
+    # Boards being loaded -> whether a delta arrived during the load
+    _loading: typing.Dict[BoardKey, bool]
+
+    def __init__(self, capacity: int = 50, max_boards: int = 10000):
+        self.capacity = capacity
+        self.stats = LeaderboardStats()
+        self._boards = LRUCache(max_boards)
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._boards)
+
+    def apply(self, guild_id: int, user_id: int, emoji_uid: str, periods: typing.Iterable[str], hits: int):
+        """
+        Applies a delta that was written to the counters of the user, the guild leaderboard gets it as well
+        """
+        self.stats.deltas += 1
+        for period in periods:
+            kind = period_kind(period)
+            for key in ((guild_id, None, kind), (guild_id, user_id, kind)):
+                if key in self._loading:
+                    self._loading[key] = True
+                board = self._boards.peek(key)
+                if board is not None and board.period == period:
+                    board.apply(emoji_uid, hits)
+
+    async def top(self, guild_id: int, user_id: typing.Optional[int], period: str, loader: Loader,
+                  n: int = 10) -> typing.List[typing.Tuple[str, int]]:
+        """
+        Returns the top-N (emoji uid, hits) of the current period, the loader receives a limit and returns
+        up to that many largest counters of the period as (emoji uid, hits)
+        """
+        key = (guild_id, user_id, period_kind(period))
+        board = self._boards.get(key)
+        if board is not None:
+            if board.period == period:
+                top = board.top(n)
+                if top is not None:
+                    self.stats.hits += 1
+                    return top
+                self.stats.reloads += 1
+            else:
+                self.stats.rotations += 1
+
+        self.stats.loads += 1
+        self._loading[key] = False
+        try:
+            rows = await loader(max(self.capacity, n) + 1)
+        finally:
+            # Another load of the same board may have finished first
+            touched = self._loading.pop(key, True)
+        board = TopK(period, max(self.capacity, n), rows)
+        if touched:
+            # It is unknown whether the loaded counters include the delta, the board is loaded again next time
+            self._boards.invalidate(key)
+        else:
+            self._boards.put(key, board)
+        return board.top(n)
+
+    def invalidate(self, guild_id: int):
+        self._boards.invalidate_if(lambda key: key[0] == guild_id)
+
+    def clear(self):
+        self._boards.clear()
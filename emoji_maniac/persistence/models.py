@@ -1,80 +1,238 @@
 import base64
-from dataclasses import dataclass
-from functools import cached_property
+import sys
+import typing
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timezone, timedelta
 
 import discord
-import emoji
 
+from emoji_maniac.persistence.cache import LRUCache
 from emoji_maniac.persistence.utils import pack2b64, pack2b64_bin, unpack_from_b64
 
+# Models are immutable and, where dataclasses support it, slotted: no per-instance __dict__
+MODEL_OPTIONS = {'frozen': True, 'slots': True} if sys.version_info >= (3, 10) else {'frozen': True}
 
-@dataclass
+
+def _uid_field():
+    # Lazily computed uid, set with object.__setattr__ since the models are frozen
+    return field(default=None, init=False, repr=False, compare=False)
+
+
+@dataclass(**MODEL_OPTIONS)
 class Emoji:
     is_custom: bool
     name: str
     emoji_id: int = None
+    _uid: typing.Optional[str] = _uid_field()
 
-    @cached_property
-    def uid(self):
-        if self.is_custom:
-            return 'c' + pack2b64('<Q', self.emoji_id) + ':' + self.name
-        else:
-            emoji_unicode = emoji.EMOJI_UNICODE[f':{self.name}:']
-            emoji_bytes = emoji_unicode.encode('utf-16be')
-            return 'u' + base64.b64encode(emoji_bytes).decode('ascii') + ':' + self.name
+    @property
+    def uid(self) -> str:
+        if self._uid is None:
+            object.__setattr__(self, '_uid', get_emoji_registry().uid(self))
+        return self._uid
 
     @property
     def unicode_char(self):
+        # Imported on use, the emoji tables are slow to build and custom emojis do not need them
+        import emoji
         return emoji.EMOJI_UNICODE.get(f':{self.name}:')
 
     @classmethod
     def from_uid(cls, uid: str):
-        parts = uid[1:].split(':')
-        if len(parts) != 2:
-            return None
-        type_ = uid[0]
-        name = parts[1]
-        if type_ == 'u':
-            if f':{name}:' in emoji.EMOJI_UNICODE:
-                return cls(name=name, is_custom=False)
-            return None
-        elif type_ == 'c':
-            try:
-                emoji_id = unpack_from_b64('<Q', parts[0])[0]
-                return cls(is_custom=True, name=name, emoji_id=emoji_id)
-            except:
-                return None
+        return get_emoji_registry().from_uid(uid)
 
+    def with_count(self, count: int) -> 'MessageEmoji':
+        return get_emoji_registry().counted(self.is_custom, self.name, self.emoji_id, count)
 
-@dataclass
+
+@dataclass(**MODEL_OPTIONS)
 class MessageEmoji(Emoji):
     count: int = 1
 
     @classmethod
     def custom(cls, name: str, emoji_id: int, count: int = 1) -> 'MessageEmoji':
-        return cls(True, name, emoji_id, count)
+        return get_emoji_registry().counted(True, name, emoji_id, count)
 
     @classmethod
     def unicode(cls, name: str, count: int = 1) -> 'MessageEmoji':
-        return cls(False, name, count=count)
+        return get_emoji_registry().counted(False, name, None, count)
 
     @classmethod
     def from_reaction(cls, reaction: discord.RawReactionActionEvent) -> 'MessageEmoji':
         msg_emoji: discord.PartialEmoji = reaction.emoji
         if msg_emoji.is_unicode_emoji():
-            return cls.unicode(emoji.UNICODE_EMOJI[msg_emoji.name][1:-1])
+            emoji_obj = get_emoji_registry().from_char(msg_emoji.name)
+            if emoji_obj is None:
+                raise KeyError(msg_emoji.name)
+            return emoji_obj.with_count(1)
         else:
             return cls.custom(msg_emoji.name, msg_emoji.id)
 
+    @classmethod
+    def from_discord_emoji(cls, msg_emoji: typing.Union[str, discord.Emoji, discord.PartialEmoji],
+                           count: int = 1) -> typing.Optional['MessageEmoji']:
+        """
+        Creates MessageEmoji from discord.Reaction.emoji, returns None for unknown unicode emojis
+        """
+        if isinstance(msg_emoji, str) or msg_emoji.id is None:
+            emoji_obj = get_emoji_registry().from_char(str(msg_emoji))
+            if emoji_obj is None:
+                return None
+            return emoji_obj.with_count(count)
+        return cls.custom(msg_emoji.name, msg_emoji.id, count)
 
-@dataclass
+
+def _encode_uid(is_custom: bool, name: str, emoji_id: typing.Optional[int]) -> str:
+    if is_custom:
+        return 'c' + pack2b64('<Q', emoji_id) + ':' + name
+    import emoji
+    emoji_bytes = emoji.EMOJI_UNICODE[f':{name}:'].encode('utf-16be')
+    return 'u' + base64.b64encode(emoji_bytes).decode('ascii') + ':' + name
+
+
+E = typing.TypeVar('E', bound=Emoji)
+
+
+def _with_uid(emoji_obj: E, uid: str) -> E:
+    object.__setattr__(emoji_obj, '_uid', uid)
+    return emoji_obj
+
+
+class _RegistryEntry:
+    __slots__ = ('emoji', 'uid', 'counted')
+
+    def __init__(self, emoji_obj: Emoji):
+        self.emoji = emoji_obj
+        self.uid = emoji_obj.uid
+        # MessageEmoji of counts -1..EmojiRegistry.MAX_INTERNED_COUNT at index count + 1, created on first use
+        self.counted: typing.List[typing.Optional[MessageEmoji]] = [None] * (EmojiRegistry.MAX_INTERNED_COUNT + 2)
+
+
+class EmojiRegistry:
+    """
+
+    EmojiRegistry interns canonical Emoji instances together with their uids, so decoding a uid or creating
+    a MessageEmoji of a known emoji is a dictionary lookup and returns a shared instance. MessageEmoji
+    instances are interned for the counts a single message or reaction usually has.
+    Unicode emojis are kept for good since their table is finite, custom emojis are kept in an LRU table
+    of `max_custom` entries. Emojis are immutable, so the shared instances are safe to hand out
+
+    """
+
+    MAX_INTERNED_COUNT = 8
+
+    _unicode: typing.Dict[str, _RegistryEntry]
+    _unicode_by_uid: typing.Dict[str, _RegistryEntry]
+    _by_char: typing.Dict[str, _RegistryEntry]
+
+    def __init__(self, max_custom: int = 10000):
+        self._unicode = {}
+        self._unicode_by_uid = {}
+        self._by_char = {}
+        self._custom = LRUCache(max_custom)
+        self._custom_by_uid = LRUCache(max_custom)
+
+    def _unicode_entry(self, name: str) -> typing.Optional[_RegistryEntry]:
+        entry = self._unicode.get(name)
+        if entry is None:
+            import emoji
+            if f':{name}:' not in emoji.EMOJI_UNICODE:
+                return None
+            entry = _RegistryEntry(_with_uid(Emoji(False, name), _encode_uid(False, name, None)))
+            self._unicode[name] = entry
+            self._unicode_by_uid[entry.uid] = entry
+        return entry
+
+    def _custom_entry(self, name: str, emoji_id: int) -> _RegistryEntry:
+        key = (name, emoji_id)
+        entry = self._custom.get(key)
+        if entry is None:
+            entry = _RegistryEntry(_with_uid(Emoji(True, name, emoji_id), _encode_uid(True, name, emoji_id)))
+            self._custom.put(key, entry)
+            self._custom_by_uid.put(entry.uid, entry)
+        return entry
+
+    def get(self, is_custom: bool, name: str, emoji_id: int = None) -> typing.Optional[Emoji]:
+        """
+        Returns the canonical Emoji, None for unknown unicode emojis
+        """
+        entry = self._custom_entry(name, emoji_id) if is_custom else self._unicode_entry(name)
+        return entry.emoji if entry is not None else None
+
+    def from_char(self, char: str) -> typing.Optional[Emoji]:
+        """
+        Returns the canonical Emoji of a unicode emoji sequence, None if it is not a known emoji
+        """
+        entry = self._by_char.get(char)
+        if entry is None:
+            import emoji
+            name = emoji.UNICODE_EMOJI.get(char)
+            entry = self._unicode_entry(name[1:-1]) if name is not None else None
+            if entry is None:
+                return None
+            self._by_char[char] = entry
+        return entry.emoji
+
+    def counted(self, is_custom: bool, name: str, emoji_id: typing.Optional[int], count: int) -> MessageEmoji:
+        entry = self._custom_entry(name, emoji_id) if is_custom else self._unicode_entry(name)
+        if entry is None or not -1 <= count <= self.MAX_INTERNED_COUNT:
+            return MessageEmoji(is_custom, name, emoji_id, count)
+        msg_emoji = entry.counted[count + 1]
+        if msg_emoji is None:
+            msg_emoji = entry.counted[count + 1] = _with_uid(MessageEmoji(is_custom, name, emoji_id, count), entry.uid)
+        return msg_emoji
+
+    def uid(self, emoji_obj: Emoji) -> str:
+        if emoji_obj.is_custom:
+            return self._custom_entry(emoji_obj.name, emoji_obj.emoji_id).uid
+        entry = self._unicode_entry(emoji_obj.name)
+        if entry is None:
+            raise KeyError(f':{emoji_obj.name}:')
+        return entry.uid
+
+    def from_uid(self, uid: str) -> typing.Optional[Emoji]:
+        entry = self._unicode_by_uid.get(uid) or self._custom_by_uid.get(uid)
+        if entry is not None:
+            return entry.emoji
+        parts = uid[1:].split(':')
+        if len(parts) != 2:
+            return None
+        type_ = uid[0]
+        name = parts[1]
+        if type_ == 'u':
+            # Only the name is checked, a uid with other bytes still decodes to the canonical emoji
+            return self.get(False, name)
+        elif type_ == 'c':
+            try:
+                emoji_id = unpack_from_b64('<Q', parts[0])[0]
+            except:
+                return None
+            return self.get(True, name, emoji_id)
+
+
+_registry: typing.Optional[EmojiRegistry] = None
+
+
+def get_emoji_registry() -> EmojiRegistry:
+    global _registry
+    if _registry is None:
+        _registry = EmojiRegistry()
+    return _registry
+
+
+@dataclass(**MODEL_OPTIONS)
 class StatsEmoji:
     emoji: Emoji
     total_mentions: int
     percentage: float
 
 
-@dataclass
+def source_uid(reaction: bool, guild_id: int, user_id: int, message_id: int) -> str:
+    return pack2b64('<?QQQ', reaction, guild_id, user_id, message_id)
+
+
+@dataclass(**MODEL_OPTIONS)
 class EmojiSource:
     """
 
@@ -87,10 +245,13 @@ class EmojiSource:
     message_id: int
     user_id: int
     reaction: bool = False
+    _uid: typing.Optional[str] = _uid_field()
 
-    @cached_property
-    def uid(self):
-        return pack2b64('<?QQQ', self.reaction, self.guild_id, self.user_id, self.message_id)
+    @property
+    def uid(self) -> str:
+        if self._uid is None:
+            object.__setattr__(self, '_uid', source_uid(self.reaction, self.guild_id, self.user_id, self.message_id))
+        return self._uid
 
     @classmethod
     def from_message(cls, message: discord.Message, reaction: bool = False):
@@ -110,3 +271,113 @@ class EmojiSource:
             message_id=reaction.message_id,
             user_id=reaction.user_id
         )
+
+
+def utc_timestamp(at: datetime) -> float:
+    """
+    Returns the unix time of a datetime, naive datetimes are UTC like the ones of discord.py and utcnow()
+    """
+    return (at if at.tzinfo is not None else at.replace(tzinfo=timezone.utc)).timestamp()
+
+
+HistoryRecord = typing.Tuple[EmojiSource, MessageEmoji, datetime]
+# Raw events to delete: all events of the source or, if an emoji is given, only the ones of the emoji
+EventRemoval = typing.Tuple[EmojiSource, typing.Optional[Emoji]]
+# (guild id, message id, user id, reaction, emoji, count, unix time)
+BatchRow = typing.Tuple[int, int, int, int, Emoji, int, float]
+
+
+class EmojiBatch:
+    """
+
+    EmojiBatch is a columnar batch of emojis from messages and reactions: ids, counts and unix times are kept
+    in parallel arrays and emojis as references to the interned registry instances, so a record costs
+    about 50 bytes instead of an EmojiSource, a MessageEmoji and a datetime.
+    The count of a record is the one in `counts`, not the count of its emoji object. Iterating a batch yields
+    (EmojiSource, MessageEmoji, datetime) tuples, so it can be passed wherever a list of history records is
+    expected, backends that know the batch read the columns with `rows`
+
+    """
+
+    __slots__ = ('guild_ids', 'message_ids', 'user_ids', 'reactions', 'emojis', 'counts', 'timestamps')
+
+    emojis: typing.List[Emoji]
+
+    def __init__(self):
+        self.guild_ids = array('Q')
+        self.message_ids = array('Q')
+        self.user_ids = array('Q')
+        self.reactions = array('b')
+        self.emojis = []
+        self.counts = array('q')
+        self.timestamps = array('d')
+
+    @classmethod
+    def of(cls, records: typing.Iterable[HistoryRecord]) -> 'EmojiBatch':
+        if isinstance(records, EmojiBatch):
+            return records
+        batch = cls()
+        batch.extend(records)
+        return batch
+
+    def __len__(self):
+        return len(self.emojis)
+
+    def __iter__(self) -> typing.Iterator[HistoryRecord]:
+        for (guild_id, message_id, user_id, reaction, emoji_obj, count, at) in self.rows():
+            yield (EmojiSource(guild_id, message_id, user_id, bool(reaction)), emoji_obj.with_count(count),
+                   datetime.utcfromtimestamp(at))
+
+    def append(self, guild_id: int, message_id: int, user_id: int, reaction: bool, emoji_obj: Emoji, count: int,
+               at: float):
+        self.guild_ids.append(guild_id)
+        self.message_ids.append(message_id)
+        self.user_ids.append(user_id)
+        self.reactions.append(reaction)
+        self.emojis.append(emoji_obj)
+        self.counts.append(count)
+        self.timestamps.append(at)
+
+    def add(self, source: EmojiSource, emoji_obj: MessageEmoji, at: datetime):
+        self.append(source.guild_id, source.message_id, source.user_id, source.reaction, emoji_obj,
+                    emoji_obj.count, utc_timestamp(at))
+
+    def extend(self, records: typing.Iterable[HistoryRecord]):
+        for (source, emoji_obj, at) in records:
+            self.add(source, emoji_obj, at)
+
+    def rows(self) -> typing.Iterator[BatchRow]:
+        return zip(self.guild_ids, self.message_ids, self.user_ids, self.reactions, self.emojis, self.counts,
+                   self.timestamps)
+
+    @property
+    def total_count(self) -> int:
+        return sum(self.counts)
+
+
+@dataclass
+class GuildConfig:
+    """
+
+    GuildConfig is a decoded guild configuration document
+
+    """
+
+    exists: bool = False
+    tz: timezone = timezone.utc
+    prefix: typing.Optional[str] = None
+    lang: typing.Optional[str] = None
+    data: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_doc(cls, doc: typing.Optional[dict]) -> 'GuildConfig':
+        if doc is None:
+            return cls()
+        offset = doc.get('tz_offset')
+        return cls(
+            exists=True,
+            tz=timezone.utc if offset is None else timezone(timedelta(hours=offset)),
+            prefix=doc.get('cmd_prefix'),
+            lang=doc.get('lang'),
+            data=doc
+        )
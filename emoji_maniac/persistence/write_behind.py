@@ -0,0 +1,165 @@
+import asyncio
+import time
+import typing
+from dataclasses import dataclass
+
+from emoji_maniac.log import get_logger
+
+
+@dataclass
+class FlushStats:
+    flushes: int = 0
+    failures: int = 0
+    increments: int = 0
+    documents: int = 0
+    last_flush_documents: int = 0
+    last_flush_duration: float = 0
+
+    @property
+    def coalescing_ratio(self) -> float:
+        """
+        Average number of increments merged into one written document
+        """
+        if self.documents == 0:
+            return 0
+        return self.increments / self.documents
+
+
+class PartialFlushError(Exception):
+    """
+    Raised by flush callbacks when only some of the documents were written, `failed` holds the indexes of
+    the documents that were not
+    """
+
+    def __init__(self, message: str, failed: typing.Iterable[int]):
+        super(PartialFlushError, self).__init__(message)
+        self.failed = set(failed)
+
+
+class CounterBuffer:
+    """
+
+    CounterBuffer collects $inc deltas in memory, merges them by counter key and hands them over
+    to the flush callback (one call per collection) either periodically, when the number of
+    buffered keys exceeds the limit or when the buffer is closed. Deltas of a collection whose callback
+    failed are put back and retried with the next flush, only the failed documents if the callback raised
+    PartialFlushError
+
+    """
+
+    FlushCallback = typing.Callable[[str, typing.List[typing.Tuple[dict, typing.Dict[str, int]]]], typing.Awaitable]
+
+    def __init__(self, flush_callback: FlushCallback, flush_interval: float = 1.0, max_keys: int = 5000,
+                 log_stats: bool = False):
+        self._flush_callback = flush_callback
+        self._flush_interval = flush_interval
+        self._max_keys = max_keys
+        self._log_stats = log_stats
+        self._pending: typing.Dict[str, typing.Dict[typing.Hashable, typing.Tuple[dict, typing.Dict[str, int]]]] = {}
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._loop_task: typing.Optional[asyncio.Task] = None
+        self._flush_task: typing.Optional[asyncio.Task] = None
+        self.stats = FlushStats()
+        self.log = get_logger(CounterBuffer)
+
+    def __len__(self):
+        return self._size
+
+    def start(self):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        await self.flush()
+
+    def add(self, collection: str, key: typing.Hashable, filter_: dict, inc: typing.Dict[str, int]):
+        self._merge(collection, key, filter_, inc)
+        self.stats.increments += 1
+        if self._size >= self._max_keys:
+            self._schedule_flush()
+
+    def _merge(self, collection: str, key: typing.Hashable, filter_: dict, inc: typing.Dict[str, int]):
+        documents = self._pending.setdefault(collection, {})
+        entry = documents.get(key)
+        if entry is None:
+            documents[key] = (filter_, dict(inc))
+            self._size += 1
+        else:
+            values = entry[1]
+            for (field, value) in inc.items():
+                values[field] = values.get(field, 0) + value
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self.flush())
+            self._flush_task.add_done_callback(self._log_flush_error)
+
+    def _log_flush_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f'Failed to flush counters: {task.exception()}')
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as exc:
+                self.log.error(f'Failed to flush counters: {exc}')
+
+    async def flush(self):
+        async with self._lock:
+            pending, self._pending, self._size = self._pending, {}, 0
+            batches = {}
+            for (collection, documents) in pending.items():
+                # Deltas that cancel each other out (e.g. reaction added and removed) are not written at all
+                batch = [
+                    (key, filter_, {field: value for (field, value) in inc.items() if value != 0})
+                    for (key, (filter_, inc)) in documents.items()
+                ]
+                batch = [(key, filter_, inc) for (key, filter_, inc) in batch if inc]
+                if batch:
+                    batches[collection] = batch
+            if not batches:
+                return
+
+            started_at = time.monotonic()
+            results = await asyncio.gather(*(
+                self._flush_callback(collection, [(filter_, inc) for (_, filter_, inc) in batch])
+                for (collection, batch) in batches.items()
+            ), return_exceptions=True)
+            errors = []
+            documents_count = 0
+            for ((collection, batch), result) in zip(batches.items(), results):
+                if not isinstance(result, BaseException):
+                    documents_count += len(batch)
+                    continue
+                errors.append(result)
+                # Deltas that were not written are put back and retried with the next flush, the written
+                # ones must not be, or they would be counted twice
+                failed = result.failed if isinstance(result, PartialFlushError) else range(len(batch))
+                for index in failed:
+                    (key, filter_, inc) = batch[index]
+                    self._merge(collection, key, filter_, inc)
+                documents_count += len(batch) - len(failed)
+            if errors:
+                self.stats.failures += 1
+                raise errors[0]
+
+            self.stats.flushes += 1
+            self.stats.documents += documents_count
+            self.stats.last_flush_documents = documents_count
+            self.stats.last_flush_duration = time.monotonic() - started_at
+
+            message = f'Flushed {documents_count} counters in {round(self.stats.last_flush_duration * 1000)}ms ' \
+                      f'(total flushes = {self.stats.flushes}, coalescing ratio = {self.stats.coalescing_ratio:.2f})'
+            if self._log_stats:
+                self.log.info(message)
+            else:
+                self.log.debug(message)
+
+        if self._size >= self._max_keys:
+            self._schedule_flush()
@@ -0,0 +1,167 @@
+"""
+
+Startup profile mode: times module imports and the phases of bot startup up to the gateway connection
+and reports them once the bot is ready.
+
+    python main.py --profile-startup
+
+"""
+import contextlib
+import sys
+import time
+import typing
+
+_profiler: typing.Optional['StartupProfiler'] = None
+
+
+class _TimingLoader:
+    """
+
+    Wraps the loader of a module spec and times its exec_module, the real loader is put back before the
+    module is executed, so the module never sees the wrapper
+
+    """
+
+    def __init__(self, loader, profiler: 'StartupProfiler'):
+        self._loader = loader
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+        with self._profiler.importing(module.__name__):
+            self._loader.exec_module(module)
+
+
+class _TimingFinder:
+    def __init__(self, profiler: 'StartupProfiler'):
+        self._profiler = profiler
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimingLoader(spec.loader, self._profiler)
+                return spec
+        return None
+
+
+class StartupProfiler:
+    """
+
+    StartupProfiler records self and cumulative import time of every module imported after it was
+    installed, the duration of named phases and the time of marks since it was installed
+
+    """
+
+    # module -> (self seconds, cumulative seconds)
+    imports: typing.Dict[str, typing.Tuple[float, float]]
+    phases: typing.List[typing.Tuple[str, float]]
+    marks: typing.List[typing.Tuple[str, float]]
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.imports = {}
+        self.phases = []
+        self.marks = []
+        self._children: typing.List[float] = []
+        self._finder = _TimingFinder(self)
+        self.reported = False
+
+    def install(self):
+        sys.meta_path.insert(0, self._finder)
+
+    def uninstall(self):
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    @contextlib.contextmanager
+    def importing(self, name: str):
+        started_at = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - started_at
+            children = self._children.pop()
+            self.imports[name] = (total - children, total)
+            if self._children:
+                self._children[-1] += total
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started_at))
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter() - self.started_at))
+
+    def report(self, top: int = 25) -> typing.List[str]:
+        lines = [f'{"ms":>8}  mark (since start)']
+        lines += [f'{at * 1000:8.1f}  {name}' for (name, at) in self.marks]
+        lines.append(f'{"ms":>8}  phase')
+        lines += [f'{duration * 1000:8.1f}  {name}' for (name, duration) in self.phases]
+        lines.append(f'{"self ms":>8}  {"total ms":>8}  module ({len(self.imports)} imported, top {top} by self time)')
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        lines += [f'{own * 1000:8.1f}  {total * 1000:8.1f}  {name}' for (name, (own, total)) in slowest]
+        packages = {}
+        for (name, (own, _)) in self.imports.items():
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + own
+        lines.append(f'{"self ms":>8}  package')
+        lines += [f'{own * 1000:8.1f}  {package}'
+                  for (package, own) in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]]
+        return lines
+
+
+def enable() -> StartupProfiler:
+    """
+    Starts profiling, must be called before the modules of interest are imported
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = StartupProfiler()
+        _profiler.install()
+    return _profiler
+
+
+def get_profiler() -> typing.Optional[StartupProfiler]:
+    return _profiler
+
+
+def phase(name: str):
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name)
+
+
+def mark(name: str):
+    if _profiler is not None and not _profiler.reported:
+        _profiler.mark(name)
+
+
+def report():
+    """
+    Logs the profile once and stops timing imports
+    """
+    if _profiler is None or _profiler.reported:
+        return
+    from emoji_maniac.log import get_logger
+    _profiler.reported = True
+    _profiler.uninstall()
+    log = get_logger('Startup')
+    for line in _profiler.report():
+        log.info(line)
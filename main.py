@@ -1,3 +1,15 @@
-from emoji_maniac.bot.default import run_default
+import sys
 
-run_default(True)
\ No newline at end of file
+if '--profile-startup' in sys.argv[1:]:
+    # Imports are timed from here on, so this goes before the imports of the bot
+    from emoji_maniac import startup
+    startup.enable()
+
+from emoji_maniac.bot.default import run_default, run_sharded
+
+# Shard processes are spawned and import this module, so the bot is only started from the main process
+if __name__ == '__main__':
+    if '--sharded' in sys.argv[1:]:
+        run_sharded(True)
+    else:
+        run_default(True)